@@ -1,15 +1,25 @@
-from fastapi import FastAPI, HTTPException
-from db_manager import DatabaseManager, IPConfig
+from fastapi import FastAPI, HTTPException, Query
+from fastapi.responses import Response, StreamingResponse
+from db_manager import DatabaseManager, IPConfig, IP_PAGE_DEFAULT_LIMIT, ip_cache_stats_from_metrics
 from pydantic import BaseModel
-from typing import List, Optional
-from cache_manager import HeartbeatCache
+from typing import Iterator, List, Optional
+from contextlib import asynccontextmanager
+from dataclasses import asdict
+from datetime import datetime
+import json
+import time
+from metrics import REGISTRY
+from cache_manager import (
+    AsyncHeartbeatCache, HeartbeatSnapshot, HEARTBEAT_L1_CACHE, HEARTBEAT_SNAPSHOT_PATH, fetch_heartbeats, retention_cutoff
+)
 import pandas as pd
 import mariadb
 from sqlalchemy.engine import url as sa_url
 
-app = FastAPI()
-db_manager = DatabaseManager()
-cache = HeartbeatCache()
+db_manager = DatabaseManager(source='api')
+# L1 is enabled in lifespan: main.py imports this module before forking the API
+# process, and the pub/sub thread that keeps L1 coherent would not survive the fork
+cache = AsyncHeartbeatCache(snapshot=HeartbeatSnapshot() if HEARTBEAT_SNAPSHOT_PATH else None)
 
 # Extract connection parameters from SQLAlchemy engine
 url = sa_url.make_url(db_manager.engine.url)
@@ -24,6 +34,23 @@ db_config = {
     'connect_timeout': 60
 }
 
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Warm the heartbeat cache, and this process's L1, before uvicorn accepts requests"""
+    if HEARTBEAT_L1_CACHE:
+        cache.enable_l1()
+    try:
+        await cache.get_or_refresh(load_heartbeats_from_db, as_json=True)
+    except Exception as e:
+        # Serve anyway; /ready reports 503 until a cache generation exists
+        print(f"Heartbeat cache warm-up failed: {e}")
+    try:
+        yield
+    finally:
+        cache.disable_l1()
+
+app = FastAPI(lifespan=lifespan)
+
 class IPConfigRequest(BaseModel):
     ip: str
     device_name: Optional[str] = ""
@@ -33,34 +60,47 @@ class IPConfigRequest(BaseModel):
 async def root():
     return {"message": "TCP Responder API"}
 
+def load_heartbeats_from_db() -> pd.DataFrame:
+    """Load the heartbeats of the cache retention window from MariaDB"""
+    conn = mariadb.connect(**db_config)
+    conn.autocommit = True
+    # Unbuffered, so rows are streamed in chunks instead of held by the driver
+    cursor = conn.cursor(buffered=False)
+    try:
+        return fetch_heartbeats(cursor, retention_cutoff())
+    finally:
+        cursor.close()
+        conn.close()
+
+@app.get("/ready")
+async def ready():
+    """Report ready once the heartbeat cache has a generation to serve from"""
+    generation = await cache.get_generation()
+    if generation is None:
+        raise HTTPException(status_code=503, detail="Heartbeat cache is not warm yet")
+    return {"generation": generation}
+
 @app.get("/heartbeats")
-async def get_heartbeats():
-    """Get heartbeat data from cache or database"""
+async def get_heartbeats(monitor_id: Optional[List[int]] = Query(None), since: Optional[datetime] = None):
+    """
+    Get heartbeat data from cache, refreshing it from the database at most once at a time.
+
+    since selects whole hourly segments, so it may return up to an hour of
+    earlier heartbeats.
+    """
     try:
-        # Try to get data from cache first
-        df = cache.get_data()
-        if df is not None:
-            return df.to_dict(orient='records')
-        
-        # If not in cache, get from database using MariaDB connector
-        conn = mariadb.connect(**db_config)
-        conn.autocommit = True
-        cursor = conn.cursor(dictionary=True)
-        
-        try:
-            cursor.execute("""
-                SELECT h.* 
-                FROM heartbeat h
-                JOIN monitor m ON h.monitor_id = m.id
-            """)
-            results = cursor.fetchall()
-            df = pd.DataFrame(results)
-            # Cache the data
-            cache.set_data(df)
-            return df.to_dict(orient='records')
-        finally:
-            cursor.close()
-            conn.close()
+        body = await cache.get_or_refresh(load_heartbeats_from_db, monitor_ids=monitor_id, as_json=True, since=since)
+        return Response(content=body, media_type="application/json")
+    except TimeoutError as e:
+        raise HTTPException(status_code=503, detail=str(e))
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.get("/heartbeats/stats")
+async def get_heartbeat_stats(monitor_id: Optional[List[int]] = Query(None)):
+    """Get 1h/24h/7d/30d uptime and ping aggregates and the last status change per monitor"""
+    try:
+        return await cache.get_stats(monitor_ids=monitor_id)
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
@@ -80,11 +120,21 @@ async def add_ip(ip_config: IPConfigRequest):
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+def stream_ips_json() -> Iterator[str]:
+    """Encode all IP configurations as a JSON array, one chunk at a time"""
+    yield "["
+    for i, ip_config in enumerate(db_manager.iter_ips()):
+        yield ("," if i else "") + json.dumps(asdict(ip_config))
+    yield "]"
+
 @app.get("/ip")
-async def get_ips():
-    """Get all IP configurations"""
+async def get_ips(cursor: Optional[int] = None, limit: Optional[int] = None):
+    """Get IP configurations, paginated by id when cursor or limit is given"""
     try:
-        return db_manager.get_all_ips()
+        if cursor is None and limit is None:
+            return StreamingResponse(stream_ips_json(), media_type="application/json")
+        items, next_cursor = db_manager.get_ips_page(cursor or 0, limit or IP_PAGE_DEFAULT_LIMIT)
+        return {"items": items, "next_cursor": next_cursor}
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
@@ -104,4 +154,39 @@ async def sync_from_ninja():
         ips = db_manager.sync_from_ninja()
         return {"message": f"Synced {len(ips)} IPs from NinjaRMM"}
     except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e)) 
\ No newline at end of file
+        raise HTTPException(status_code=500, detail=str(e))
+
+@app.get("/ip/cache/stats")
+async def get_ip_cache_stats():
+    """Get hit/miss statistics of the IP lookup cache of the API process and, as last published, of the TCP process"""
+    stats = {'api': db_manager.get_cache_stats()}
+    processes = await cache.get_published_metrics()
+    for source, snapshot in processes.items():
+        published = ip_cache_stats_from_metrics(snapshot['metrics'])
+        if published:
+            stats[source] = published
+    return stats
+
+@app.get("/metrics")
+async def get_metrics():
+    """Get the metrics of the API process and those recently published by the sync processes"""
+    processes = await cache.get_published_metrics()
+    processes['api'] = {'published_at': time.time(), 'metrics': REGISTRY.snapshot()}
+    return processes
+
+@app.get("/debug/cache")
+async def get_cache_debug():
+    """Get the heartbeat cache versions, segments and freshness"""
+    return await cache.get_debug_info()
+
+@app.get("/debug/queries")
+async def get_query_stats():
+    """Get per-method database query latency of the API and the slow-query logs of every process, newest last"""
+    stats = db_manager.get_query_stats()
+    logs = db_manager.get_published_slow_queries()
+    logs['api'] = stats['slow_queries']
+    stats['slow_queries'] = sorted(
+        ({'process': source, **entry} for source, entries in logs.items() for entry in entries),
+        key=lambda entry: entry['timestamp']
+    )
+    return stats
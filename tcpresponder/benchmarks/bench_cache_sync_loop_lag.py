@@ -0,0 +1,123 @@
+"""
+Measure event loop lag while CacheSync runs a full refresh, then an
+incremental one that seals the open segment before appending, to check that
+refreshes never stall the loop shared with the TCP server.
+
+The database is replaced by a cursor serving generated heartbeats after a
+simulated query time; Redis is the one at REDIS_HOST/REDIS_PORT. Exits with
+status 1 if the 99th percentile lag of either refresh exceeds the budget.
+The maximum is reported too: it is bounded by garbage collection pauses and
+single long C calls holding the GIL, which stall the loop whatever thread
+runs them.
+
+Usage:
+    python benchmarks/bench_cache_sync_loop_lag.py [row_count] [budget_ms]
+"""
+import asyncio
+import os
+import sys
+import time
+from datetime import datetime, timedelta, timezone
+from unittest.mock import Mock
+
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from bench_heartbeat_serialization import make_heartbeats
+from cache_manager import SEGMENT_SECONDS, CacheSync, open_segment_start
+from metrics import MetricsRegistry, monitor_loop_lag
+
+QUERY_SECONDS = 0.5
+TICK_SECONDS = 0.001
+
+
+class FakeCursor:
+    """Serves heartbeats like a driver cursor, blocking for QUERY_SECONDS per query"""
+
+    def __init__(self, df):
+        self.df = df
+        self.description = [(name,) for name in df.columns]
+        self.query = ''
+        self.rows = df
+        self.position = 0
+
+    def execute(self, query, params=None):
+        time.sleep(QUERY_SECONDS)
+        self.query = query
+        # Incremental refreshes only ask for the ids above the watermark
+        self.rows = self.df[self.df['id'] > params[0]] if 'h.id >' in query else self.df
+        self.position = 0
+
+    def fetchall(self):
+        # No history to backfill the daily aggregates from
+        return []
+
+    def fetchmany(self, size):
+        # Rows are built per chunk, as a driver reads them off the wire
+        chunk = self.rows.iloc[self.position:self.position + size]
+        self.position += len(chunk)
+        return list(chunk.itertuples(index=False, name=None))
+
+    def close(self):
+        pass
+
+
+class FakeConnection:
+    def __init__(self, df):
+        self.df = df
+
+    def cursor(self, **kwargs):
+        return FakeCursor(self.df)
+
+
+async def measure(label: str, refresh, row_count: int, budget_ms: float) -> bool:
+    """Await refresh while sampling loop lag, and report whether its p99 stays within budget"""
+    registry = MetricsRegistry()
+    lag_task = asyncio.create_task(monitor_loop_lag(TICK_SECONDS, registry))
+    started = time.perf_counter()
+    await refresh
+    elapsed = time.perf_counter() - started
+    lag_task.cancel()
+
+    lag = registry.histogram('event_loop_lag_seconds').snapshot()
+    # Upper bound of the bucket holding the 99th percentile
+    p99 = next(bound for bound, count in lag['buckets'].items() if count >= 0.99 * lag['count'])
+    p99_ms = float(p99) * 1000
+    worst_ms = registry.gauge('event_loop_lag_max_seconds').value * 1000
+    print(f"{label:<11} rows={row_count} refresh={elapsed * 1000:8.1f} ms ticks={lag['count']} "
+          f"mean_lag={lag['sum'] / max(lag['count'], 1) * 1000:6.2f} ms p99_lag<={p99_ms:6.2f} ms "
+          f"max_lag={worst_ms:6.2f} ms budget={budget_ms} ms")
+    return p99_ms <= budget_ms
+
+
+async def run(row_count: int, budget_ms: float) -> bool:
+    df = make_heartbeats(row_count)
+    # Spread the rows over the last day, so they are all inside the retention window
+    now = datetime.now(timezone.utc).replace(tzinfo=None)
+    df['time'] = [now - timedelta(seconds=86400 * (row_count - i) / row_count) for i in range(row_count)]
+    cursor = FakeCursor(df)
+
+    sync = CacheSync(Mock())
+    sync.conn = FakeConnection(df)
+    # Warm up imports and caches first: the guarantee is about steady-state refreshes
+    await sync.refresh_full(cursor)
+    full_ok = await measure('full', sync.refresh_full(cursor), row_count, budget_ms)
+
+    # Move the open segment back an hour, so the incremental refresh seals it, reading
+    # and rewriting every open shard, before appending a percent more rows
+    cache = sync.cache
+    generation = int(cache._sync_client.get(cache.CURRENT_KEY))
+    cache._sync_client.set(cache.open_segment_key(generation), open_segment_start() - SEGMENT_SECONDS)
+    new_rows = make_heartbeats(max(row_count // 100, 1))
+    new_rows['id'] += row_count
+    new_rows['time'] = datetime.now(timezone.utc).replace(tzinfo=None)
+    sync.conn = FakeConnection(pd.concat([df, new_rows], ignore_index=True))
+    incremental_ok = await measure('incremental', sync.refresh_incremental(cursor), len(new_rows), budget_ms)
+    return full_ok and incremental_ok
+
+
+if __name__ == "__main__":
+    row_count = int(sys.argv[1]) if len(sys.argv) > 1 else 100_000
+    budget_ms = float(sys.argv[2]) if len(sys.argv) > 2 else 5.0
+    sys.exit(0 if asyncio.run(run(row_count, budget_ms)) else 1)
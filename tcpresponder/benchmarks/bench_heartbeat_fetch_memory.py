@@ -0,0 +1,78 @@
+"""
+Compare the peak memory of loading heartbeats with fetchall() into a list of
+dicts and then a DataFrame, against read_chunks() streaming fixed-size chunks
+from an unbuffered cursor into Arrow.
+
+Each path runs in a fresh interpreter and reports its peak RSS growth next to
+the size of the resulting DataFrame. The cursor generates rows on demand, the
+way an unbuffered driver cursor reads them off the wire.
+
+Usage:
+    python benchmarks/bench_heartbeat_fetch_memory.py [row_count ...]
+"""
+import os
+import resource
+import subprocess
+import sys
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+COLUMNS = ('id', 'important', 'monitor_id', 'status', 'msg', 'time', 'ping', 'duration', 'down_count', 'retries')
+MESSAGES = ('', 'OK', '200 - OK', 'timeout of 48000ms exceeded', 'Connection_from_10.0.0.1')
+START = datetime(2025, 1, 1)
+
+
+def make_row(i: int) -> tuple:
+    return (i, i % 50 == 0, i % 200, 1 if i % 20 else 0, MESSAGES[i % len(MESSAGES)],
+            START + timedelta(seconds=20 * i), None if i % 20 == 0 else i % 500, i % 60, i % 3, i % 3)
+
+
+class FakeCursor:
+    """Generates row_count heartbeat rows on demand"""
+
+    description = [(name,) for name in COLUMNS]
+
+    def __init__(self, row_count: int):
+        self.row_count = row_count
+        self.position = 0
+
+    def fetchall(self):
+        # A dictionary cursor, as the refresh used before
+        return [dict(zip(COLUMNS, make_row(i))) for i in range(self.row_count)]
+
+    def fetchmany(self, size: int):
+        end = min(self.position + size, self.row_count)
+        rows = [make_row(i) for i in range(self.position, end)]
+        self.position = end
+        return rows
+
+
+def peak_rss_mib() -> float:
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def measure(path: str, row_count: int) -> None:
+    import pandas as pd
+    from cache_manager import read_chunks
+
+    cursor = FakeCursor(row_count)
+    before = peak_rss_mib()
+    if path == 'fetchall':
+        df = pd.DataFrame(cursor.fetchall())
+    else:
+        df = read_chunks(cursor)
+    growth = peak_rss_mib() - before
+    size = df.memory_usage(deep=True).sum() / 1024 / 1024
+    print(f"{path:<9} rows={row_count:<9} frame={size:8.1f} MiB peak_growth={growth:8.1f} MiB "
+          f"overhead={growth / size:5.2f}x")
+
+
+if __name__ == "__main__":
+    if len(sys.argv) == 4 and sys.argv[1] == '--run':
+        measure(sys.argv[2], int(sys.argv[3]))
+        sys.exit(0)
+    counts = [int(arg) for arg in sys.argv[1:]] or [250_000, 1_000_000]
+    for count in counts:
+        for path in ('fetchall', 'chunked'):
+            subprocess.run([sys.executable, __file__, '--run', path, str(count)], check=True)
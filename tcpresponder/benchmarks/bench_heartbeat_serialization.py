@@ -0,0 +1,69 @@
+"""
+Compare pickle and Arrow IPC payloads for HeartbeatCache, with and without
+compression: payload size, serialisation time, full deserialisation and a
+two-column projection.
+
+Usage:
+    python benchmarks/bench_heartbeat_serialization.py [row_count]
+"""
+import os
+import sys
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import numpy as np
+import pandas as pd
+from cache_manager import HeartbeatCache
+
+REPEAT = 5
+
+
+def make_heartbeats(row_count: int) -> pd.DataFrame:
+    """Build a frame shaped like the rows of Uptime Kuma's heartbeat table"""
+    rng = np.random.default_rng(0)
+    start = datetime(2025, 1, 1)
+    status = rng.choice([0, 1, 2, 3], size=row_count, p=[0.05, 0.93, 0.01, 0.01])
+    messages = np.array(['', 'OK', '200 - OK', 'timeout of 48000ms exceeded', 'Connection_from_10.0.0.1'], dtype=object)
+    return pd.DataFrame({
+        'id': np.arange(1, row_count + 1),
+        'important': rng.random(row_count) < 0.02,
+        'monitor_id': rng.integers(1, 200, size=row_count),
+        'status': status,
+        'msg': messages[rng.integers(0, len(messages), size=row_count)],
+        'time': [start + timedelta(seconds=20 * i) for i in range(row_count)],
+        'ping': rng.integers(1, 500, size=row_count),
+        'duration': rng.integers(0, 60, size=row_count),
+        'down_count': rng.integers(0, 3, size=row_count),
+        'retries': rng.integers(0, 3, size=row_count)
+    })
+
+
+def best_of(func):
+    timings = []
+    for _ in range(REPEAT):
+        start = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - start)
+    return min(timings) * 1000
+
+
+def run(df: pd.DataFrame, serialization: str, compression: str = 'none'):
+    cache = HeartbeatCache(serialization=serialization, compression=compression)
+    payload = cache.serialize(df)
+    dump_ms = best_of(lambda: cache.serialize(df))
+    load_ms = best_of(lambda: cache.deserialize(payload))
+    project_ms = best_of(lambda: cache.deserialize(payload, columns=['monitor_id', 'status']))
+    print(f"{serialization + '+' + compression:<12} size={len(payload) / 1024 / 1024:7.2f} MiB "
+          f"dump={dump_ms:8.2f} ms load={load_ms:8.2f} ms load[monitor_id,status]={project_ms:8.2f} ms")
+
+
+if __name__ == "__main__":
+    rows = int(sys.argv[1]) if len(sys.argv) > 1 else 200_000
+    frame = make_heartbeats(rows)
+    print(f"{rows} heartbeat rows")
+    run(frame, 'pickle')
+    run(frame, 'arrow')
+    run(frame, 'arrow', 'lz4')
+    run(frame, 'arrow', 'zstd')
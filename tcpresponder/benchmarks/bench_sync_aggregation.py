@@ -0,0 +1,78 @@
+"""
+Compare the pandas-based device aggregation formerly used by
+DatabaseManager.sync_from_ninja with the single-pass aggregate_device_ips.
+
+Usage:
+    python benchmarks/bench_sync_aggregation.py [device_count]
+"""
+import os
+import random
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import pandas as pd
+from db_manager import aggregate_device_ips
+
+PAGE_SIZE = 1000
+
+
+def make_device(device_id: int) -> dict:
+    org = device_id % 400
+    location = device_id % 7
+    return {
+        'id': device_id,
+        'systemName': f"device-{device_id}",
+        'dnsName': f"device-{device_id}.example.local",
+        'publicIP': f"203.0.{org % 256}.{location + 1}",
+        'ipAddresses': [f"10.{org % 256}.{location}.{device_id % 250}"],
+        'os': {'name': 'Windows 11 Pro', 'buildNumber': '22631', 'architecture': '64-bit'},
+        'system': {'manufacturer': 'Dell Inc.', 'model': 'OptiPlex 7090', 'serialNumber': f"SN{device_id:08d}"},
+        'lastContact': random.random() * 1e9,
+        'references': {
+            'organization': {'id': org, 'name': f"Organization {org}", 'description': 'x' * 64},
+            'location': {'id': org * 10 + location, 'name': f"Location {location}", 'address': 'y' * 64}
+        }
+    }
+
+
+def pages(device_count: int):
+    """Yield devices the way _iter_ninja_devices does: one page in memory at a time"""
+    for start in range(0, device_count, PAGE_SIZE):
+        page = [make_device(i) for i in range(start, min(start + PAGE_SIZE, device_count))]
+        yield from page
+
+
+def pandas_path(device_count: int):
+    ninja_data = [make_device(i) for i in range(device_count)]
+    df = pd.json_normalize(ninja_data)
+    df = df[['references.organization.name', 'references.location.name', 'publicIP']]
+    df = df.dropna()
+    ip_counts = df.groupby(['references.organization.name', 'references.location.name', 'publicIP']).size()
+    ip_counts = ip_counts.reset_index(name='count')
+    ip_counts = ip_counts.sort_values(['references.organization.name', 'count'], ascending=[True, False])
+    rows = [row for _, row in ip_counts.iterrows()]
+    return len(rows)
+
+
+def streaming_path(device_count: int):
+    return len(aggregate_device_ips(pages(device_count)))
+
+
+def measure(name, func, device_count):
+    tracemalloc.start()
+    start = time.perf_counter()
+    groups = func(device_count)
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(f"{name:<10} groups={groups:<6} time={elapsed:7.3f}s peak={peak / 1024 / 1024:8.1f} MiB")
+
+
+if __name__ == "__main__":
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 50_000
+    print(f"Aggregating {count} devices")
+    measure("pandas", pandas_path, count)
+    measure("streaming", streaming_path, count)
@@ -1,110 +1,1978 @@
 import redis
+import redis.asyncio
 import pickle
 import pandas as pd
+import pyarrow as pa
+import orjson
+import zstandard
+import lz4.frame
 import mariadb
 import os
 import asyncio
-from typing import Optional
-from datetime import datetime
+import inspect
+import math
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from functools import partial
+from typing import Callable, Dict, Hashable, Iterable, List, Optional, Sequence, Set, Tuple
+from datetime import datetime, timedelta, timezone
 from sqlalchemy import create_engine
 from sqlalchemy.engine import url as sa_url
 from db_manager import DB_CONFIG
+from metrics import REGISTRY
 
-class HeartbeatCache:
-    def __init__(self):
-        self.redis_client = redis.Redis(
-            host=os.getenv('REDIS_HOST', 'redis'),
-            port=int(os.getenv('REDIS_PORT', 6379)),
-            db=0,
-            decode_responses=False
+# 'arrow' (Arrow IPC file format) or 'pickle'. Pickle payloads are only ever
+# unpickled in 'pickle' mode since loading them from a shared Redis can run code.
+HEARTBEAT_CACHE_SERIALIZATION = os.getenv('HEARTBEAT_CACHE_SERIALIZATION', 'arrow')
+ARROW_MAGIC = b'ARROW1'
+
+# Optional payload compression: 'none', 'zstd' or 'lz4', applied to payloads of at
+# least HEARTBEAT_CACHE_COMPRESSION_MIN_BYTES. Compressed payloads start with a codec
+# header byte; uncompressed ones are stored as-is so older readers keep working.
+HEARTBEAT_CACHE_COMPRESSION = os.getenv('HEARTBEAT_CACHE_COMPRESSION', 'none')
+HEARTBEAT_CACHE_COMPRESSION_MIN_BYTES = int(os.getenv('HEARTBEAT_CACHE_COMPRESSION_MIN_BYTES', 16 * 1024))
+CODEC_HEADERS = {'zstd': b'\x01', 'lz4': b'\x02'}
+COMPRESSION_RATIO_BUCKETS = (1, 1.5, 2, 3, 4, 6, 8, 12, 16, 32)
+PAYLOAD_SIZE_BUCKETS = tuple(1024 * 4 ** power for power in range(9))  # 1 KiB .. 64 MiB
+
+# Sync processes publish their metrics to Redis so the API can serve them.
+# Snapshots older than this are left out of /metrics.
+HEARTBEAT_METRICS_TTL = int(os.getenv('HEARTBEAT_METRICS_TTL', 60))  # seconds
+
+# Heartbeats are streamed from an unbuffered cursor this many rows at a time
+HEARTBEAT_FETCH_CHUNK_ROWS = int(os.getenv('HEARTBEAT_FETCH_CHUNK_ROWS', 10000))
+
+# Heartbeats older than this are trimmed from the cache by CacheSync
+HEARTBEAT_CACHE_RETENTION = int(os.getenv('HEARTBEAT_CACHE_RETENTION', 24 * 60 * 60))  # seconds
+
+# Heartbeats are cached in hourly segments. Once an hour has been over for
+# HEARTBEAT_SEGMENT_GRACE seconds it is sealed: written once and kept until it has
+# left the retention window. Refreshes only ever rewrite the open segment.
+SEGMENT_SECONDS = 3600
+HEARTBEAT_SEGMENT_GRACE = int(os.getenv('HEARTBEAT_SEGMENT_GRACE', 120))  # seconds
+# Field present in every sealed segment hash, so that empty segments still exist
+SEGMENT_SENTINEL = b'_'
+
+# Change probe used by CacheSync: 'max_id' or 'auto_increment'
+HEARTBEAT_CHANGE_PROBE = os.getenv('HEARTBEAT_CHANGE_PROBE', 'max_id')
+
+# Full writes build a new generation of keys under heartbeat_data:v{n} and then
+# switch the pointer to it, so readers keep being served the previous generation
+# meanwhile. Keys of a replaced generation expire after this many seconds.
+HEARTBEAT_GENERATION_GRACE = int(os.getenv('HEARTBEAT_GENERATION_GRACE', 60))
+
+# Single-flight refresh: only the holder of the Redis lease rebuilds the cache
+HEARTBEAT_REFRESH_LEASE_MS = int(os.getenv('HEARTBEAT_REFRESH_LEASE_MS', 30000))
+HEARTBEAT_REFRESH_WAIT = float(os.getenv('HEARTBEAT_REFRESH_WAIT', 10))  # seconds
+
+# In-process L1 copy of the shards, kept coherent through Redis pub/sub
+HEARTBEAT_L1_CACHE = os.getenv('HEARTBEAT_L1_CACHE', 'true').lower() == 'true'
+
+# Sealed segments of the current generation, kept by CacheSync in a local Arrow file that
+# every process on the host memory-maps instead of copying them out of Redis. Redis
+# stays the cache shared between hosts. Empty to disable.
+HEARTBEAT_SNAPSHOT_PATH = os.getenv('HEARTBEAT_SNAPSHOT_PATH', 'data/heartbeat_segments.arrow')
+
+# Per-monitor uptime and ping aggregates, kept as buckets so that rolling windows
+# can be summed at read time. Windows are aligned to their bucket size.
+STATS_RESOLUTIONS = {'minute': 60, 'hour': 3600, 'day': 86400}
+STATS_WINDOWS = {
+    '1h': ('minute', 3600),
+    '24h': ('hour', 24 * 3600),
+    '7d': ('day', 7 * 86400),
+    '30d': ('day', 30 * 86400)
+}
+# Buckets are dropped once they have left the longest window of their resolution
+STATS_KEEP = {resolution: max(seconds for r, seconds in STATS_WINDOWS.values() if r == resolution)
+              for resolution in STATS_RESOLUTIONS}
+STATS_TTL = 31 * 86400  # seconds without heartbeats before a monitor's aggregates expire
+# Kuma heartbeat.status values
+STATUS_DOWN = 0
+STATUS_UP = 1
+
+# Heartbeat columns loaded into the cache. Columns of the monitor table are only
+# joined in, as monitor_{column}, when listed in HEARTBEAT_MONITOR_COLUMNS.
+HEARTBEAT_COLUMNS = ('id', 'important', 'monitor_id', 'status', 'msg', 'time', 'ping',
+                     'duration', 'down_count', 'end_time', 'retries')
+HEARTBEAT_MONITOR_COLUMNS = tuple(column.strip() for column in os.getenv('HEARTBEAT_MONITOR_COLUMNS', '').split(',')
+                                  if column.strip())
+
+# Narrowest types that hold Kuma's heartbeat columns. msg has few distinct values, so it
+# is dictionary encoded and becomes a categorical column in pandas. ping is left alone:
+# it has NULLs and is summed into the aggregates.
+HEARTBEAT_TYPES = {
+    'id': pa.int64(),
+    'important': pa.bool_(),
+    'monitor_id': pa.int32(),
+    'status': pa.int8(),
+    'msg': pa.dictionary(pa.int32(), pa.string()),
+    'time': pa.timestamp('us'),
+    'duration': pa.int32(),
+    'down_count': pa.int32(),
+    'end_time': pa.timestamp('us'),
+    'retries': pa.int32()
+}
+
+def heartbeat_query(monitor_columns: Sequence[str] = HEARTBEAT_MONITOR_COLUMNS) -> str:
+    """SELECT of the cached heartbeat columns, joining monitor only if some of its columns are wanted"""
+    for column in monitor_columns:
+        if not column.isidentifier():
+            raise ValueError(f"Invalid monitor column: {column}")
+    columns = [f"h.{column}" for column in HEARTBEAT_COLUMNS]
+    columns += [f"m.{column} AS monitor_{column}" for column in monitor_columns]
+    query = f"SELECT {', '.join(columns)} FROM heartbeat h"
+    if monitor_columns:
+        query += " JOIN monitor m ON h.monitor_id = m.id"
+    return query
+
+HEARTBEAT_QUERY = heartbeat_query()
+
+# Daily aggregates, used to backfill the 7d/30d windows beyond the cache retention.
+# TIMESTAMPDIFF keeps heartbeat.time in UTC whatever the session time zone.
+DAILY_STATS_QUERY = """
+    SELECT h.monitor_id,
+           FLOOR(TIMESTAMPDIFF(SECOND, '1970-01-01', h.time) / 86400) * 86400 AS bucket,
+           SUM(h.status = 1) AS up,
+           SUM(h.status = 0) AS down,
+           COUNT(h.ping) AS ping_count,
+           SUM(h.ping) AS ping_sum,
+           MIN(h.ping) AS ping_min,
+           MAX(h.ping) AS ping_max
+    FROM heartbeat h
+    WHERE h.time >= %s AND h.time < %s
+    GROUP BY h.monitor_id, bucket
+"""
+
+# Bumps the cache version and announces it to L1 caches in the same round trip
+PUBLISH_INVALIDATION_SCRIPT = """
+local version = redis.call('incr', KEYS[1])
+redis.call('publish', ARGV[1], version .. ':' .. ARGV[2])
+return version
+"""
+
+# Deletes the lease only if it is still held by the caller's token
+RELEASE_LEASE_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+"""
+
+# Extends the lease to ARGV[2] ms only if it is still held by the caller's token
+RENEW_LEASE_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('pexpire', KEYS[1], ARGV[2])
+end
+return 0
+"""
+
+_REDIS_POOLS: Dict[Tuple[bool, str, int], object] = {}
+
+def get_redis_pool(use_asyncio: bool = False):
+    """Connection pool shared by every heartbeat cache client of this process"""
+    host = os.getenv('REDIS_HOST', 'redis')
+    port = int(os.getenv('REDIS_PORT', 6379))
+    key = (use_asyncio, host, port)
+    pool = _REDIS_POOLS.get(key)
+    if pool is None:
+        pool_class = redis.asyncio.ConnectionPool if use_asyncio else redis.ConnectionPool
+        pool = _REDIS_POOLS.setdefault(key, pool_class(host=host, port=port, db=0, decode_responses=False))
+    return pool
+
+def retention_cutoff(retention: timedelta = timedelta(seconds=HEARTBEAT_CACHE_RETENTION)) -> datetime:
+    """Oldest heartbeat time kept in the cache. Kuma stores heartbeat.time as naive UTC."""
+    return datetime.now(timezone.utc).replace(tzinfo=None) - retention
+
+def segment_start(moment: datetime) -> int:
+    """Epoch second at which the segment containing moment starts. Naive datetimes are UTC."""
+    if moment.tzinfo is None:
+        moment = moment.replace(tzinfo=timezone.utc)
+    seconds = int(moment.timestamp())
+    return seconds - seconds % SEGMENT_SECONDS
+
+def segment_datetime(start: int) -> datetime:
+    """Naive UTC datetime at which a segment starts"""
+    return datetime.fromtimestamp(start, timezone.utc).replace(tzinfo=None)
+
+def open_segment_start() -> int:
+    """Start of the newest segment, the only one that is not sealed yet"""
+    return segment_start(datetime.now(timezone.utc) - timedelta(seconds=HEARTBEAT_SEGMENT_GRACE))
+
+def split_segments(df: pd.DataFrame, open_start: int) -> Tuple[Dict[int, pd.DataFrame], pd.DataFrame]:
+    """Split heartbeats into sealed segments by start and the rows of the open segment"""
+    if df.empty:
+        return {}, df
+    starts = (pd.to_datetime(df['time']) - pd.Timestamp(0)) // pd.Timedelta(seconds=SEGMENT_SECONDS) * SEGMENT_SECONDS
+    sealed = starts < open_start
+    segments = {int(start): rows for start, rows in df[sealed].groupby(starts[sealed])}
+    return segments, df[~sealed]
+
+def narrow_columns(table: pa.Table, types: Dict[str, pa.DataType]) -> pa.Table:
+    """Cast the columns of table named in types, dictionary encoding where asked to"""
+    for name, type_ in types.items():
+        index = table.schema.get_field_index(name)
+        if index < 0 or table.schema.field(index).type == type_:
+            continue
+        column = table.column(index)
+        if pa.types.is_dictionary(type_):
+            column = column.cast(type_.value_type).dictionary_encode()
+        else:
+            column = column.cast(type_)
+        table = table.set_column(index, name, column)
+    return table
+
+def compact_frame(df: pd.DataFrame, types: Dict[str, pa.DataType] = HEARTBEAT_TYPES) -> pd.DataFrame:
+    """
+    Narrow the columns of a DataFrame like narrow_columns() does for Arrow.
+
+    Needed after concatenating frames, which turns categoricals with
+    different categories back into object columns.
+    """
+    dtypes = {}
+    for name, type_ in types.items():
+        if name not in df.columns:
+            continue
+        if pa.types.is_dictionary(type_):
+            dtypes[name] = 'category'
+        elif not (pa.types.is_integer(type_) or pa.types.is_boolean(type_)) or not df[name].isna().any():
+            # Columns missing from some of the concatenated frames have NaNs and stay float
+            dtypes[name] = type_.to_pandas_dtype()
+    return df.astype(dtypes) if dtypes else df
+
+def read_chunks(cursor, chunk_size: int = HEARTBEAT_FETCH_CHUNK_ROWS,
+                types: Optional[Dict[str, pa.DataType]] = None) -> pd.DataFrame:
+    """
+    Build a DataFrame from the pending result of cursor, chunk_size rows at a time.
+
+    Each chunk becomes an Arrow record batch before the next one is fetched, so
+    with an unbuffered cursor only one chunk of row objects is ever alive. The
+    Arrow buffers are released column by column while converting to pandas.
+    Columns named in types are narrowed before the conversion.
+    """
+    tables = []
+    names = None
+    while True:
+        rows = cursor.fetchmany(chunk_size)
+        if not rows:
+            break
+        if isinstance(rows[0], dict):
+            batch = pa.RecordBatch.from_pylist(rows)
+        else:
+            names = names or [column[0] for column in cursor.description]
+            batch = pa.RecordBatch.from_arrays([pa.array(column) for column in zip(*rows)], names=names)
+        tables.append(pa.Table.from_batches([batch]))
+        del rows, batch
+    if not tables:
+        return pd.DataFrame()
+    # Chunks without a single non-NULL value in a column infer the null type
+    table = pa.concat_tables(tables, promote_options='permissive')
+    del tables
+    if types:
+        table = narrow_columns(table, types)
+    return table.to_pandas(self_destruct=True, split_blocks=True)
+
+def fetch_heartbeats(cursor, since: datetime) -> pd.DataFrame:
+    """Load every heartbeat newer than since, streamed in chunks"""
+    cursor.execute(HEARTBEAT_QUERY + " WHERE h.time >= %s", (since,))
+    return read_chunks(cursor, types=HEARTBEAT_TYPES)
+
+def fetch_new_heartbeats(cursor, watermark: int, since: datetime) -> pd.DataFrame:
+    """Load every heartbeat with an id above watermark and newer than since, in id order, streamed in chunks"""
+    cursor.execute(HEARTBEAT_QUERY + " WHERE h.id > %s AND h.time >= %s ORDER BY h.id", (watermark, since))
+    return read_chunks(cursor, types=HEARTBEAT_TYPES)
+
+def _json_default(value):
+    if value is pd.NaT:
+        return None
+    if isinstance(value, datetime):
+        return value.isoformat()
+    raise TypeError(f"Type is not JSON serializable: {type(value).__name__}")
+
+def encode_records(df: pd.DataFrame) -> bytes:
+    """Encode a DataFrame as the JSON array of records served by /heartbeats"""
+    return orjson.dumps(df.to_dict(orient='records'), default=_json_default,
+                        option=orjson.OPT_SERIALIZE_NUMPY)
+
+def _optional_float(value) -> Optional[float]:
+    return None if value is None or pd.isna(value) else float(value)
+
+def merge_bucket(a: list, b: list) -> list:
+    """Combine two [up, down, ping_count, ping_sum, ping_min, ping_max] buckets"""
+    lows = [value for value in (a[4], b[4]) if value is not None]
+    highs = [value for value in (a[5], b[5]) if value is not None]
+    return [a[0] + b[0], a[1] + b[1], a[2] + b[2], a[3] + b[3],
+            min(lows) if lows else None, max(highs) if highs else None]
+
+def aggregate_stats(df: pd.DataFrame, now: Optional[float] = None) -> Dict[int, Dict[str, list]]:
+    """
+    Aggregate heartbeats into '{resolution}:{start}' buckets per monitor.
+
+    Given now, buckets that have already left every window of their
+    resolution are skipped.
+    """
+    if df.empty:
+        return {}
+    seconds = (pd.to_datetime(df['time']) - pd.Timestamp(0)) // pd.Timedelta(seconds=1)
+    frame = pd.DataFrame({
+        'monitor_id': df['monitor_id'].astype(int),
+        'up': (df['status'] == STATUS_UP).astype(int),
+        'down': (df['status'] == STATUS_DOWN).astype(int),
+        'ping': pd.to_numeric(df['ping'], errors='coerce') if 'ping' in df.columns else float('nan')
+    })
+    stats: Dict[int, Dict[str, list]] = {}
+    for resolution, size in STATS_RESOLUTIONS.items():
+        frame['bucket'] = seconds - seconds % size
+        rows = frame if now is None else frame[frame['bucket'] + size > now - STATS_KEEP[resolution]]
+        grouped = rows.groupby(['monitor_id', 'bucket']).agg(
+            up=('up', 'sum'), down=('down', 'sum'), count=('ping', 'count'),
+            total=('ping', 'sum'), low=('ping', 'min'), high=('ping', 'max'))
+        for row in grouped.itertuples():
+            monitor_id, start = row.Index
+            stats.setdefault(int(monitor_id), {})[f"{resolution}:{int(start)}"] = [
+                int(row.up), int(row.down), int(row.count), float(row.total),
+                _optional_float(row.low), _optional_float(row.high)]
+    return stats
+
+def fetch_daily_stats(cursor, since: datetime, until: datetime) -> Dict[int, Dict[str, list]]:
+    """Aggregate the heartbeats between since and until into daily buckets in MariaDB"""
+    cursor.execute(DAILY_STATS_QUERY, (since, until))
+    stats: Dict[int, Dict[str, list]] = {}
+    for row in cursor.fetchall():
+        stats.setdefault(int(row['monitor_id']), {})[f"day:{int(row['bucket'])}"] = [
+            int(row['up'] or 0), int(row['down'] or 0), int(row['ping_count']), float(row['ping_sum'] or 0),
+            _optional_float(row['ping_min']), _optional_float(row['ping_max'])]
+    return stats
+
+def latest_status(rows: pd.DataFrame, stored: Optional[dict]) -> Optional[dict]:
+    """Fold one monitor's heartbeats into its last status and status change, skipping rows already seen"""
+    rows = rows.assign(time=pd.to_datetime(rows['time'])).sort_values('time', kind='stable')
+    if stored:
+        rows = rows[rows['time'] > pd.Timestamp(stored['time'])]
+    if rows.empty:
+        return None
+    statuses = rows['status'].astype(int)
+    previous = statuses.shift()
+    previous.iloc[0] = stored['status'] if stored else statuses.iloc[0]
+    changes = rows['time'][statuses != previous]
+    changed_at = changes.iloc[-1].isoformat() if not changes.empty else (stored or {}).get('changed_at')
+    return {'status': int(statuses.iloc[-1]), 'time': rows['time'].iloc[-1].isoformat(), 'changed_at': changed_at}
+
+def summarize_stats(fields: Dict[str, bytes], now: float) -> Dict[str, object]:
+    """Sum a monitor's buckets into its rolling windows"""
+    windows = {}
+    for name, (resolution, seconds) in STATS_WINDOWS.items():
+        size = STATS_RESOLUTIONS[resolution]
+        total = [0, 0, 0, 0.0, None, None]
+        for field, value in fields.items():
+            kind, _, start = field.partition(':')
+            if kind == resolution and int(start) + size > now - seconds:
+                total = merge_bucket(total, orjson.loads(value))
+        up, down, ping_count, ping_sum, ping_min, ping_max = total
+        windows[name] = {
+            'up': up,
+            'down': down,
+            'uptime': up / (up + down) if up + down else None,
+            'ping_min': ping_min,
+            'ping_avg': ping_sum / ping_count if ping_count else None,
+            'ping_max': ping_max
+        }
+    status = orjson.loads(fields['status']) if 'status' in fields else {}
+    return {
+        'windows': windows,
+        'status': status.get('status'),
+        'last_heartbeat': status.get('time'),
+        'last_status_change': status.get('changed_at')
+    }
+
+def _buffer_views(column: pa.ChunkedArray) -> List[memoryview]:
+    """Views of the values of a large_binary column, sharing the column's buffers"""
+    views = []
+    for chunk in column.chunks:
+        _, offsets, data = chunk.buffers()
+        offsets = memoryview(offsets).cast('q')[chunk.offset:chunk.offset + len(chunk) + 1]
+        data = memoryview(data) if data is not None else memoryview(b'')
+        views.extend(data[offsets[i]:offsets[i + 1]] for i in range(len(chunk)))
+    return views
+
+class SnapshotState:
+    """Contents of one mapped snapshot file"""
+
+    def __init__(self, generation: int, starts: List[int], table: pa.Table):
+        self.generation = generation
+        self.starts = starts
+        self.table = table
+        # kind -> start -> monitor_id -> payload, every payload a view into the mapping
+        self.segments: Dict[str, Dict[int, Dict[int, memoryview]]] = {'frame': {}, 'json': {}}
+        for kind, segments in self.segments.items():
+            # Segments without heartbeats still count as present
+            for start in starts:
+                segments[start] = {}
+            rows = zip(table['start'].to_pylist(), table['monitor_id'].to_pylist(), _buffer_views(table[kind]))
+            for start, monitor_id, payload in rows:
+                segments.setdefault(start, {})[monitor_id] = payload
+
+class HeartbeatSnapshot:
+    """
+    Sealed segments of one cache generation in a memory-mapped Arrow IPC file.
+
+    Each row holds one monitor's frame and JSON payloads of one segment,
+    byte for byte as stored in Redis. CacheSync publishes new files by atomic
+    rename. Every local process maps the current file and reads payloads
+    straight from the shared page cache. A reader keeps its mapping until it
+    sees a new file, so the pages never change under it.
+    """
+    SCHEMA = pa.schema([
+        ('start', pa.int64()),
+        ('monitor_id', pa.int64()),
+        ('frame', pa.large_binary()),
+        ('json', pa.large_binary())
+    ])
+
+    def __init__(self, path: str = HEARTBEAT_SNAPSHOT_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+        # (inode, mtime) of the mapped file
+        self._identity: Optional[Tuple[int, int]] = None
+        self._state: Optional[SnapshotState] = None
+
+    def load(self) -> Optional[SnapshotState]:
+        """Map the current file, reusing the existing mapping while it has not been replaced"""
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        identity = (stat.st_ino, stat.st_mtime_ns)
+        with self._lock:
+            if identity != self._identity:
+                try:
+                    table = pa.ipc.open_file(pa.memory_map(self.path, 'r')).read_all()
+                    metadata = table.schema.metadata
+                    state = SnapshotState(int(metadata[b'generation']), orjson.loads(metadata[b'starts']), table)
+                except (OSError, pa.ArrowInvalid, KeyError, ValueError) as e:
+                    print(f"Ignoring unreadable heartbeat snapshot {self.path}: {e}")
+                    return None
+                self._identity, self._state = identity, state
+            return self._state
+
+    def get_segments(self, kind: str, generation: int, starts: Iterable[int]) -> Dict[int, Dict[int, memoryview]]:
+        """Get the payloads of the requested segments found in the snapshot of generation"""
+        state = self.load()
+        if state is None or state.generation != generation:
+            return {}
+        segments = state.segments[kind]
+        return {start: segments[start] for start in starts if start in segments}
+
+    def publish(self, generation: int, starts: List[int],
+                rows: Iterable[Tuple[int, int, bytes, bytes]]) -> None:
+        """Atomically replace the snapshot with (start, monitor_id, frame, json) rows"""
+        rows = sorted(rows, key=lambda row: (row[0], row[1]))
+        columns = [[row[0] for row in rows], [row[1] for row in rows],
+                   [bytes(row[2]) for row in rows], [bytes(row[3]) for row in rows]]
+        table = pa.Table.from_arrays(
+            [pa.array(values, type=field.type) for values, field in zip(columns, self.SCHEMA)],
+            schema=self.SCHEMA.with_metadata({'generation': str(generation), 'starts': orjson.dumps(sorted(starts))})
         )
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        # Unique per writer, and renamed over the old file so mappings of it stay valid
+        tmp_path = f"{self.path}.tmp-{os.getpid()}"
+        with pa.OSFile(tmp_path, 'wb') as sink:
+            with pa.ipc.new_file(sink, table.schema) as writer:
+                writer.write_table(table)
+        os.replace(tmp_path, self.path)
+
+class HeartbeatCache:
+    """
+    Heartbeat cache in Redis, with an optional in-process L1.
+
+    Redis access is written as plans: generators that yield zero-argument
+    steps (a command, pipe.execute, a sleep) and receive their results.
+    _run() performs the steps synchronously; AsyncHeartbeatCache runs the
+    same plans on redis.asyncio.
+    """
+
+    def __init__(self, serialization: Optional[str] = None, l1: bool = False,
+                 compression: Optional[str] = None, snapshot: Optional[HeartbeatSnapshot] = None):
+        self.redis_client = self._create_client()
+        # Local source of sealed segments, consulted before L1 and Redis
+        self.snapshot = snapshot
+        # Pub/sub listens on a thread, which needs a synchronous client
+        self._sync_client = self._create_sync_client()
         self.CACHE_KEY = 'heartbeat_data'
+        self.CURRENT_KEY = 'heartbeat_data:current'  # generation served to readers
+        self.GENERATION_KEY = 'heartbeat_data:generation'  # last generation handed out
         self.LAST_UPDATE_KEY = 'heartbeat_last_update'
-        self.CACHE_TTL = 300  # 5 minutes
+        self.LEASE_KEY = 'heartbeat_data:refresh_lease'
+        self.VERSION_KEY = 'heartbeat_data:version'
+        self.INVALIDATION_CHANNEL = 'heartbeat_data:invalidate'
+        self.METRICS_KEY = 'heartbeat_data:metrics'
+        # Binlog position the cache is up to date with, kept next to the cache so both go together
+        self.BINLOG_POSITION_KEY = 'heartbeat_data:binlog_position'
+        self.STATS_KEY = 'heartbeat_stats'
+        self.STATS_INDEX_KEY = 'heartbeat_stats:monitors'
+        # Binlog position the aggregates include changes up to, written together with them
+        self.STATS_POSITION_KEY = 'heartbeat_stats:binlog_position'
+        self.CACHE_TTL = 300  # 5 minutes, for the open segment
+        self.retention = timedelta(seconds=HEARTBEAT_CACHE_RETENTION)
+        self._release_lease = self.redis_client.register_script(RELEASE_LEASE_SCRIPT)
+        # Renewed from a thread, so a busy event loop cannot let the lease lapse
+        self._renew_lease = self._sync_client.register_script(RENEW_LEASE_SCRIPT)
+        self.serialization = serialization or HEARTBEAT_CACHE_SERIALIZATION
+        if self.serialization not in ('arrow', 'pickle'):
+            raise ValueError(f"Unknown heartbeat cache serialization: {self.serialization}")
+        self.compression = compression or HEARTBEAT_CACHE_COMPRESSION
+        if self.compression != 'none' and self.compression not in CODEC_HEADERS:
+            raise ValueError(f"Unknown heartbeat cache compression: {self.compression}")
+        self.compression_min_bytes = HEARTBEAT_CACHE_COMPRESSION_MIN_BYTES
 
-    def get_data(self) -> Optional[pd.DataFrame]:
-        """Get heartbeat data from cache or database"""
-        cached_data = self.redis_client.get(self.CACHE_KEY)
-        if cached_data:
-            return pickle.loads(cached_data)
-        return None
+        # L1: (kind, monitor_id) -> (expires_at, frame or JSON fragment) for the open
+        # segment and ('sealed_' + kind, start) -> (inf, {monitor_id: value}) for sealed
+        # segments, valid for cache version _l1_version and generation _l1_generation
+        self.l1_enabled = False
+        self._l1: Dict[Tuple[str, int], Tuple[float, object]] = {}
+        self._l1_index: Optional[Set[int]] = None
+        self._l1_segments: Optional[List[int]] = None
+        self._l1_generation: Optional[int] = None
+        self._l1_version = 0
+        self._l1_lock = threading.Lock()
+        self._pubsub = None
+        self._pubsub_thread = None
+        if l1:
+            self.enable_l1()
 
-    def set_data(self, df: pd.DataFrame) -> None:
-        """Cache heartbeat data"""
-        self.redis_client.setex(
-            self.CACHE_KEY,
-            self.CACHE_TTL,
-            pickle.dumps(df)
+    def _create_client(self):
+        return redis.Redis(connection_pool=get_redis_pool())
+
+    def _create_sync_client(self):
+        return self.redis_client
+
+    _sleep = staticmethod(time.sleep)
+
+    def _blocking(self, func: Callable) -> Callable:
+        """Wrap a blocking call as a plan step"""
+        return func
+
+    def _cmd(self, command: str, *args, **kwargs) -> Callable:
+        """Plan step running one Redis command"""
+        return partial(getattr(self.redis_client, command), *args, **kwargs)
+
+    def _run(self, plan):
+        """Run a plan synchronously and return its result"""
+        send, value = plan.send, None
+        while True:
+            try:
+                step = send(value)
+            except StopIteration as stop:
+                return stop.value
+            try:
+                send, value = plan.send, step()
+            except Exception as error:
+                send, value = plan.throw, error
+
+    def enable_l1(self) -> None:
+        """Keep an in-process copy of the shards, dropped on pub/sub invalidations"""
+        # Subscribe before reading the version so no invalidation can slip in between
+        self._pubsub = self._sync_client.pubsub(ignore_subscribe_messages=True)
+        self._pubsub.subscribe(**{self.INVALIDATION_CHANNEL: self._handle_invalidation_message})
+        self._pubsub_thread = self._pubsub.run_in_thread(
+            sleep_time=1,
+            daemon=True,
+            exception_handler=self._handle_pubsub_error
         )
-        self.redis_client.set(
-            self.LAST_UPDATE_KEY,
-            datetime.now().timestamp()
+        version = self._sync_client.get(self.VERSION_KEY)
+        self._l1_version = int(version) if version else 0
+        self.l1_enabled = True
+
+    def disable_l1(self) -> None:
+        """Stop listening for invalidations and drop the in-process copy"""
+        self.l1_enabled = False
+        if self._pubsub_thread:
+            self._pubsub_thread.stop()
+            self._pubsub_thread = None
+        if self._pubsub:
+            self._pubsub.close()
+            self._pubsub = None
+        self._clear_l1()
+
+    def get_cache_version(self) -> int:
+        """Get the cache version, bumped by every write and invalidation"""
+        return self._run(self._plan_get_cache_version())
+
+    def _plan_get_cache_version(self):
+        version = yield self._cmd('get', self.VERSION_KEY)
+        return int(version) if version else 0
+
+    def _clear_l1(self) -> None:
+        with self._l1_lock:
+            self._l1.clear()
+            self._l1_index = None
+            self._l1_segments = None
+            self._l1_generation = None
+
+    def _handle_invalidation_message(self, message) -> None:
+        version, _, target = message['data'].decode().partition(':')
+        scope = target if target in ('*', 'seal') else 'monitor'
+        REGISTRY.counter('heartbeat_cache_l1_invalidations_total', {'scope': scope}).inc()
+        if target == 'seal':
+            self._apply_seal(int(version))
+        else:
+            self._apply_invalidation(int(version), None if target == '*' else [int(m) for m in target.split(',')])
+
+    def _handle_pubsub_error(self, error, pubsub, thread) -> None:
+        # Invalidations may have been lost while disconnected
+        print(f"Heartbeat cache invalidation channel error, clearing L1: {error}")
+        self._clear_l1()
+        time.sleep(1)
+
+    def _apply_invalidation(self, version: int, monitor_ids: Optional[Iterable[int]]) -> None:
+        with self._l1_lock:
+            self._l1_version = max(self._l1_version, version)
+            if monitor_ids is None:
+                self._l1.clear()
+                self._l1_index = None
+                self._l1_segments = None
+                self._l1_generation = None
+                return
+            for monitor_id in monitor_ids:
+                self._l1.pop(('frame', monitor_id), None)
+                self._l1.pop(('json', monitor_id), None)
+                if self._l1_index is not None and monitor_id not in self._l1_index:
+                    # The monitor may have just been added to the index
+                    self._l1_index = None
+
+    def _apply_seal(self, version: int) -> None:
+        with self._l1_lock:
+            self._l1_version = max(self._l1_version, version)
+            # Rows moved out of the open segment, but sealed segments never change
+            for key in [key for key in self._l1 if key[0] in ('frame', 'json')]:
+                del self._l1[key]
+            self._l1_index = None
+            self._l1_segments = None
+
+    def _bulk_pipeline(self):
+        """Transaction for large writes, which AsyncHeartbeatCache executes off the event loop"""
+        return self._sync_client.pipeline()
+
+    def _plan_execute_invalidating(self, pipe, monitor_ids: Optional[List[int]] = None, bulk: bool = False):
+        """Execute pipe with a version bump and invalidation message as its last command"""
+        return (yield from self._plan_execute_publishing(
+            pipe, '*' if monitor_ids is None else ','.join(str(monitor_id) for monitor_id in monitor_ids),
+            lambda version: self._apply_invalidation(version, monitor_ids), bulk
+        ))
+
+    def _plan_execute_sealing(self, pipe):
+        """Like _plan_execute_invalidating for a bulk pipe, but lets L1 keep the sealed segments"""
+        return (yield from self._plan_execute_publishing(pipe, 'seal', self._apply_seal, True))
+
+    def _plan_execute_publishing(self, pipe, target: str, apply: Callable[[int], None], bulk: bool = False):
+        pipe.eval(PUBLISH_INVALIDATION_SCRIPT, 1, self.VERSION_KEY, self.INVALIDATION_CHANNEL, target)
+        results = yield (self._blocking(pipe.execute) if bulk else pipe.execute)
+        if self.l1_enabled:
+            apply(int(results[-1]))
+        return results
+
+    def _get_l1(self, kind: str, monitor_ids: Optional[Iterable[int]]):
+        """
+        Get the open segment's L1 entries of one kind in monitor id order.
+
+        Returns (monitor ids, values, sealed segment starts, generation), or
+        None on a miss.
+        """
+        now = time.monotonic()
+        with self._l1_lock:
+            if self._l1_index is None or self._l1_segments is None:
+                return None
+            ids = sorted(self._l1_index if monitor_ids is None else self._l1_index & {int(m) for m in monitor_ids})
+            values = []
+            for monitor_id in ids:
+                entry = self._l1.get((kind, monitor_id))
+                if entry is None or entry[0] <= now:
+                    return None
+                values.append(entry[1])
+            return ids, values, self._l1_segments, self._l1_generation
+
+    def _store_l1(self, version: int, generation: int, index: Set[int], kind: str,
+                  shards: Dict[int, object], full: bool, starts: List[int]) -> None:
+        expires_at = time.monotonic() + self.CACHE_TTL
+        with self._l1_lock:
+            # Skip the store if an invalidation arrived while reading from Redis
+            if version != self._l1_version:
+                return
+            if generation != self._l1_generation:
+                # The swap's invalidation has not arrived yet; never mix generations
+                self._l1.clear()
+                self._l1_index = None
+                self._l1_generation = generation
+            if full:
+                self._l1_index = set(index)
+            for monitor_id, value in shards.items():
+                self._l1[(kind, monitor_id)] = (expires_at, value)
+            self._l1_segments = list(starts)
+            # Forget sealed segments that have left the retention window
+            for key in [key for key in self._l1 if key[0].startswith('sealed_') and key[1] not in starts]:
+                del self._l1[key]
+
+    def _get_l1_sealed(self, kind: str, start: int) -> Optional[Dict[int, object]]:
+        entry = self._l1.get(('sealed_' + kind, start))
+        return entry[1] if entry else None
+
+    def _store_l1_sealed(self, version: int, generation: int, kind: str, start: int,
+                         values: Dict[int, object]) -> None:
+        with self._l1_lock:
+            if version == self._l1_version and generation == self._l1_generation:
+                self._l1[('sealed_' + kind, start)] = (float('inf'), values)
+
+    def serialize(self, df: pd.DataFrame) -> bytes:
+        """Encode a DataFrame in the configured serialization format"""
+        # A shard of a larger frame would otherwise carry every category of the frame
+        categorical = [column for column in df.columns if isinstance(df[column].dtype, pd.CategoricalDtype)]
+        if categorical:
+            df = df.assign(**{column: df[column].cat.remove_unused_categories() for column in categorical})
+        if self.serialization == 'pickle':
+            return self.compress(pickle.dumps(df))
+        table = pa.Table.from_pandas(df, preserve_index=False)
+        sink = pa.BufferOutputStream()
+        with pa.ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table)
+        return self.compress(sink.getvalue().to_pybytes())
+
+    def compress(self, payload: bytes) -> bytes:
+        """Compress a payload with the configured codec if it is large enough"""
+        if self.compression == 'none' or len(payload) < self.compression_min_bytes:
+            return payload
+        labels = {'codec': self.compression}
+        start = time.perf_counter()
+        if self.compression == 'zstd':
+            body = zstandard.ZstdCompressor().compress(payload)
+        else:
+            body = lz4.frame.compress(payload)
+        REGISTRY.histogram('heartbeat_cache_compress_seconds', labels).observe(time.perf_counter() - start)
+        REGISTRY.histogram('heartbeat_cache_compression_ratio', labels,
+                           buckets=COMPRESSION_RATIO_BUCKETS).observe(len(payload) / max(len(body), 1))
+        return CODEC_HEADERS[self.compression] + body
+
+    def decompress(self, payload: bytes) -> bytes:
+        """Undo compress(), passing uncompressed payloads through unchanged"""
+        header = payload[:1]
+        if header == CODEC_HEADERS['zstd']:
+            codec = 'zstd'
+        elif header == CODEC_HEADERS['lz4']:
+            codec = 'lz4'
+        else:
+            return payload
+        start = time.perf_counter()
+        body = memoryview(payload)[1:]
+        if codec == 'zstd':
+            payload = zstandard.ZstdDecompressor().decompress(body)
+        else:
+            payload = lz4.frame.decompress(body)
+        REGISTRY.histogram('heartbeat_cache_decompress_seconds', {'codec': codec}).observe(time.perf_counter() - start)
+        return payload
+
+    def deserialize_table(self, payload: bytes, columns: Optional[List[str]] = None) -> Optional[pa.Table]:
+        """Map an Arrow IPC payload without copying, keeping only the requested columns"""
+        return self._open_table(self.decompress(payload), columns)
+
+    def _open_table(self, payload: bytes, columns: Optional[List[str]]) -> Optional[pa.Table]:
+        # Slicing also works for memoryviews of mapped snapshot payloads
+        if payload[:len(ARROW_MAGIC)] != ARROW_MAGIC:
+            return None
+        table = pa.ipc.open_file(pa.py_buffer(payload)).read_all()
+        if columns is not None:
+            table = table.select([column for column in columns if column in table.column_names])
+        return table
+
+    def deserialize(self, payload: bytes, columns: Optional[List[str]] = None) -> Optional[pd.DataFrame]:
+        """Decode a cached payload, returning None for payloads this mode may not read"""
+        payload = self.decompress(payload)
+        table = self._open_table(payload, columns)
+        if table is not None:
+            return table.to_pandas()
+        if self.serialization != 'pickle':
+            return None
+        df = pickle.loads(payload)
+        return df[[column for column in columns if column in df.columns]] if columns is not None else df
+
+    def generation_key(self, generation: int) -> str:
+        """Prefix of every key written by one full write of the cache"""
+        return f"{self.CACHE_KEY}:v{generation}"
+
+    def index_key(self, generation: int) -> str:
+        """Redis set holding the ids of the monitors cached in a generation"""
+        return f"{self.generation_key(generation)}:monitors"
+
+    def segments_key(self, generation: int) -> str:
+        """Redis sorted set holding the starts of a generation's sealed segments"""
+        return f"{self.generation_key(generation)}:segments"
+
+    def open_segment_key(self, generation: int) -> str:
+        """Redis key holding the start of a generation's open segment"""
+        return f"{self.generation_key(generation)}:open_segment"
+
+    def shard_key(self, monitor_id: int, generation: int) -> str:
+        """Redis key holding the heartbeats of one monitor in the open segment"""
+        return f"{self.generation_key(generation)}:monitor:{monitor_id}"
+
+    def json_key(self, monitor_id: int, generation: int) -> str:
+        """Redis key holding one monitor's open segment as a pre-encoded JSON fragment"""
+        return f"{self.generation_key(generation)}:json:monitor:{monitor_id}"
+
+    def segment_key(self, start: int, generation: int) -> str:
+        """Redis hash holding a sealed segment, one shard per monitor"""
+        return f"{self.generation_key(generation)}:segment:{start}"
+
+    def segment_json_key(self, start: int, generation: int) -> str:
+        """Redis hash holding a sealed segment, one JSON fragment per monitor"""
+        return f"{self.generation_key(generation)}:json:segment:{start}"
+
+    def stats_key(self, monitor_id: int) -> str:
+        """Redis hash holding one monitor's aggregate buckets and last status"""
+        return f"{self.STATS_KEY}:monitor:{monitor_id}"
+
+    def _keys(self, kind: str) -> Tuple[Callable[[int], str], Callable[[int], str]]:
+        if kind == 'frame':
+            return self.shard_key, self.segment_key
+        return self.json_key, self.segment_json_key
+
+    def encode_json_fragment(self, df: pd.DataFrame) -> bytes:
+        """Encode records without the enclosing brackets so shards can be joined"""
+        return self.compress(encode_records(df)[1:-1])
+
+    def get_generation(self) -> Optional[int]:
+        """Get the generation readers are served from, or None if nothing was ever cached"""
+        return self._run(self._plan_get_generation())
+
+    def _plan_get_generation(self):
+        generation = yield self._cmd('get', self.CURRENT_KEY)
+        return int(generation) if generation else None
+
+    def get_cached_monitor_ids(self) -> Set[int]:
+        """Get the ids of all monitors with a cached shard"""
+        return self._run(self._plan_get_cached_monitor_ids())
+
+    def _plan_get_cached_monitor_ids(self, generation: Optional[int] = None):
+        if generation is None:
+            generation = yield from self._plan_get_generation()
+            if generation is None:
+                return set()
+        monitor_ids = yield self._cmd('smembers', self.index_key(generation))
+        return {int(monitor_id) for monitor_id in monitor_ids}
+
+    def get_sealed_segments(self, generation: Optional[int] = None) -> List[int]:
+        """Get the starts of all sealed segments of generation, by default the current one, oldest first"""
+        return self._run(self._plan_get_sealed_segments(generation))
+
+    def _plan_get_sealed_segments(self, generation: Optional[int] = None):
+        if generation is None:
+            generation = yield from self._plan_get_generation()
+            if generation is None:
+                return []
+        starts = yield self._cmd('zrange', self.segments_key(generation), 0, -1)
+        return sorted(int(start) for start in starts)
+
+    def get_open_segment(self) -> Optional[int]:
+        """Get the start of the open segment as of the last write"""
+        return self._run(self._plan_get_open_segment())
+
+    def _plan_get_open_segment(self):
+        generation = yield from self._plan_get_generation()
+        if generation is None:
+            return None
+        start = yield self._cmd('get', self.open_segment_key(generation))
+        return int(start) if start else None
+
+    def _plan_read_shards(self, key: Callable[[int, int], str], monitor_ids: Optional[Iterable[int]],
+                          generation: int):
+        """
+        Read the requested shards of a generation from Redis.
+
+        Returns (index, ids, payloads), or None if nothing is cached or a
+        shard that should exist is missing.
+        """
+        index = yield from self._plan_get_cached_monitor_ids(generation)
+        if not index:
+            return None
+        cached_ids = index
+        if monitor_ids is not None:
+            cached_ids = index & {int(monitor_id) for monitor_id in monitor_ids}
+        ids = sorted(cached_ids)
+        payloads = (yield self._cmd('mget', [key(monitor_id, generation) for monitor_id in ids])) if ids else []
+        if any(payload is None for payload in payloads):
+            return None
+        return index, ids, payloads
+
+    def _plan_read_open(self, kind: str, monitor_ids: Optional[Iterable[int]], decode: Callable):
+        """
+        Read the current generation's open segment shards of one kind from Redis.
+
+        Returns (generation, index, ids, values, sealed segment starts), or
+        None on a miss. A generation replaced mid-read stays readable for
+        HEARTBEAT_GENERATION_GRACE seconds, so the read still completes.
+        """
+        generation = yield from self._plan_get_generation()
+        if generation is None:
+            return None
+        for _ in range(3):
+            starts = yield from self._plan_get_sealed_segments(generation)
+            shards = yield from self._plan_read_shards(self._keys(kind)[0], monitor_ids, generation)
+            if shards is None:
+                return None
+            # Sealing in between would have moved rows out of the shards just read
+            if (yield from self._plan_get_sealed_segments(generation)) != starts:
+                continue
+            index, ids, payloads = shards
+            values = yield self._blocking(lambda: [decode(payload) for payload in payloads])
+            if any(value is None for value in values):
+                return None
+            return generation, index, ids, values, starts
+        return None
+
+    def _plan_read_sealed(self, kind: str, monitor_ids: List[int], starts: List[int],
+                          decode: Callable, l1_version: int, generation: int):
+        """Read sealed segments as {monitor_id: value}, or None if one has gone missing"""
+        segments = {}
+        if self.snapshot is not None:
+            # Decoded on every read: keeping them in L1 would copy the shared pages
+            mapped = self.snapshot.get_segments(kind, generation, starts)
+            for start, payloads in mapped.items():
+                ids = [monitor_id for monitor_id in monitor_ids if monitor_id in payloads]
+                values = {monitor_id: decode(payloads[monitor_id]) for monitor_id in ids}
+                if any(value is None for value in values.values()):
+                    return None
+                segments[start] = values
+            if mapped:
+                REGISTRY.counter('heartbeat_snapshot_segment_reads_total', {'kind': kind}).inc(len(mapped))
+        if self.l1_enabled:
+            for start in starts:
+                cached = self._get_l1_sealed(kind, start) if start not in segments else None
+                if cached is not None:
+                    segments[start] = cached
+        missing = [start for start in starts if start not in segments]
+        if missing:
+            segment_key = self._keys(kind)[1]
+            pipe = self.redis_client.pipeline(transaction=False)
+            for start in missing:
+                if self.l1_enabled:
+                    # Sealed segments never change, so L1 keeps them whole
+                    pipe.hgetall(segment_key(start, generation))
+                else:
+                    pipe.hmget(segment_key(start, generation), SEGMENT_SENTINEL, *monitor_ids)
+            results = yield pipe.execute
+            for start, result in zip(missing, results):
+                if self.l1_enabled:
+                    if SEGMENT_SENTINEL not in result:
+                        return None
+                    payloads = {int(field): payload for field, payload in result.items() if field != SEGMENT_SENTINEL}
+                else:
+                    if result[0] is None:
+                        return None
+                    payloads = {m: payload for m, payload in zip(monitor_ids, result[1:]) if payload is not None}
+                values = {monitor_id: decode(payload) for monitor_id, payload in payloads.items()}
+                if any(value is None for value in values.values()):
+                    return None
+                segments[start] = values
+                if self.l1_enabled:
+                    self._store_l1_sealed(l1_version, generation, kind, start, values)
+        return [segments[start] for start in starts]
+
+    def get_segment_payloads(self, generation: int, starts: List[int]) -> Optional[List[Tuple[int, int, bytes, bytes]]]:
+        """
+        Get the raw (start, monitor_id, frame, json) payloads of sealed segments.
+
+        Returns None if a segment has gone missing, e.g. because the
+        generation was replaced.
+        """
+        return self._run(self._plan_get_segment_payloads(generation, starts))
+
+    def _plan_get_segment_payloads(self, generation: int, starts: List[int]):
+        if not starts:
+            return []
+        read = self.redis_client.pipeline(transaction=False)
+        for start in starts:
+            read.hgetall(self.segment_key(start, generation))
+            read.hgetall(self.segment_json_key(start, generation))
+        results = yield read.execute
+        rows = []
+        for i, start in enumerate(starts):
+            shards, fragments = results[2 * i], results[2 * i + 1]
+            if SEGMENT_SENTINEL not in shards or SEGMENT_SENTINEL not in fragments:
+                return None
+            for field, shard in shards.items():
+                if field != SEGMENT_SENTINEL:
+                    rows.append((start, int(field), shard, fragments.get(field, b'')))
+        return rows
+
+    def _plan_read_entries(self, kind: str, monitor_ids: Optional[Iterable[int]],
+                           since: Optional[datetime], decode: Callable):
+        """
+        Read the open segment and the sealed segments from since's segment on.
+
+        Returns one value per monitor and segment, ordered by monitor and then
+        time, or None on a miss.
+        """
+        l1_version = self._l1_version
+        cached = self._get_l1(kind, monitor_ids) if self.l1_enabled else None
+        if cached is not None:
+            REGISTRY.counter('heartbeat_cache_l1_hits_total', {'kind': kind}).inc()
+            ids, open_values, starts, generation = cached
+        else:
+            read = yield from self._plan_read_open(kind, monitor_ids, decode)
+            if read is None:
+                return None
+            generation, index, ids, open_values, starts = read
+            if self.l1_enabled:
+                self._store_l1(l1_version, generation, index, kind, dict(zip(ids, open_values)),
+                               full=monitor_ids is None, starts=starts)
+
+        if since is not None:
+            first = segment_start(since)
+            starts = [start for start in starts if start >= first]
+        sealed = []
+        if ids and starts:
+            sealed = yield from self._plan_read_sealed(kind, ids, starts, decode, l1_version, generation)
+            if sealed is None:
+                return None
+
+        values = []
+        for monitor_id, open_value in zip(ids, open_values):
+            values.extend(segment[monitor_id] for segment in sealed if monitor_id in segment)
+            values.append(open_value)
+        return values
+
+    def _concat(self, frames: List[pd.DataFrame], columns: Optional[List[str]]) -> pd.DataFrame:
+        if not frames:
+            return pd.DataFrame(columns=columns or [])
+        df = pd.concat([frame for frame in frames if not frame.empty] or frames[:1], ignore_index=True)
+        if self.l1_enabled and columns is not None:
+            df = df[[column for column in columns if column in df.columns]]
+        return df
+
+    def get_data(self, monitor_ids: Optional[Iterable[int]] = None,
+                 columns: Optional[List[str]] = None,
+                 since: Optional[datetime] = None) -> Optional[pd.DataFrame]:
+        """
+        Get cached heartbeat data, optionally only for some monitors.
+
+        Args:
+            since: Skip sealed segments that end before this time. The open
+                segment is always returned whole.
+
+        Returns None on a miss, i.e. when nothing is cached or when a shard
+        or segment that should exist has expired or been invalidated.
+        """
+        return self._run(self._plan_get_data(monitor_ids, columns, since))
+
+    def _plan_get_data(self, monitor_ids, columns, since):
+        # L1 keeps whole shards so later reads can project other columns
+        frames = yield from self._plan_read_entries(
+            'frame', monitor_ids, since,
+            lambda payload: self.deserialize(payload, None if self.l1_enabled else columns)
         )
+        self._count_lookup('frame', frames is not None)
+        return self._concat(frames, columns) if frames is not None else None
+
+    def get_open_segment_data(self, monitor_ids: Optional[Iterable[int]] = None) -> Optional[pd.DataFrame]:
+        """Get the cached heartbeats of the open segment only"""
+        return self._run(self._plan_get_open_segment_data(monitor_ids))
+
+    def _plan_get_open_segment_data(self, monitor_ids):
+        read = yield from self._plan_read_open('frame', monitor_ids, self.deserialize)
+        return self._concat(read[3], None) if read is not None else None
+
+    def get_json(self, monitor_ids: Optional[Iterable[int]] = None,
+                 since: Optional[datetime] = None) -> Optional[bytes]:
+        """
+        Get cached heartbeat data as a ready-to-send JSON array of records.
+
+        Misses exactly when get_data() would, since fragments are written and
+        invalidated together with the shards.
+        """
+        return self._run(self._plan_get_json(monitor_ids, since))
+
+    def _plan_get_json(self, monitor_ids, since):
+        fragments = yield from self._plan_read_entries('json', monitor_ids, since, self.decompress)
+        self._count_lookup('json', fragments is not None)
+        if fragments is None:
+            return None
+        return b'[' + b','.join(fragment for fragment in fragments if fragment) + b']'
+
+    def _count_lookup(self, kind: str, hit: bool) -> None:
+        REGISTRY.counter('heartbeat_cache_hits_total' if hit else 'heartbeat_cache_misses_total', {'kind': kind}).inc()
+
+    def _observe_payload(self, kind: str, segment: str, payload: bytes) -> bytes:
+        REGISTRY.histogram('heartbeat_cache_payload_bytes', {'kind': kind, 'segment': segment},
+                           buckets=PAYLOAD_SIZE_BUCKETS).observe(len(payload))
+        return payload
+
+    def _write_open(self, pipe, generation: int, monitor_id: int, df: pd.DataFrame) -> None:
+        shard = self._observe_payload('frame', 'open', self.serialize(df))
+        fragment = self._observe_payload('json', 'open', self.encode_json_fragment(df))
+        pipe.setex(self.shard_key(monitor_id, generation), self.CACHE_TTL, shard)
+        pipe.setex(self.json_key(monitor_id, generation), self.CACHE_TTL, fragment)
+
+    def _write_segments(self, pipe, generation: int, segments: Dict[int, pd.DataFrame]) -> None:
+        """Queue sealed segments on pipe, each expiring after it has left the retention window"""
+        now = int(datetime.now(timezone.utc).timestamp())
+        retention = int(self.retention.total_seconds())
+        for start, df in segments.items():
+            # Outlive the trim below by a segment so listed segments never go missing
+            ttl = start + 2 * SEGMENT_SECONDS + retention - now
+            if ttl <= 0:
+                continue
+            shards = {SEGMENT_SENTINEL: b''}
+            fragments = {SEGMENT_SENTINEL: b''}
+            for monitor_id, shard in df.groupby('monitor_id', sort=False):
+                shards[int(monitor_id)] = self._observe_payload('frame', 'sealed', self.serialize(shard))
+                fragments[int(monitor_id)] = self._observe_payload('json', 'sealed', self.encode_json_fragment(shard))
+            for key, mapping in ((self.segment_key(start, generation), shards),
+                                 (self.segment_json_key(start, generation), fragments)):
+                pipe.delete(key)
+                pipe.hset(key, mapping=mapping)
+                pipe.expire(key, ttl)
+            pipe.zadd(self.segments_key(generation), {start: start})
+        oldest = segment_start(retention_cutoff(self.retention)) - SEGMENT_SECONDS
+        pipe.zremrangebyscore(self.segments_key(generation), '-inf', f"({oldest}")
+
+    def set_data(self, df: pd.DataFrame) -> None:
+        """
+        Cache heartbeat data, replacing the open segment and all sealed segments.
+
+        The data is written as a new generation and the pointer switched to
+        it in the same transaction, so readers see either the previous
+        generation or the new one, never a miss. The previous generation
+        expires HEARTBEAT_GENERATION_GRACE seconds later.
+        """
+        return self._run(self._plan_set_data(df))
+
+    def _plan_set_data(self, df: pd.DataFrame):
+        previous = yield from self._plan_get_generation()
+        read = self.redis_client.pipeline(transaction=False)
+        read.incr(self.GENERATION_KEY)
+        if previous is not None:
+            read.smembers(self.index_key(previous))
+            read.zrange(self.segments_key(previous), 0, -1)
+        generation, *cached = yield read.execute
+        generation = int(generation)
+
+        # One transaction, so readers never see a half-written cache. Encoding and
+        # sending a full load is CPU-bound, so neither happens on the event loop.
+        pipe = self._bulk_pipeline()
+        yield self._blocking(partial(self._queue_full_write, pipe, generation, df))
+        pipe.set(self.CURRENT_KEY, generation)
+        if previous is not None:
+            self._queue_retire(pipe, previous, *cached)
+        yield from self._plan_execute_invalidating(pipe, bulk=True)
+
+    def _queue_full_write(self, pipe, generation: int, df: pd.DataFrame) -> None:
+        """Queue the keys of a new generation holding df on pipe"""
+        open_start = open_segment_start()
+        segments, open_rows = split_segments(df, open_start)
+        open_shards = {int(monitor_id): shard for monitor_id, shard in open_rows.groupby('monitor_id', sort=False)} \
+            if not open_rows.empty else {}
+        monitor_ids = sorted(int(monitor_id) for monitor_id in df['monitor_id'].unique()) if not df.empty else []
+
+        for monitor_id in monitor_ids:
+            # Monitors with only sealed rows still get an empty shard, which marks them as cached
+            self._write_open(pipe, generation, monitor_id, open_shards.get(monitor_id, open_rows.iloc[0:0]))
+        if monitor_ids:
+            pipe.sadd(self.index_key(generation), *monitor_ids)
+            pipe.expire(self.index_key(generation), self.CACHE_TTL)
+        self._write_segments(pipe, generation, segments)
+        pipe.mset({self.open_segment_key(generation): open_start, self.LAST_UPDATE_KEY: datetime.now().timestamp()})
+
+    def _queue_retire(self, pipe, generation: int, cached_ids: Set[bytes], cached_starts: List[bytes]) -> None:
+        """Queue the expiry of a replaced generation, giving reads already under way time to finish"""
+        keys = [key(int(monitor_id), generation) for monitor_id in cached_ids for key in (self.shard_key, self.json_key)]
+        keys += [key(int(start), generation) for start in cached_starts
+                 for key in (self.segment_key, self.segment_json_key)]
+        keys += [self.index_key(generation), self.segments_key(generation), self.open_segment_key(generation)]
+        for key in keys:
+            pipe.expire(key, HEARTBEAT_GENERATION_GRACE)
+
+    def set_monitor_data(self, monitor_id: int, df: pd.DataFrame) -> None:
+        """Cache the open segment heartbeats of a single monitor in the current generation"""
+        return self._run(self._plan_set_monitor_data(monitor_id, df))
+
+    def _plan_set_monitor_data(self, monitor_id: int, df: pd.DataFrame):
+        generation = yield from self._plan_get_generation()
+        if generation is None:
+            # Nothing to add to; the next full write caches this monitor too
+            return
+        index = yield from self._plan_get_cached_monitor_ids(generation)
+        pipe = self.redis_client.pipeline()
+        yield self._blocking(partial(self._write_open, pipe, generation, monitor_id, df))
+        pipe.sadd(self.index_key(generation), int(monitor_id))
+        self._queue_keep_open(pipe, generation, index | {int(monitor_id)})
+        pipe.set(self.LAST_UPDATE_KEY, datetime.now().timestamp())
+        yield from self._plan_execute_invalidating(pipe, [monitor_id])
+
+    def apply_changes(self, inserted: Optional[pd.DataFrame] = None, updated: Optional[pd.DataFrame] = None,
+                      previous: Optional[pd.DataFrame] = None, deleted: Optional[pd.DataFrame] = None,
+                      position: Optional[Tuple[str, int]] = None) -> bool:
+        """
+        Apply row-level heartbeat changes to the open segment shards and the aggregates.
+
+        Args:
+            inserted: New heartbeats. Those already in the cached shards were
+                folded into the aggregates when cached and only replace their row.
+            updated: Heartbeats as they are after an update.
+            previous: The same heartbeats as they were before it, which are
+                taken back out of the aggregates.
+            deleted: Deleted heartbeats.
+            position: Binlog position (log file, log position) the changes end
+                at. It is stored with the aggregates, and changes at or before
+                the stored position were folded in already and are not again.
+
+        Returns False, changing nothing, if a change falls into a sealed
+        segment or a touched shard is not cached, in which case the caller
+        should rebuild or invalidate instead. Only called by the holder of the
+        refresh lease.
+        """
+        return self._run(self._plan_apply_changes(inserted, updated, previous, deleted, position))
+
+    def _plan_apply_changes(self, inserted, updated, previous, deleted, position=None):
+        empty = pd.DataFrame()
+        inserted, updated, previous, deleted = (frame if frame is not None else empty
+                                                for frame in (inserted, updated, previous, deleted))
+        changes = [frame for frame in (inserted, updated, previous, deleted) if not frame.empty]
+        if not changes:
+            return True
+        open_start = yield from self._plan_get_open_segment()
+        if open_start is None:
+            return False
+        first = segment_datetime(open_start)
+        if any((pd.to_datetime(frame['time']) < first).any() for frame in changes):
+            # Sealed segments are never rewritten, so changes to them need a rebuild
+            return False
+        monitor_ids = sorted({int(monitor_id) for frame in changes for monitor_id in frame['monitor_id'].unique()})
+        read = yield from self._plan_read_open('frame', monitor_ids, self.deserialize)
+        if read is None:
+            return False
+        generation, index, ids, cached, _ = read
+        shards, unseen = yield self._blocking(partial(self._merge_changes, ids, cached, inserted, updated, deleted))
+
+        if shards:
+            pipe = self.redis_client.pipeline()
+            for monitor_id, shard in shards.items():
+                yield self._blocking(partial(self._write_open, pipe, generation, monitor_id, shard))
+            pipe.sadd(self.index_key(generation), *shards)
+            self._queue_keep_open(pipe, generation, index | set(shards))
+            pipe.set(self.LAST_UPDATE_KEY, datetime.now().timestamp())
+            yield from self._plan_execute_invalidating(pipe, list(shards))
+
+        if not (yield self._cmd('exists', self.STATS_INDEX_KEY)):
+            # The aggregates are built by the next full refresh, from scratch
+            return True
+        if position is not None:
+            applied = yield self._cmd('hmget', self.STATS_POSITION_KEY, 'log_file', 'log_pos')
+            if None not in applied and (applied[0].decode(), int(applied[1])) >= tuple(position):
+                # A replayed batch, whose changes are in the aggregates already
+                return True
+        added = [frame for frame in (unseen, updated) if not frame.empty]
+        retracted = [frame for frame in (previous, deleted) if not frame.empty]
+        if added or retracted:
+            yield from self._plan_update_stats(
+                pd.concat(added, ignore_index=True) if added else empty, None, None,
+                pd.concat(retracted, ignore_index=True) if retracted else None, position
+            )
+        return True
+
+    def _merge_changes(self, ids: List[int], cached: List[pd.DataFrame], inserted: pd.DataFrame,
+                       updated: pd.DataFrame, deleted: pd.DataFrame) -> Tuple[Dict[int, pd.DataFrame], pd.DataFrame]:
+        """
+        Merge row changes into the cached open segment frames.
+
+        Returns the frame of every touched monitor, and the inserted rows that
+        were not cached yet and so are not in the aggregates either.
+        """
+        changed = [frame for frame in (inserted, updated) if not frame.empty]
+        stale = {int(row_id) for frame in (inserted, updated, deleted) if not frame.empty for row_id in frame['id']}
+        current = self._concat(cached, None)
+        unseen = inserted
+        if not current.empty:
+            if not inserted.empty:
+                unseen = inserted[~inserted['id'].isin(current['id'])]
+            current = current[~current['id'].isin(stale)]
+        parts = [frame for frame in (current, *changed) if 'monitor_id' in frame.columns]
+        if not parts:
+            return {}, unseen
+        combined = compact_frame(pd.concat(parts, ignore_index=True).sort_values('id', kind='stable'))
+        combined = combined[pd.to_datetime(combined['time']) >= retention_cutoff(self.retention)]
+        monitor_ids = set(ids) | {int(monitor_id) for frame in changed for monitor_id in frame['monitor_id'].unique()}
+        shards = {monitor_id: combined[combined['monitor_id'] == monitor_id] for monitor_id in sorted(monitor_ids)}
+        return shards, unseen
+
+    def _queue_keep_open(self, pipe, generation: int, index: Set[int]) -> None:
+        """
+        Queue a TTL refresh of the index and of every indexed shard on pipe.
+
+        Writes only rewrite the shards of monitors with new rows, and a shard
+        expiring while the index still lists it would make reads miss.
+        """
+        pipe.expire(self.index_key(generation), self.CACHE_TTL)
+        for monitor_id in index:
+            pipe.expire(self.shard_key(monitor_id, generation), self.CACHE_TTL)
+            pipe.expire(self.json_key(monitor_id, generation), self.CACHE_TTL)
+
+    def seal_segments(self, open_start: int) -> bool:
+        """
+        Move rows older than open_start out of the open segment into sealed segments.
+
+        Returns False if the open segment is not fully cached, in which case
+        the caller should rebuild the cache instead.
+        """
+        return self._run(self._plan_seal_segments(open_start))
+
+    def _plan_seal_segments(self, open_start: int):
+        read = yield from self._plan_read_open('frame', None, self.deserialize)
+        if read is None:
+            return False
+        generation, _, ids, frames, _ = read
+
+        pipe = self._bulk_pipeline()
+        yield self._blocking(partial(self._queue_seal, pipe, generation, open_start, ids, frames))
+        yield from self._plan_execute_sealing(pipe)
+        return True
+
+    def _queue_seal(self, pipe, generation: int, open_start: int, ids: List[int],
+                    frames: List[pd.DataFrame]) -> None:
+        """Queue the split of the open segment frames at open_start on pipe"""
+        sealed: Dict[int, List[pd.DataFrame]] = {}
+        for monitor_id, frame in zip(ids, frames):
+            segments, open_rows = split_segments(frame, open_start)
+            for start, rows in segments.items():
+                sealed.setdefault(start, []).append(rows)
+            self._write_open(pipe, generation, monitor_id, open_rows)
+        pipe.expire(self.index_key(generation), self.CACHE_TTL)
+        self._write_segments(pipe, generation,
+                             {start: pd.concat(parts, ignore_index=True) for start, parts in sealed.items()})
+        pipe.mset({self.open_segment_key(generation): open_start, self.LAST_UPDATE_KEY: datetime.now().timestamp()})
 
     def get_last_update(self) -> Optional[float]:
         """Get timestamp of last update"""
-        last_update = self.redis_client.get(self.LAST_UPDATE_KEY)
-        return float(last_update) if last_update else None
+        return self._run(self._plan_get_last_update())
+
+    def _plan_get_last_update(self):
+        last_update = yield self._cmd('get', self.LAST_UPDATE_KEY)
+        if not last_update:
+            return None
+        REGISTRY.gauge('heartbeat_cache_age_seconds').set(time.time() - float(last_update))
+        return float(last_update)
+
+    def acquire_refresh_lease(self) -> Optional[str]:
+        """Try to become the single refresher, returning the lease token on success"""
+        return self._run(self._plan_acquire_refresh_lease())
+
+    def _plan_acquire_refresh_lease(self):
+        token = uuid.uuid4().hex
+        if (yield self._cmd('set', self.LEASE_KEY, token, nx=True, px=HEARTBEAT_REFRESH_LEASE_MS)):
+            REGISTRY.counter('heartbeat_refresh_lease_total', {'outcome': 'acquired'}).inc()
+            return token
+        REGISTRY.counter('heartbeat_refresh_lease_total', {'outcome': 'contended'}).inc()
+        return None
+
+    def release_refresh_lease(self, token: str) -> None:
+        """Release the lease unless it already expired and was taken over"""
+        return self._release_lease(keys=[self.LEASE_KEY], args=[token])
+
+    @contextmanager
+    def keep_refresh_lease(self, token: str):
+        """Renew the lease every third of its lifetime from a background thread while the block runs"""
+        stop = threading.Event()
+
+        def renew():
+            while not stop.wait(HEARTBEAT_REFRESH_LEASE_MS / 3000):
+                try:
+                    if not self._renew_lease(keys=[self.LEASE_KEY], args=[token, HEARTBEAT_REFRESH_LEASE_MS]):
+                        REGISTRY.counter('heartbeat_refresh_lease_total', {'outcome': 'lost'}).inc()
+                        print("Heartbeat refresh lease expired before it could be renewed")
+                        return
+                except redis.RedisError as e:
+                    print(f"Error renewing the heartbeat refresh lease: {e}")
+
+        thread = threading.Thread(target=renew, name="refresh-lease", daemon=True)
+        thread.start()
+        try:
+            yield
+        finally:
+            stop.set()
+
+    def get_or_refresh(self, loader: Callable[[], pd.DataFrame],
+                       monitor_ids: Optional[Iterable[int]] = None,
+                       wait_timeout: float = HEARTBEAT_REFRESH_WAIT,
+                       poll_interval: float = 0.05, as_json: bool = False,
+                       since: Optional[datetime] = None):
+        """
+        Read through the cache, letting only one caller run loader on a miss.
+
+        Callers that lose the lease race poll the cache until the winner has
+        written it. If the winner dies, its lease expires and a waiter takes
+        over. With as_json the result is the encoded response body instead
+        of a DataFrame. since selects segments as in get_data().
+
+        Raises:
+            TimeoutError: If no data became available within wait_timeout
+        """
+        return self._run(self._plan_get_or_refresh(loader, monitor_ids, wait_timeout, poll_interval, as_json, since))
+
+    def _plan_get_or_refresh(self, loader, monitor_ids, wait_timeout, poll_interval, as_json, since):
+        if monitor_ids is not None:
+            monitor_ids = [int(monitor_id) for monitor_id in monitor_ids]
+        deadline = time.monotonic() + wait_timeout
+        wait_started = None
+        while True:
+            # Steps go through the public methods so they can be replaced in tests
+            if as_json:
+                cached = yield partial(self.get_json, monitor_ids, since=since)
+            else:
+                cached = yield partial(self.get_data, monitor_ids=monitor_ids, since=since)
+            if cached is not None:
+                if wait_started is not None:
+                    REGISTRY.histogram('heartbeat_refresh_wait_seconds').observe(time.monotonic() - wait_started)
+                return cached
+
+            token = yield self.acquire_refresh_lease
+            if token:
+                started = time.perf_counter()
+                try:
+                    with self.keep_refresh_lease(token):
+                        df = yield self._blocking(loader)
+                        yield partial(self.set_data, df)
+                finally:
+                    yield partial(self.release_refresh_lease, token)
+                REGISTRY.histogram('heartbeat_cache_refresh_seconds', {'mode': 'read_through'}) \
+                    .observe(time.perf_counter() - started)
+                if monitor_ids is not None and not df.empty:
+                    df = df[df['monitor_id'].isin(monitor_ids)]
+                if since is not None and not df.empty:
+                    first = segment_datetime(min(segment_start(since), open_segment_start()))
+                    df = df[pd.to_datetime(df['time']) >= first]
+                return encode_records(df) if as_json else df
+
+            if time.monotonic() >= deadline:
+                REGISTRY.counter('heartbeat_refresh_lease_total', {'outcome': 'timeout'}).inc()
+                raise TimeoutError("Timed out waiting for the heartbeat cache refresh")
+            if wait_started is None:
+                wait_started = time.monotonic()
+            yield partial(self._sleep, poll_interval)
+
+    def invalidate(self, monitor_id: Optional[int] = None) -> None:
+        """
+        Invalidate the cache.
+
+        Without a monitor_id the current generation is only marked stale:
+        readers keep being served from it until CacheSync, which rebuilds
+        caches without a last update, switches to a new generation.
+
+        Args:
+            monitor_id: Only drop this monitor's open segment shard. Its id
+                stays in the index so reads of it miss until the cache is
+                rebuilt, which also rewrites the sealed segments.
+        """
+        return self._run(self._plan_invalidate(None if monitor_id is None else [int(monitor_id)]))
+
+    def invalidate_monitors(self, monitor_ids: Iterable[int]) -> None:
+        """Drop the open segment shards of several monitors, as invalidate(monitor_id) does, in one transaction"""
+        monitor_ids = sorted({int(monitor_id) for monitor_id in monitor_ids})
+        if monitor_ids:
+            return self._run(self._plan_invalidate(monitor_ids))
+
+    def _plan_invalidate(self, monitor_ids: Optional[List[int]]):
+        if monitor_ids is None:
+            REGISTRY.counter('heartbeat_cache_invalidations_total', {'scope': 'all'}).inc()
+            yield self._cmd('delete', self.LAST_UPDATE_KEY)
+            return
+        REGISTRY.counter('heartbeat_cache_invalidations_total', {'scope': 'monitor'}).inc(len(monitor_ids))
+        generation = yield from self._plan_get_generation()
+        if generation is None:
+            return
+        pipe = self.redis_client.pipeline()
+        pipe.delete(*[key(monitor_id, generation) for monitor_id in monitor_ids for key in (self.shard_key, self.json_key)])
+        yield from self._plan_execute_invalidating(pipe, monitor_ids)
+
+    def get_stats_monitor_ids(self) -> Set[int]:
+        """Get the ids of all monitors with aggregates"""
+        return self._run(self._plan_get_stats_monitor_ids())
+
+    def _plan_get_stats_monitor_ids(self):
+        monitor_ids = yield self._cmd('smembers', self.STATS_INDEX_KEY)
+        return {int(monitor_id) for monitor_id in monitor_ids}
+
+    def get_stats(self, monitor_ids: Optional[Iterable[int]] = None) -> Dict[int, Dict[str, object]]:
+        """Get the rolling uptime and ping windows and last status change per monitor"""
+        return self._run(self._plan_get_stats(monitor_ids))
+
+    def _plan_get_stats(self, monitor_ids):
+        if monitor_ids is None:
+            monitor_ids = yield from self._plan_get_stats_monitor_ids()
+        monitor_ids = sorted(set(monitor_ids))
+        if not monitor_ids:
+            return {}
+        read = self.redis_client.pipeline(transaction=False)
+        for monitor_id in monitor_ids:
+            read.hgetall(self.stats_key(monitor_id))
+        results = yield read.execute
+        now = time.time()
+        return {
+            monitor_id: summarize_stats({field.decode(): value for field, value in fields.items()}, now)
+            for monitor_id, fields in zip(monitor_ids, results) if fields
+        }
+
+    def update_stats(self, df: pd.DataFrame, replace_since: Optional[int] = None,
+                     backfill: Optional[Dict[int, Dict[str, list]]] = None,
+                     retract: Optional[pd.DataFrame] = None) -> None:
+        """
+        Fold heartbeats into the per-monitor aggregates.
+
+        Buckets are added to, except those starting at or after replace_since
+        (fully covered by df) and backfilled ones, which are overwritten.
+        Heartbeats in retract are subtracted again; ping minimums and maximums
+        cannot be, and stay as they are. Only called by the holder of the
+        refresh lease.
+        """
+        return self._run(self._plan_update_stats(df, replace_since, backfill, retract))
 
-    def invalidate(self) -> None:
-        """Invalidate the cache"""
-        self.redis_client.delete(self.CACHE_KEY)
-        self.redis_client.delete(self.LAST_UPDATE_KEY)
+    def _plan_update_stats(self, df, replace_since, backfill, retract=None, position=None):
+        backfill = backfill or {}
+
+        def replaced(monitor_id: int, field: str) -> bool:
+            return field in backfill.get(monitor_id, {}) or (
+                replace_since is not None and int(field.partition(':')[2]) >= replace_since)
+
+        def collect() -> Dict[int, Dict[str, list]]:
+            buckets = {}
+            for monitor_id, fields in aggregate_stats(df, time.time()).items():
+                buckets[monitor_id] = {field: value for field, value in fields.items()
+                                       if replace_since is None or replaced(monitor_id, field)}
+            for monitor_id, fields in backfill.items():
+                buckets.setdefault(monitor_id, {}).update(fields)
+            if retract is not None:
+                for monitor_id, fields in aggregate_stats(retract, time.time()).items():
+                    target = buckets.setdefault(monitor_id, {})
+                    for field, value in fields.items():
+                        negated = [-value[0], -value[1], -value[2], -value[3], None, None]
+                        target[field] = merge_bucket(target[field], negated) if field in target else negated
+            return buckets
+
+        buckets = yield self._blocking(collect)
+        monitor_ids = sorted(monitor_id for monitor_id, fields in buckets.items() if fields)
+        if not monitor_ids:
+            return
+        read = self.redis_client.pipeline(transaction=False)
+        for monitor_id in monitor_ids:
+            read.hgetall(self.stats_key(monitor_id))
+        stored = yield read.execute
+        pipe = self._bulk_pipeline()
+        yield self._blocking(partial(self._queue_stats, pipe, df, monitor_ids, stored, buckets, replaced))
+        if position is not None:
+            pipe.hset(self.STATS_POSITION_KEY, mapping={'log_file': position[0], 'log_pos': position[1]})
+        yield self._blocking(pipe.execute)
+
+    def _queue_stats(self, pipe, df: pd.DataFrame, monitor_ids: List[int], stored: List[dict],
+                     buckets: Dict[int, Dict[str, list]], replaced: Callable[[int, str], bool]) -> None:
+        """Queue the merged aggregate buckets and last status of each monitor on pipe"""
+        rows = {int(monitor_id): group for monitor_id, group in df.groupby('monitor_id')} if not df.empty else {}
+        now = time.time()
+        for monitor_id, fields in zip(monitor_ids, stored):
+            fields = {field.decode(): value for field, value in fields.items()}
+            mapping = {}
+            for field, value in buckets[monitor_id].items():
+                if field in fields and not replaced(monitor_id, field):
+                    value = merge_bucket(orjson.loads(fields[field]), value)
+                elif min(value[:3]) < 0:
+                    # Taking heartbeats back out of a bucket that has already gone
+                    continue
+                mapping[field] = orjson.dumps(value)
+            # Expired buckets, and replaced ones that no longer have heartbeats
+            stale = []
+            for field in fields:
+                resolution, _, start = field.partition(':')
+                if resolution not in STATS_RESOLUTIONS or field in mapping:
+                    continue
+                if int(start) + STATS_RESOLUTIONS[resolution] <= now - STATS_KEEP[resolution] \
+                        or replaced(monitor_id, field):
+                    stale.append(field)
+            if monitor_id in rows:
+                status = latest_status(rows[monitor_id], orjson.loads(fields['status']) if 'status' in fields else None)
+                if status:
+                    mapping['status'] = orjson.dumps(status)
+            key = self.stats_key(monitor_id)
+            if mapping:
+                pipe.hset(key, mapping=mapping)
+            if stale:
+                pipe.hdel(key, *stale)
+            pipe.expire(key, STATS_TTL)
+        pipe.sadd(self.STATS_INDEX_KEY, *monitor_ids)
+
+    def get_debug_info(self) -> Dict[str, object]:
+        """Get the cache version and generation, segments and freshness as seen from this process"""
+        return self._run(self._plan_get_debug_info())
+
+    def _plan_get_debug_info(self):
+        generation = yield from self._plan_get_generation()
+        # Generations start at 1, so the keys of generation 0 never exist
+        keys_of = generation or 0
+        read = self.redis_client.pipeline(transaction=False)
+        read.mget([self.VERSION_KEY, self.open_segment_key(keys_of), self.LAST_UPDATE_KEY])
+        read.scard(self.index_key(keys_of))
+        read.pttl(self.LEASE_KEY)
+        read.zrange(self.segments_key(keys_of), 0, -1)
+        (version, open_start, last_update), cached_monitors, lease_ttl, starts = yield read.execute
+        return {
+            'version': int(version) if version else 0,
+            'generation': generation,
+            'stale': generation is not None and not last_update,
+            'l1': {
+                'enabled': self.l1_enabled,
+                'version': self._l1_version,
+                'entries': len(self._l1),
+                'sealed_segments': len(self._l1_segments or [])
+            },
+            'snapshot': self._snapshot_debug_info(),
+            'open_segment': segment_datetime(int(open_start)).isoformat() if open_start else None,
+            'sealed_segments': [segment_datetime(start).isoformat() for start in sorted(int(s) for s in starts)],
+            'cached_monitors': cached_monitors,
+            'last_update': float(last_update) if last_update else None,
+            'age_seconds': time.time() - float(last_update) if last_update else None,
+            'refresh_lease_ms': lease_ttl if lease_ttl and lease_ttl > 0 else None
+        }
+
+    def _snapshot_debug_info(self) -> Optional[Dict[str, object]]:
+        state = self.snapshot.load() if self.snapshot is not None else None
+        if state is None:
+            return None
+        return {'path': self.snapshot.path, 'generation': state.generation, 'sealed_segments': len(state.starts)}
+
+    def publish_metrics(self, source: str) -> None:
+        """Publish this process's metrics for the API's /metrics endpoint"""
+        return self._run(self._plan_publish_metrics(source))
+
+    def _plan_publish_metrics(self, source: str):
+        snapshot = {'published_at': time.time(), 'metrics': REGISTRY.snapshot()}
+        yield self._cmd('hset', self.METRICS_KEY, source, orjson.dumps(snapshot))
+
+    def get_published_metrics(self) -> Dict[str, dict]:
+        """Get the metrics other processes published recently, by source"""
+        return self._run(self._plan_get_published_metrics())
+
+    def _plan_get_published_metrics(self):
+        published = yield self._cmd('hgetall', self.METRICS_KEY)
+        cutoff = time.time() - HEARTBEAT_METRICS_TTL
+        snapshots = {source.decode(): orjson.loads(payload) for source, payload in published.items()}
+        return {source: snapshot for source, snapshot in snapshots.items() if snapshot['published_at'] >= cutoff}
+
+    def get_binlog_position(self) -> Optional[Tuple[str, int]]:
+        """Get the (log file, position) checkpointed by the binlog sync service, if any"""
+        return self._run(self._plan_get_binlog_position())
+
+    def _plan_get_binlog_position(self):
+        position = yield self._cmd('hmget', self.BINLOG_POSITION_KEY, 'log_file', 'log_pos')
+        if not position or None in position:
+            return None
+        return position[0].decode(), int(position[1])
+
+    def set_binlog_position(self, log_file: str, log_pos: int) -> None:
+        """Checkpoint the binlog position the binlog sync service has processed up to"""
+        return self._run(self._plan_set_binlog_position(log_file, log_pos))
+
+    def _plan_set_binlog_position(self, log_file: str, log_pos: int):
+        yield self._cmd('hset', self.BINLOG_POSITION_KEY, mapping={'log_file': log_file, 'log_pos': log_pos})
+
+    def clear_binlog_position(self) -> None:
+        """Forget the checkpointed binlog position, e.g. once the server has purged its log file"""
+        return self._run(self._plan_clear_binlog_position())
+
+    def _plan_clear_binlog_position(self):
+        # Positions in a new log need not sort after the old ones
+        yield self._cmd('delete', self.BINLOG_POSITION_KEY, self.STATS_POSITION_KEY)
+
+class AsyncHeartbeatCache(HeartbeatCache):
+    """
+    HeartbeatCache on redis.asyncio for use from the event loop.
+
+    Every public Redis method returns a coroutine. Keys, formats and the L1
+    are shared with HeartbeatCache, so both can serve the same cache.
+    """
+
+    def _create_client(self):
+        return redis.asyncio.Redis(connection_pool=get_redis_pool(use_asyncio=True))
+
+    def _create_sync_client(self):
+        return redis.Redis(connection_pool=get_redis_pool())
+
+    _sleep = staticmethod(asyncio.sleep)
+
+    def _blocking(self, func: Callable) -> Callable:
+        return partial(asyncio.to_thread, func)
+
+    async def _run(self, plan):
+        """Run a plan on the event loop and return its result"""
+        send, value = plan.send, None
+        while True:
+            try:
+                step = send(value)
+            except StopIteration as stop:
+                return stop.value
+            try:
+                value = step()
+                if inspect.isawaitable(value):
+                    value = await value
+                send = plan.send
+            except Exception as error:
+                send, value = plan.throw, error
+
+class ChangeProbe:
+    """
+    Cheap query whose result changes whenever the watched tables gain rows.
+
+    Subclasses return a comparable token from read(); CacheSync refreshes
+    the cache whenever the token differs from the previous poll.
+    """
+    name = 'base'
+
+    def __init__(self, tables: Sequence[str] = ('heartbeat',)):
+        self.tables = tuple(tables)
+
+    def read(self, cursor) -> Hashable:
+        """Run the probe and record how long it took"""
+        start = time.perf_counter()
+        try:
+            return self._read(cursor)
+        finally:
+            REGISTRY.histogram('cache_probe_seconds', {'probe': self.name}).observe(time.perf_counter() - start)
+
+    def _read(self, cursor) -> Hashable:
+        raise NotImplementedError
+
+    def heartbeat_id(self, token: Hashable) -> Optional[int]:
+        """Highest heartbeat id the token shows to exist, if the probe watches that table"""
+        return None
+
+class MaxIdProbe(ChangeProbe):
+    """MAX(id) of each table, answered from the primary key index alone"""
+    name = 'max_id'
+
+    def _read(self, cursor) -> Hashable:
+        columns = ", ".join(f"(SELECT MAX(id) FROM {table}) AS {table}" for table in self.tables)
+        cursor.execute(f"SELECT {columns}")
+        row = cursor.fetchone()
+        return tuple(row[table] for table in self.tables)
+
+    def heartbeat_id(self, token: Hashable) -> Optional[int]:
+        if 'heartbeat' not in self.tables:
+            return None
+        value = token[self.tables.index('heartbeat')]
+        return int(value) if value is not None else None
+
+class AutoIncrementProbe(ChangeProbe):
+    """Next AUTO_INCREMENT value of each table from information_schema, without touching the tables"""
+    name = 'auto_increment'
+
+    def _read(self, cursor) -> Hashable:
+        placeholders = ", ".join(["%s"] * len(self.tables))
+        cursor.execute(f"""
+            SELECT TABLE_NAME, AUTO_INCREMENT
+            FROM information_schema.TABLES
+            WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME IN ({placeholders})
+        """, self.tables)
+        values = {row['TABLE_NAME']: row['AUTO_INCREMENT'] for row in cursor.fetchall()}
+        return tuple(values.get(table) for table in self.tables)
+
+    def heartbeat_id(self, token: Hashable) -> Optional[int]:
+        if 'heartbeat' not in self.tables:
+            return None
+        value = token[self.tables.index('heartbeat')]
+        # Ids below the next AUTO_INCREMENT value may be unused, which only makes this an upper bound
+        return int(value) - 1 if value is not None else None
+
+CHANGE_PROBES = {probe.name: probe for probe in (MaxIdProbe, AutoIncrementProbe)}
 
 class CacheSync:
-    def __init__(self, engine):
+    def __init__(self, engine, probe: Optional[ChangeProbe] = None,
+                 snapshot: Optional[HeartbeatSnapshot] = None):
         self.engine = engine
-        self.cache = HeartbeatCache()
+        self.cache = AsyncHeartbeatCache()
+        # Kept up to date for every process of this host, whoever refreshes Redis
+        self.snapshot = snapshot or (HeartbeatSnapshot() if HEARTBEAT_SNAPSHOT_PATH else None)
+        self.probe = probe or CHANGE_PROBES[HEARTBEAT_CHANGE_PROBE]()
+        # Token returned by the probe at the last refresh
+        self.last_probe_token: Optional[Hashable] = None
         self.running = False
         self.poll_interval = 5  # seconds
+        self.retention = timedelta(seconds=HEARTBEAT_CACHE_RETENTION)
+        # Highest heartbeat.id already in the cache; None until the first full refresh
+        self.watermark: Optional[int] = None
+        # Highest heartbeat.id the probe saw before the current refresh, the watermark
+        # of a full refresh that finds no heartbeats inside the retention window
+        self.probed_id: Optional[int] = None
+        # Blocking MariaDB work runs on this thread, over one persistent connection,
+        # so refreshes never stall the event loop shared with the TCP server
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='cache-sync-db')
+        self.conn = None
+
+    async def _db(self, func: Callable, *args):
+        """Run blocking database work on the executor thread"""
+        return await asyncio.get_running_loop().run_in_executor(self.executor, partial(func, *args))
+
+    def _open_cursor(self, buffered: bool = True):
+        """
+        Cursor on the persistent connection, connecting first if needed. Runs on the executor.
+
+        Buffered cursors return dictionaries. Unbuffered ones return tuples
+        straight off the wire, and must be read to the end before the
+        connection runs another statement.
+        """
+        if self.conn is None:
+            self.conn = mariadb.connect(**DB_CONFIG)
+            self.conn.autocommit = True
+        return self.conn.cursor(dictionary=True) if buffered else self.conn.cursor(buffered=False)
+
+    async def _stream(self, fetch: Callable[..., pd.DataFrame], *args) -> pd.DataFrame:
+        """Run a heartbeat fetch on its own unbuffered cursor, so rows are streamed rather than buffered"""
+        def run():
+            cursor = self._open_cursor(buffered=False)
+            try:
+                return fetch(cursor, *args)
+            finally:
+                cursor.close()
+        return await self._db(run)
+
+    def _close_connection(self) -> None:
+        """Drop the persistent connection so the next poll reconnects. Runs on the executor."""
+        if self.conn is not None:
+            try:
+                self.conn.close()
+            except Exception:
+                pass
+            self.conn = None
+
+    async def refresh_full(self, cursor) -> None:
+        """Reload every heartbeat inside the retention window"""
+        cutoff = retention_cutoff(self.retention)
+        df = await self._stream(fetch_heartbeats, cutoff)
+        await self.cache.set_data(df)
+        self.watermark = int(df['id'].max()) if not df.empty else (self.probed_id or 0)
+        await self.refresh_stats(cursor, df, cutoff)
+        print("Cache updated with new heartbeat data")
+
+    async def refresh_stats(self, cursor, df: pd.DataFrame, cutoff: datetime) -> None:
+        """Rebuild the aggregate buckets covered by a full load, backfilling older days on first use"""
+        replace_since = math.ceil(cutoff.replace(tzinfo=timezone.utc).timestamp())
+        backfill = None
+        if not await self.cache.get_stats_monitor_ids():
+            day = STATS_RESOLUTIONS['day']
+            first = (replace_since - STATS_KEEP['day']) // day * day
+            # Days up to the first one df fully covers
+            until = -(-replace_since // day) * day
+            backfill = await self._db(fetch_daily_stats, cursor, segment_datetime(first), segment_datetime(until))
+        await self.cache.update_stats(df, replace_since=replace_since, backfill=backfill)
+
+    async def refresh_incremental(self, cursor) -> None:
+        """Append heartbeats above the watermark to the open segment, sealing it once its hour is over"""
+        open_start = await self.cache.get_open_segment()
+        if open_start is None:
+            await self.refresh_full(cursor)
+            return
+        if open_segment_start() > open_start:
+            open_start = open_segment_start()
+            if not await self.cache.seal_segments(open_start):
+                await self.refresh_full(cursor)
+                return
+
+        new_rows = await self._stream(fetch_new_heartbeats, self.watermark, retention_cutoff(self.retention))
+        if new_rows.empty:
+            return
+
+        # The binlog consumer may have applied some of these rows already; they are
+        # replaced by id and only counted once in the aggregates
+        if not await self.cache.apply_changes(inserted=new_rows):
+            # Late heartbeats belong to sealed segments, or a shard expired or was
+            # invalidated so appending would lose rows
+            await self.refresh_full(cursor)
+            return
+
+        self.watermark = int(new_rows['id'].max())
+        print(f"Cache appended {len(new_rows)} new heartbeats")
 
     async def check_for_updates(self):
         """Check if heartbeat data has been updated"""
         try:
-            conn = mariadb.connect(**DB_CONFIG)
-            conn.autocommit = True
-            cursor = conn.cursor(dictionary=True)
-            
+            cursor = await self._db(self._open_cursor)
             try:
-                # Get last update time from heartbeat table
-                cursor.execute("""
-                    SELECT MAX(updated_at) as last_update
-                    FROM heartbeat
-                """)
-                last_db_update = cursor.fetchone()['last_update']
-                
-                if last_db_update:
-                    last_cache_update = self.cache.get_last_update()
-                    if not last_cache_update or last_db_update.timestamp() > last_cache_update:
-                        # Data has been updated, refresh cache
-                        cursor.execute("""
-                            SELECT h.* 
-                            FROM heartbeat h
-                            JOIN monitor m ON h.monitor_id = m.id
-                        """)
-                        results = cursor.fetchall()
-                        df = pd.DataFrame(results)
-                        self.cache.set_data(df)
-                        print("Cache updated with new heartbeat data")
+                # Detect new heartbeats without scanning the table
+                token = await self._db(self.probe.read, cursor)
+                self.probed_id = self.probe.heartbeat_id(token)
+                cache_missing = (await self.cache.get_last_update()) is None
+
+                if token != self.last_probe_token or cache_missing:
+                    # Data has been updated, refresh cache unless another process already is
+                    lease = await self.cache.acquire_refresh_lease()
+                    if lease:
+                        try:
+                            mode = 'full' if self.watermark is None or cache_missing else 'incremental'
+                            started = time.perf_counter()
+                            with self.cache.keep_refresh_lease(lease):
+                                if mode == 'full':
+                                    await self.refresh_full(cursor)
+                                else:
+                                    await self.refresh_incremental(cursor)
+                            REGISTRY.histogram('heartbeat_cache_refresh_seconds', {'mode': mode}) \
+                                .observe(time.perf_counter() - started)
+                            self.last_probe_token = token
+                        finally:
+                            await self.cache.release_refresh_lease(lease)
             finally:
-                cursor.close()
-                conn.close()
-                
+                await self._db(cursor.close)
+
         except Exception as e:
             print(f"Error checking for updates: {e}")
+            await self._db(self._close_connection)
+
+    async def sync_snapshot(self) -> None:
+        """Rewrite the local snapshot when the current generation's sealed segments differ from it"""
+        generation = await self.cache.get_generation()
+        if generation is None:
+            return
+        starts = await self.cache.get_sealed_segments(generation)
+        state = await asyncio.to_thread(self.snapshot.load)
+        if state is not None and state.generation == generation and state.starts == starts:
+            return
+
+        kept = set(starts) & set(state.starts) if state is not None and state.generation == generation else set()
+        rows = await self.cache.get_segment_payloads(generation, [start for start in starts if start not in kept])
+        if rows is None:
+            # The generation was replaced meanwhile; catch up on the next poll
+            return
+        for start in kept:
+            frames, fragments = state.segments['frame'][start], state.segments['json'][start]
+            rows.extend((start, monitor_id, frame, fragments.get(monitor_id, b'')) for monitor_id, frame in frames.items())
+        started = time.perf_counter()
+        await asyncio.to_thread(self.snapshot.publish, generation, starts, rows)
+        REGISTRY.histogram('heartbeat_snapshot_publish_seconds').observe(time.perf_counter() - started)
+        print(f"Heartbeat snapshot updated to generation {generation} with {len(starts)} sealed segments")
 
     async def start_sync(self):
         """Start the cache sync process"""
         self.running = True
         print("Starting cache sync service...")
         
-        while self.running:
-            try:
-                await self.check_for_updates()
-                await asyncio.sleep(self.poll_interval)
-            except Exception as e:
-                print(f"Error in cache sync: {e}")
-                await asyncio.sleep(5)  # Wait before retry
+        try:
+            while self.running:
+                try:
+                    await self.check_for_updates()
+                    if self.snapshot is not None:
+                        await self.sync_snapshot()
+                    await self.cache.publish_metrics('cache_sync')
+                    await asyncio.sleep(self.poll_interval)
+                except Exception as e:
+                    print(f"Error in cache sync: {e}")
+                    await asyncio.sleep(5)  # Wait before retry
+        finally:
+            await self._db(self._close_connection)
 
     def stop_sync(self):
         """Stop the cache sync process"""
@@ -1,12 +1,17 @@
-from typing import List, Dict, Any
-from dataclasses import dataclass
+from typing import List, Dict, Any, Callable, Hashable, Iterable, Iterator, Optional, Tuple
+from dataclasses import dataclass, fields
+from collections import Counter, OrderedDict, deque
 import os
+import threading
+import time
 from dotenv import load_dotenv
 import mariadb
-import pandas as pd
+import msgpack
+import redis
 from ninjapy.client import NinjaRMMClient
 from sqlalchemy import create_engine
 from sqlalchemy.pool import QueuePool
+from metrics import REGISTRY
 
 load_dotenv()
 
@@ -29,6 +34,31 @@ DB_CONFIG = {
     'connect_timeout': 60
 }
 
+# Read-through cache for per-connection IP lookups
+IP_CACHE_MAX_ENTRIES = int(os.getenv("IP_CACHE_MAX_ENTRIES", "10000"))
+IP_CACHE_TTL = float(os.getenv("IP_CACHE_TTL", "300"))  # seconds
+# Writes to allowed_ips are announced here so every process drops its cached lookups
+IP_INVALIDATION_CHANNEL = 'allowed_ips:invalidate'
+
+# Keyset pagination of allowed_ips
+IP_PAGE_DEFAULT_LIMIT = 500
+IP_PAGE_MAX_LIMIT = 5000
+
+# Local snapshot of allowed_ips used to serve lookups before MariaDB is reachable
+IP_SNAPSHOT_PATH = os.getenv("IP_SNAPSHOT_PATH", "data/allowed_ips.snapshot")
+IP_SNAPSHOT_INTERVAL = float(os.getenv("IP_SNAPSHOT_INTERVAL", "300"))  # seconds
+IP_SNAPSHOT_VERSION = 1
+
+# Query timing; slower queries are logged with their parameters redacted
+SLOW_QUERY_THRESHOLD_MS = float(os.getenv("SLOW_QUERY_THRESHOLD_MS", "100"))
+SLOW_QUERY_LOG_SIZE = 100
+# Each process's slow-query log is published here, by source, for the API's /debug/queries
+SLOW_QUERIES_KEY = 'db:slow_queries'
+SLOW_QUERY_PUBLISH_INTERVAL = float(os.getenv("SLOW_QUERY_PUBLISH_INTERVAL", "10"))  # seconds
+
+# Devices requested per NinjaRMM devices-detailed page during sync
+NINJA_DEVICE_PAGE_SIZE = int(os.getenv("NINJA_DEVICE_PAGE_SIZE", "1000"))
+
 @dataclass
 class IPConfig:
     ip_address: str
@@ -38,8 +68,168 @@ class IPConfig:
     device_name: str = ""  # Default to empty string
     push_url: str = ""  # Default to empty string
 
+def aggregate_device_ips(devices: Iterable[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """
+    Count devices per (organization, location, public IP) in a single pass.
+
+    Devices missing any of the three fields are skipped. The result is sorted
+    by organization name, then by descending count.
+    """
+    counts: Counter = Counter()
+    for device in devices:
+        references = device.get('references') or {}
+        org = (references.get('organization') or {}).get('name')
+        location = (references.get('location') or {}).get('name')
+        public_ip = device.get('publicIP')
+        if org is None or location is None or public_ip is None:
+            continue
+        counts[(org, location, public_ip)] += 1
+
+    return [
+        {
+            'references.organization.name': org,
+            'references.location.name': location,
+            'publicIP': public_ip,
+            'count': count
+        }
+        for (org, location, public_ip), count in sorted(
+            counts.items(), key=lambda item: (item[0][0], -item[1], item[0][1], item[0][2])
+        )
+    ]
+
+class LRUTTLCache:
+    """
+    Thread-safe LRU cache whose entries also expire after a fixed TTL.
+
+    Missing rows are cached as well (as ``None``) so repeated lookups for
+    unknown IPs do not reach the database either.
+    """
+
+    def __init__(self, max_entries: int = IP_CACHE_MAX_ENTRIES, ttl: float = IP_CACHE_TTL):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries: "OrderedDict[Hashable, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._generation = 0
+        # Mirrored into the metrics registry so other processes can read them once published
+        self._hit_counter = REGISTRY.counter('ip_cache_lookups_total', {'result': 'hit'})
+        self._miss_counter = REGISTRY.counter('ip_cache_lookups_total', {'result': 'miss'})
+        self._eviction_counter = REGISTRY.counter('ip_cache_evictions_total')
+        self._size_gauge = REGISTRY.gauge('ip_cache_entries')
+
+    def get_or_load(self, key: Hashable, loader: Callable[[], Any]) -> Any:
+        """Return the cached value for key, calling loader on a miss"""
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > now:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                self._hit_counter.inc()
+                return entry[1]
+            self.misses += 1
+            self._miss_counter.inc()
+            generation = self._generation
+
+        value = loader()
+        with self._lock:
+            # Skip the store if an invalidation raced with the load
+            if generation == self._generation:
+                self._store(key, value)
+        return value
+
+    def put(self, key: Hashable, value: Any) -> None:
+        """Store a value, evicting the least recently used entry if full"""
+        with self._lock:
+            self._store(key, value)
+
+    def _store(self, key: Hashable, value: Any) -> None:
+        self._entries[key] = (time.monotonic() + self.ttl, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+            self._eviction_counter.inc()
+        self._size_gauge.set(len(self._entries))
+
+    @property
+    def generation(self) -> int:
+        """Bumped by every invalidation"""
+        return self._generation
+
+    def run_unless_invalidated(self, generation: int, apply: Callable[[], None]) -> bool:
+        """Call apply, under the cache lock, unless an invalidation happened since generation was read"""
+        with self._lock:
+            if generation != self._generation:
+                return False
+            apply()
+            return True
+
+    def invalidate(self, *keys: Hashable) -> None:
+        """Drop the given keys, or every entry when called without keys"""
+        with self._lock:
+            self._generation += 1
+            if not keys:
+                self._entries.clear()
+            for key in keys:
+                self._entries.pop(key, None)
+            self._size_gauge.set(len(self._entries))
+
+    def stats(self) -> Dict[str, Any]:
+        """Return hit/miss counters and current size"""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_ratio': self.hits / lookups if lookups else 0.0,
+                'size': len(self._entries),
+                'max_entries': self.max_entries,
+                'ttl': self.ttl
+            }
+
+def ip_cache_stats_from_metrics(metrics: Dict[str, List[Dict[str, Any]]]) -> Optional[Dict[str, Any]]:
+    """Rebuild IP cache statistics from a metrics snapshot published by another process"""
+    lookups = {entry['labels'].get('result'): entry['value'] for entry in metrics.get('ip_cache_lookups_total', [])}
+    if not lookups:
+        return None
+
+    def value(name: str) -> int:
+        entries = metrics.get(name)
+        return int(entries[0]['value']) if entries else 0
+
+    hits, misses = int(lookups.get('hit', 0)), int(lookups.get('miss', 0))
+    return {
+        'hits': hits,
+        'misses': misses,
+        'evictions': value('ip_cache_evictions_total'),
+        'hit_ratio': hits / (hits + misses) if hits + misses else 0.0,
+        'size': value('ip_cache_entries')
+    }
+
 class DatabaseManager:
-    def __init__(self):
+    def __init__(self, source: str = 'main'):
+        self.source = source  # name this process publishes its slow-query log under
+        self.ip_cache = LRUTTLCache()
+        self.snapshot_index: Dict[str, IPConfig] = {}
+        self._snapshot_stop = threading.Event()
+        self._snapshot_thread: Optional[threading.Thread] = None
+        self.slow_queries: deque = deque(maxlen=SLOW_QUERY_LOG_SIZE)
+        # Slow queries recorded so far, and how many of them were in the last published log
+        self.slow_query_count = 0
+        self.slow_query_count_published = 0
+        self.redis_client = redis.Redis(
+            host=os.getenv('REDIS_HOST', 'redis'),
+            port=int(os.getenv('REDIS_PORT', 6379)),
+            db=0
+        )
+        self._pubsub = None
+        self._pubsub_thread = None
+
         # Create SQLAlchemy engine for cache sync using MariaDB with connection pooling
         self.engine = create_engine(
             f"mysql+pymysql://{DB_CONFIG['user']}:{DB_CONFIG['password']}@"
@@ -48,8 +238,15 @@ class DatabaseManager:
             pool_size=DB_CONFIG['pool_size'],
             pool_timeout=DB_CONFIG['connect_timeout']
         )
-        
-        self.init_db()
+
+        # Warm the lookup cache from disk first so we can serve without MariaDB
+        snapshot_loaded = self.load_snapshot()
+        try:
+            self.init_db()
+        except mariadb.Error as e:
+            if not snapshot_loaded:
+                raise
+            print(f"Database unavailable, serving allowed IPs from snapshot: {e}")
         self.ninja = self._init_ninja_client()
 
     def _init_ninja_client(self) -> NinjaRMMClient:
@@ -67,12 +264,69 @@ class DatabaseManager:
         conn.autocommit = True  # Enable autocommit for better performance
         return conn
 
+    def _execute(self, cursor, method: str, query: str, params: tuple = ()):
+        """Execute a query, recording its latency under the given method name"""
+        start = time.perf_counter()
+        try:
+            if params:
+                cursor.execute(query, params)
+            else:
+                cursor.execute(query)
+        finally:
+            elapsed = time.perf_counter() - start
+            REGISTRY.histogram('db_query_seconds', {'method': method}).observe(elapsed)
+            if elapsed * 1000 >= SLOW_QUERY_THRESHOLD_MS:
+                self._log_slow_query(method, query, params, elapsed)
+
+    def _log_slow_query(self, method: str, query: str, params: tuple, elapsed: float):
+        entry = {
+            'method': method,
+            'duration_ms': round(elapsed * 1000, 3),
+            'query': ' '.join(query.split()),
+            'params': [f"<{type(param).__name__}>" for param in params],
+            'timestamp': time.time()
+        }
+        self.slow_queries.append(entry)
+        self.slow_query_count += 1
+        print(f"Slow query in {method} ({entry['duration_ms']} ms): {entry['query']} {entry['params']}")
+
+    def publish_slow_queries(self):
+        """Publish this process's slow-query log so the API can show it, if it changed since last time"""
+        count = self.slow_query_count
+        if count == self.slow_query_count_published:
+            return
+        payload = msgpack.packb({'published_at': time.time(), 'slow_queries': list(self.slow_queries)})
+        try:
+            self.redis_client.hset(SLOW_QUERIES_KEY, self.source, payload)
+            self.slow_query_count_published = count
+        except redis.RedisError as e:
+            print(f"Error publishing the slow-query log: {e}")
+
+    def get_published_slow_queries(self) -> Dict[str, List[Dict[str, Any]]]:
+        """Get the slow-query logs the other processes published, by source"""
+        try:
+            published = self.redis_client.hgetall(SLOW_QUERIES_KEY)
+        except redis.RedisError as e:
+            print(f"Error reading published slow-query logs: {e}")
+            return {}
+        logs = {source.decode(): msgpack.unpackb(payload)['slow_queries'] for source, payload in published.items()}
+        logs.pop(self.source, None)
+        return logs
+
+    def get_query_stats(self) -> Dict[str, Any]:
+        """Get per-method query latency histograms and recent slow queries"""
+        return {
+            'threshold_ms': SLOW_QUERY_THRESHOLD_MS,
+            'histograms': REGISTRY.snapshot('db_query_seconds').get('db_query_seconds', []),
+            'slow_queries': list(self.slow_queries)
+        }
+
     def init_db(self):
         """Initialize the database if the table doesn't exist"""
         conn = self.get_connection()
         try:
             with conn.cursor() as cursor:
-                cursor.execute('''
+                self._execute(cursor, 'init_db', '''
                     CREATE TABLE IF NOT EXISTS allowed_ips (
                         id INT AUTO_INCREMENT PRIMARY KEY,
                         ip_address VARCHAR(45) UNIQUE NOT NULL,
@@ -91,20 +345,10 @@ class DatabaseManager:
     def sync_from_ninja(self) -> List[Dict[str, Any]]:
         """Sync IPs from NinjaRMM"""
         try:
-            ninja_data = self.ninja.get_devices_detailed(expand='organization,location')
-            df = pd.json_normalize(ninja_data)
-            
-            # Extract and clean data
-            df = df[['references.organization.name', 'references.location.name', 'publicIP']]
-            df = df.dropna()
-            
-            # Group and count IPs
-            ip_counts = df.groupby(['references.organization.name', 'references.location.name', 'publicIP']).size()
-            ip_counts = ip_counts.reset_index(name='count')
-            ip_counts = ip_counts.sort_values(['references.organization.name', 'count'], ascending=[True, False])
-            
+            ip_counts = aggregate_device_ips(self._iter_ninja_devices())
+
             # Convert to IPConfig objects and add to database
-            for _, row in ip_counts.iterrows():
+            for row in ip_counts:
                 ip_config = IPConfig(
                     ip_address=row['publicIP'],
                     client_name=row['references.organization.name'],
@@ -112,18 +356,32 @@ class DatabaseManager:
                     is_static_ip=True
                 )
                 self.add_ip(ip_config)
-            
-            return ip_counts.to_dict(orient='records')
+
+            return ip_counts
         except Exception as e:
             print(f"Error syncing from NinjaRMM: {e}")
             return []
 
+    def _iter_ninja_devices(self, page_size: int = NINJA_DEVICE_PAGE_SIZE) -> Iterator[Dict[str, Any]]:
+        """Stream detailed devices from NinjaRMM one page at a time"""
+        after = None
+        while True:
+            page = self.ninja.get_devices_detailed(
+                page_size=page_size,
+                after=after,
+                expand='organization,location'
+            )
+            yield from page
+            if len(page) < page_size:
+                break
+            after = page[-1]['id']
+
     def add_ip(self, ip_config: IPConfig):
         """Add or update an IP configuration"""
         conn = self.get_connection()
         try:
             with conn.cursor() as cursor:
-                cursor.execute('''
+                self._execute(cursor, 'add_ip', '''
                     INSERT INTO allowed_ips 
                     (ip_address, device_name, client_name, location_name, is_static_ip, push_url)
                     VALUES (%s, %s, %s, %s, %s, %s)
@@ -144,59 +402,258 @@ class DatabaseManager:
             conn.commit()
         finally:
             conn.close()
+        self._invalidate_ip(ip_config.ip_address)
 
     def remove_ip(self, ip_address: str):
         """Remove an IP address from the allowed list"""
         conn = self.get_connection()
         try:
             with conn.cursor() as cursor:
-                cursor.execute("DELETE FROM allowed_ips WHERE ip_address = %s", (ip_address,))
+                self._execute(cursor, 'remove_ip', "DELETE FROM allowed_ips WHERE ip_address = %s", (ip_address,))
             conn.commit()
         finally:
             conn.close()
+        self._invalidate_ip(ip_address)
+
+    def _invalidate_ip(self, ip_address: str):
+        """Drop cached lookups for an IP after it was written, here and in every listening process"""
+        self._drop_cached_ip(ip_address)
+        try:
+            self.redis_client.publish(IP_INVALIDATION_CHANNEL, ip_address)
+        except redis.RedisError as e:
+            print(f"Error announcing IP cache invalidation for {ip_address}: {e}")
+
+    def start_invalidation_listener(self):
+        """Drop cached lookups when another process writes allowed_ips"""
+        if self._pubsub_thread:
+            return
+        try:
+            self._pubsub = self.redis_client.pubsub(ignore_subscribe_messages=True)
+            self._pubsub.subscribe(**{IP_INVALIDATION_CHANNEL: self._handle_invalidation_message})
+        except redis.RedisError as e:
+            # Lookups still expire after IP_CACHE_TTL
+            print(f"Error subscribing to IP cache invalidations: {e}")
+            self._pubsub = None
+            return
+        self._pubsub_thread = self._pubsub.run_in_thread(
+            sleep_time=1,
+            daemon=True,
+            exception_handler=self._handle_pubsub_error
+        )
+
+    def stop_invalidation_listener(self):
+        """Stop listening for IP cache invalidations"""
+        if self._pubsub_thread:
+            self._pubsub_thread.stop()
+            self._pubsub_thread = None
+        if self._pubsub:
+            self._pubsub.close()
+            self._pubsub = None
+
+    def _handle_invalidation_message(self, message):
+        self._drop_cached_ip(message['data'].decode())
+
+    def _drop_cached_ip(self, ip_address: str):
+        # Invalidating first makes a reconcile listing from before the write discard its index
+        self.ip_cache.invalidate(('webhook_url', ip_address), ('ip_details', ip_address))
+        self.snapshot_index.pop(ip_address, None)
+
+    def _handle_pubsub_error(self, error, pubsub, thread):
+        # Invalidations may have been lost while disconnected. The snapshot index is
+        # kept as a fallback for MariaDB and is corrected by the next reconcile
+        print(f"IP cache invalidation channel error, clearing cache: {error}")
+        self.ip_cache.invalidate()
+        time.sleep(1)
+
+    def get_cache_stats(self) -> Dict[str, Any]:
+        """Get hit/miss statistics of the IP lookup cache"""
+        return self.ip_cache.stats()
+
+    def load_snapshot(self, path: str = IP_SNAPSHOT_PATH) -> bool:
+        """
+        Load the allowed_ips snapshot into the index that cache misses read first.
+
+        Returns:
+            True if a snapshot of the current version was loaded
+        """
+        try:
+            with open(path, 'rb') as f:
+                snapshot = msgpack.unpackb(f.read())
+        except FileNotFoundError:
+            return False
+        except (OSError, ValueError, msgpack.UnpackException) as e:
+            print(f"Ignoring unreadable IP snapshot {path}: {e}")
+            return False
+
+        if snapshot.get('version') != IP_SNAPSHOT_VERSION:
+            print(f"Ignoring IP snapshot {path} with version {snapshot.get('version')}")
+            return False
+
+        columns = snapshot['columns']
+        ip_configs = (IPConfig(**dict(zip(columns, row))) for row in snapshot['rows'])
+        self.snapshot_index = {ip_config.ip_address: ip_config for ip_config in ip_configs}
+        return True
+
+    def write_snapshot(self, ip_configs: List[IPConfig], path: str = IP_SNAPSHOT_PATH):
+        """Atomically write a compact snapshot of the given IP configurations"""
+        columns = [f.name for f in fields(IPConfig)]
+        payload = msgpack.packb({
+            'version': IP_SNAPSHOT_VERSION,
+            'written_at': time.time(),
+            'columns': columns,
+            'rows': [[getattr(ip_config, column) for column in columns] for ip_config in ip_configs]
+        })
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(payload)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+
+    def reconcile_snapshot(self, path: str = IP_SNAPSHOT_PATH) -> bool:
+        """
+        Reload allowed_ips from the database into the snapshot index and rewrite the snapshot.
+
+        Returns False, changing nothing, if an IP was written while listing,
+        since the listing may predate the write. The next reconcile retries.
+        """
+        generation = self.ip_cache.generation
+        ip_configs = list(self.iter_ips())
+        index = {ip_config.ip_address: ip_config for ip_config in ip_configs}
+        if not self.ip_cache.run_unless_invalidated(generation, lambda: setattr(self, 'snapshot_index', index)):
+            return False
+        self.write_snapshot(ip_configs, path)
+        return True
+
+    def start_snapshot_sync(self, interval: float = IP_SNAPSHOT_INTERVAL, path: str = IP_SNAPSHOT_PATH):
+        """
+        Reconcile with the database in a background thread, then every interval
+        seconds. The thread also publishes the slow-query log every
+        SLOW_QUERY_PUBLISH_INTERVAL seconds, keeping Redis off the query path.
+        """
+        if self._snapshot_thread and self._snapshot_thread.is_alive():
+            return
+
+        def run():
+            reconcile_at = time.monotonic()
+            while not self._snapshot_stop.is_set():
+                if time.monotonic() >= reconcile_at:
+                    try:
+                        self.reconcile_snapshot(path)
+                    except Exception as e:
+                        print(f"Error reconciling IP snapshot: {e}")
+                    reconcile_at = time.monotonic() + interval
+                self.publish_slow_queries()
+                self._snapshot_stop.wait(max(0.0, min(SLOW_QUERY_PUBLISH_INTERVAL, reconcile_at - time.monotonic())))
+
+        self._snapshot_stop.clear()
+        self._snapshot_thread = threading.Thread(target=run, name="ip-snapshot-sync", daemon=True)
+        self._snapshot_thread.start()
+
+    def stop_snapshot_sync(self):
+        """Stop the background snapshot reconciliation and slow-query log publishing"""
+        self._snapshot_stop.set()
 
     def get_all_ips(self) -> List[IPConfig]:
         """Get all allowed IP configurations"""
+        return list(self.iter_ips())
+
+    def get_ips_page(self, cursor: int = 0, limit: int = IP_PAGE_DEFAULT_LIMIT) -> Tuple[List[IPConfig], Optional[int]]:
+        """
+        Get one page of allowed IP configurations ordered by id.
+
+        Args:
+            cursor: Only rows with an id greater than this are returned
+            limit: Maximum number of rows to return
+
+        Returns:
+            The page and the cursor for the next page, or None on the last page
+        """
+        limit = max(1, min(limit, IP_PAGE_MAX_LIMIT))
         conn = self.get_connection()
         try:
-            with conn.cursor() as cursor:
-                cursor.execute('''
-                    SELECT ip_address, device_name, client_name, location_name, 
-                           is_static_ip, push_url 
+            with conn.cursor() as db_cursor:
+                self._execute(db_cursor, 'get_ips_page', '''
+                    SELECT id, ip_address, device_name, client_name, location_name,
+                           is_static_ip, push_url
                     FROM allowed_ips
-                ''')
-                rows = cursor.fetchall()
-                return [IPConfig(**row) for row in rows]
+                    WHERE id > %s
+                    ORDER BY id
+                    LIMIT %s
+                ''', (cursor, limit))
+                rows = db_cursor.fetchall()
         finally:
             conn.close()
 
+        next_cursor = rows[-1]['id'] if len(rows) == limit else None
+        return [IPConfig(**{k: v for k, v in row.items() if k != 'id'}) for row in rows], next_cursor
+
+    def iter_ips(self, chunk_size: int = IP_PAGE_DEFAULT_LIMIT) -> Iterator[IPConfig]:
+        """Stream all allowed IP configurations, fetching chunk_size rows at a time"""
+        cursor = 0
+        while cursor is not None:
+            page, cursor = self.get_ips_page(cursor, chunk_size)
+            yield from page
+
     def is_ip_allowed(self, ip_address: str) -> bool:
         """Check if an IP address is in the allowed list"""
         conn = self.get_connection()
         try:
             with conn.cursor() as cursor:
-                cursor.execute("SELECT 1 FROM allowed_ips WHERE ip_address = %s", (ip_address,))
+                self._execute(cursor, 'is_ip_allowed', "SELECT 1 FROM allowed_ips WHERE ip_address = %s", (ip_address,))
                 return cursor.fetchone() is not None
         finally:
             conn.close()
 
     def get_webhook_url(self, ip_address: str) -> str:
         """Get the webhook URL for an IP address"""
-        conn = self.get_connection()
+        return self.ip_cache.get_or_load(
+            ('webhook_url', ip_address),
+            lambda: self._fetch_webhook_url(ip_address)
+        )
+
+    def _fetch_webhook_url(self, ip_address: str) -> str:
+        ip_config = self.snapshot_index.get(ip_address)
+        if ip_config is not None:
+            return ip_config.push_url
+        try:
+            conn = self.get_connection()
+        except mariadb.Error:
+            if not self.snapshot_index:
+                raise
+            return ""
         try:
             with conn.cursor() as cursor:
-                cursor.execute("SELECT push_url FROM allowed_ips WHERE ip_address = %s", (ip_address,))
+                self._execute(cursor, 'get_webhook_url', "SELECT push_url FROM allowed_ips WHERE ip_address = %s", (ip_address,))
                 result = cursor.fetchone()
                 return result['push_url'] if result else ""
         finally:
             conn.close()
 
-    def get_ip_details(self, ip_address: str) -> IPConfig:
+    def get_ip_details(self, ip_address: str) -> Optional[IPConfig]:
         """Get detailed information about an allowed IP"""
-        conn = self.get_connection()
+        return self.ip_cache.get_or_load(
+            ('ip_details', ip_address),
+            lambda: self._fetch_ip_details(ip_address)
+        )
+
+    def _fetch_ip_details(self, ip_address: str) -> Optional[IPConfig]:
+        ip_config = self.snapshot_index.get(ip_address)
+        if ip_config is not None:
+            return ip_config
+        try:
+            conn = self.get_connection()
+        except mariadb.Error:
+            if not self.snapshot_index:
+                raise
+            return None
         try:
             with conn.cursor() as cursor:
-                cursor.execute('''
+                self._execute(cursor, 'get_ip_details', '''
                     SELECT ip_address, device_name, client_name, location_name, 
                            is_static_ip, push_url 
                     FROM allowed_ips 
@@ -6,6 +6,7 @@ from api import app
 from db_manager import DatabaseManager
 from cache_manager import CacheSync
 from tcp_monitor import TCPMonitor
+from metrics import monitor_loop_lag
 from sqlalchemy import create_engine
 
 def run_api():
@@ -33,7 +34,15 @@ async def main():
     """Main application entry point"""
     # Initialize database manager
     db = DatabaseManager()
+
+    # Keep the local allowed_ips snapshot and lookup cache in sync with MariaDB
+    db.start_snapshot_sync()
+    # Drop cached lookups when the API process writes allowed_ips
+    db.start_invalidation_listener()
     
+    # Lag of the loop shared by the TCP server and cache sync
+    lag_task = asyncio.create_task(monitor_loop_lag())
+
     # Start cache sync
     cache_sync_task = asyncio.create_task(run_cache_sync())
     
@@ -41,11 +50,14 @@ async def main():
     await run_tcp_monitor(db)
     
     # Cleanup
-    cache_sync_task.cancel()
-    try:
-        await cache_sync_task
-    except asyncio.CancelledError:
-        pass
+    db.stop_snapshot_sync()
+    db.stop_invalidation_listener()
+    for task in (cache_sync_task, lag_task):
+        task.cancel()
+        try:
+            await task
+        except asyncio.CancelledError:
+            pass
 
 if __name__ == "__main__":
     # Start API server in a separate process
@@ -0,0 +1,118 @@
+import asyncio
+import bisect
+import threading
+from typing import Dict, Optional, Tuple
+
+# Upper bounds in seconds, suitable for query and refresh latencies
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# Finer at the low end, where event loop lag should stay
+LOOP_LAG_BUCKETS = (0.0005, 0.001, 0.002, 0.003, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+
+class Counter:
+    """Monotonically increasing value"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.value = 0.0
+
+    def inc(self, amount: float = 1) -> None:
+        with self._lock:
+            self.value += amount
+
+    def snapshot(self) -> Dict[str, float]:
+        return {'value': self.value}
+
+class Gauge:
+    """Value that can go up and down"""
+
+    def __init__(self):
+        self.value = 0.0
+
+    def set(self, value: float) -> None:
+        self.value = value
+
+    def snapshot(self) -> Dict[str, float]:
+        return {'value': self.value}
+
+class Histogram:
+    """Distribution of observed values over fixed buckets"""
+
+    def __init__(self, buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        self.buckets = tuple(sorted(buckets))
+        self._counts = [0] * (len(self.buckets) + 1)
+        self._lock = threading.Lock()
+        self.count = 0
+        self.sum = 0.0
+        self.min: Optional[float] = None
+        self.max: Optional[float] = None
+
+    def observe(self, value: float) -> None:
+        with self._lock:
+            self._counts[bisect.bisect_left(self.buckets, value)] += 1
+            self.count += 1
+            self.sum += value
+            self.min = value if self.min is None else min(self.min, value)
+            self.max = value if self.max is None else max(self.max, value)
+
+    def snapshot(self) -> Dict[str, object]:
+        """Return count, sum, min/max and cumulative bucket counts"""
+        with self._lock:
+            cumulative = 0
+            buckets = {}
+            for bound, count in zip(self.buckets + (float('inf'),), self._counts):
+                cumulative += count
+                buckets['+Inf' if bound == float('inf') else str(bound)] = cumulative
+            return {
+                'count': self.count,
+                'sum': self.sum,
+                'min': self.min,
+                'max': self.max,
+                'buckets': buckets
+            }
+
+class MetricsRegistry:
+    """Process-local collection of named, labelled metrics"""
+
+    def __init__(self):
+        self._metrics: Dict[Tuple[str, Tuple[Tuple[str, str], ...]], object] = {}
+        self._lock = threading.Lock()
+
+    def _get(self, name: str, labels: Optional[Dict[str, str]], factory):
+        key = (name, tuple(sorted((labels or {}).items())))
+        metric = self._metrics.get(key)
+        if metric is None:
+            with self._lock:
+                metric = self._metrics.setdefault(key, factory())
+        return metric
+
+    def counter(self, name: str, labels: Optional[Dict[str, str]] = None) -> Counter:
+        return self._get(name, labels, Counter)
+
+    def gauge(self, name: str, labels: Optional[Dict[str, str]] = None) -> Gauge:
+        return self._get(name, labels, Gauge)
+
+    def histogram(self, name: str, labels: Optional[Dict[str, str]] = None,
+                  buckets: Tuple[float, ...] = DEFAULT_BUCKETS) -> Histogram:
+        return self._get(name, labels, lambda: Histogram(buckets))
+
+    def snapshot(self, prefix: str = "") -> Dict[str, list]:
+        """Return every metric whose name starts with prefix, grouped by name"""
+        result: Dict[str, list] = {}
+        for (name, labels), metric in list(self._metrics.items()):
+            if name.startswith(prefix):
+                result.setdefault(name, []).append({'labels': dict(labels), **metric.snapshot()})
+        return result
+
+REGISTRY = MetricsRegistry()
+
+async def monitor_loop_lag(interval: float = 0.1, registry: MetricsRegistry = REGISTRY) -> None:
+    """Record how late the running event loop wakes up from sleep(interval), until cancelled"""
+    loop = asyncio.get_running_loop()
+    histogram = registry.histogram('event_loop_lag_seconds', buckets=LOOP_LAG_BUCKETS)
+    gauge = registry.gauge('event_loop_lag_max_seconds')
+    while True:
+        started = loop.time()
+        await asyncio.sleep(interval)
+        lag = max(0.0, loop.time() - started - interval)
+        histogram.observe(lag)
+        gauge.set(max(gauge.value, lag))
@@ -1,14 +1,23 @@
 import os
 import time
 import logging
-from typing import Optional
+from typing import Dict, List, Optional, Set, Tuple
+import pandas as pd
 from pymysqlreplication import BinLogStreamReader
+from pymysqlreplication.event import HeartbeatLogEvent, XidEvent
 from pymysqlreplication.row_event import (
     WriteRowsEvent,
     UpdateRowsEvent,
     DeleteRowsEvent
 )
-from cache_manager import HeartbeatCache
+from cache_manager import (
+    HEARTBEAT_COLUMNS,
+    HEARTBEAT_MONITOR_COLUMNS,
+    HEARTBEAT_REFRESH_WAIT,
+    HeartbeatCache,
+    compact_frame
+)
+from metrics import REGISTRY
 from db_manager import DB_CONFIG
 
 # Configure logging
@@ -21,13 +30,95 @@ logging.basicConfig(
     ]
 )
 
+# Replica server id this consumer registers with; must be unique among the server's replicas
+BINLOG_SERVER_ID = int(os.getenv('BINLOG_SERVER_ID', 100))
+# Seconds between checkpoints of the processed binlog position to Redis
+BINLOG_CHECKPOINT_INTERVAL = float(os.getenv('BINLOG_CHECKPOINT_INTERVAL', 1))
+# After resuming, catch-up is over once events are at most this many seconds old
+BINLOG_CATCHUP_LAG = float(os.getenv('BINLOG_CATCHUP_LAG', 5))
+# Seconds of binlog silence after which the server sends a heartbeat, so pending batches still get applied
+BINLOG_HEARTBEAT_INTERVAL = float(os.getenv('BINLOG_HEARTBEAT_INTERVAL', 1))
+
+# Row events are coalesced for this long and then applied to the cache in one go
+BINLOG_BATCH_WINDOW_MS = int(os.getenv('BINLOG_BATCH_WINDOW_MS', 250))
+BATCH_SIZE_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 5000)
+
+# MariaDB error for a binlog file that is no longer on the server
+ER_MASTER_FATAL_ERROR_READING_BINLOG = 1236
+
+class RowBatch:
+    """
+    Heartbeat row changes coalesced by heartbeat id over a batch window.
+
+    Only the first before image and the last after image of every row are
+    kept, so a row inserted and updated within a batch is applied as one
+    insert, and one inserted and deleted is not applied at all.
+    """
+
+    def __init__(self):
+        self.started = time.monotonic()
+        self.events = 0
+        self.rows = 0
+        # Set while the batch has rows of a transaction that has not committed yet
+        self.open = False
+        # Set once a row lacks the columns needed to place it in the cache
+        self.unplaceable = False
+        self.monitor_ids: Set[int] = set()
+        # id -> image before the batch (None if inserted in it) and after it (None if deleted)
+        self.before: Dict[int, Optional[dict]] = {}
+        self.after: Dict[int, Optional[dict]] = {}
+
+    def add(self, binlogevent):
+        """Fold the rows of one event into the batch."""
+        self.events += 1
+        self.rows += len(binlogevent.rows)
+        self.open = True
+        for row in binlogevent.rows:
+            if isinstance(binlogevent, UpdateRowsEvent):
+                before, after = row['before_values'], row['after_values']
+            elif isinstance(binlogevent, DeleteRowsEvent):
+                before, after = row['values'], None
+            else:
+                before, after = None, row['values']
+            images = [image for image in (before, after) if image is not None]
+            if any(image.get(column) is None for image in images for column in ('id', 'monitor_id', 'time')):
+                self.unplaceable = True
+                continue
+            self.monitor_ids.update(int(image['monitor_id']) for image in images)
+            # heartbeat.id is the primary key and never changes
+            row_id = int(images[0]['id'])
+            self.before.setdefault(row_id, before)
+            self.after[row_id] = after
+
+    def frames(self) -> Dict[str, pd.DataFrame]:
+        """Net changes of the batch as the keyword arguments of HeartbeatCache.apply_changes."""
+        images: Dict[str, List[dict]] = {'inserted': [], 'updated': [], 'previous': [], 'deleted': []}
+        for row_id, after in self.after.items():
+            before = self.before[row_id]
+            if before is None:
+                if after is not None:
+                    images['inserted'].append(after)
+            elif after is None:
+                images['deleted'].append(before)
+            else:
+                images['updated'].append(after)
+                images['previous'].append(before)
+        return {name: compact_frame(self._frame(rows)) for name, rows in images.items() if rows}
+
+    @staticmethod
+    def _frame(rows: List[dict]) -> pd.DataFrame:
+        df = pd.DataFrame(rows)
+        return df[[column for column in HEARTBEAT_COLUMNS if column in df.columns]]
+
 class BinlogSyncService:
     """
     Service that monitors MariaDB binlog for changes to the heartbeat table
-    and invalidates the cache when changes are detected.
+    and applies them to the cached shards and aggregates of the affected monitors.
     
     This service uses MariaDB's binary log replication to track changes
-    to the heartbeat table in real-time, ensuring cache consistency.
+    to the heartbeat table in real-time, ensuring cache consistency. The
+    position of the last committed transaction it processed is checkpointed
+    to Redis, and every (re)connect resumes from there.
     """
     
     def __init__(self, cache: Optional[HeartbeatCache] = None):
@@ -39,7 +130,26 @@ class BinlogSyncService:
         """
         self.cache = cache or HeartbeatCache()
         self.running = False
+        self.lease_wait = HEARTBEAT_REFRESH_WAIT  # seconds to wait for a refresh holding the lease
+        self.batch_window = BINLOG_BATCH_WINDOW_MS / 1000  # seconds
+        self.batch: Optional[RowBatch] = None
+        # Position after the last transaction in the batch, taken over once it is applied
+        self.batch_position: Optional[Tuple[str, int]] = None
+        self.events_seen = 0
+        self.events_published = 0
+        self.metrics_interval = 10  # seconds between metrics publications
+        self.metrics_published_at = 0.0
         self.stream: Optional[BinLogStreamReader] = None
+        # Binlog position after the last processed transaction, and the one last checkpointed
+        self.log_file: Optional[str] = None
+        self.log_pos: Optional[int] = None
+        self.checkpointed: Optional[Tuple[str, int]] = None
+        self.checkpointed_at = 0.0
+        # Set while replaying the events missed since the checkpoint. Only the first
+        # stream and those reopened after an error replay a backlog worth measuring
+        self.replaying = True
+        self.catchup_started: Optional[float] = None
+        self.catchup_events = 0
         
         # Convert DB_CONFIG to pymysqlreplication format
         self.binlog_config = {
@@ -54,35 +164,229 @@ class BinlogSyncService:
         """Start the binlog sync service."""
         self.running = True
         logging.info("Starting binlog sync service...")
+        self.load_checkpoint()
         
         while self.running:
             try:
-                self.stream = BinLogStreamReader(
-                    connection_settings=self.binlog_config,
-                    server_id=100,  # Unique server ID for this replica
-                    only_events=[WriteRowsEvent, UpdateRowsEvent, DeleteRowsEvent],
-                    only_tables=['heartbeat']
-                )
+                self.stream = self.open_stream()
 
                 for binlogevent in self.stream:
                     if not self.running:
                         break
-                        
-                    logging.info(f"Detected {binlogevent.__class__.__name__} on heartbeat table")
-                    self.cache.invalidate()
+
+                    # Batches are only applied, and the position only moves, at transaction
+                    # boundaries, never inside one, so no transaction is ever applied in part
+                    if isinstance(binlogevent, XidEvent):
+                        self.commit(self.stream.log_file, self.stream.log_pos)
+                        self.flush(due_only=True)
+                        self.track_catchup(binlogevent)
+                    elif isinstance(binlogevent, HeartbeatLogEvent):
+                        # Only sent while there is nothing left to replay
+                        self.flush(due_only=True)
+                        self.finish_catchup()
+                    else:
+                        self.handle_event(binlogevent)
+                        self.track_catchup(binlogevent)
+                    self.checkpoint()
+                    self.publish_metrics()
                     
+                self.flush()
                 if self.running:
+                    self.finish_catchup()
                     logging.warning("Binlog stream ended, attempting to reconnect...")
                     time.sleep(5)  # Wait before reconnecting
                     
             except Exception as e:
                 logging.error(f"Error in binlog sync service: {e}")
+                self.replaying = True
+                if self.log_file is not None and e.args[:1] == (ER_MASTER_FATAL_ERROR_READING_BINLOG,):
+                    self.reset_checkpoint()
                 if self.running:
                     time.sleep(5)  # Wait before retry
             finally:
                 if self.stream:
                     self.stream.close()
                     self.stream = None
+                try:
+                    self.flush()
+                except Exception as e:
+                    # The position was not moved past the batch, so it is replayed
+                    logging.error(f"Failed to apply binlog batch: {e}")
+                self.checkpoint(force=True)
+
+    def open_stream(self) -> BinLogStreamReader:
+        """Connect to the binlog, resuming after the last processed transaction if there is one."""
+        resume = {}
+        if self.log_file is not None:
+            resume = {'resume_stream': True, 'log_file': self.log_file, 'log_pos': self.log_pos}
+            if self.replaying:
+                logging.info(f"Resuming binlog at {self.log_file}:{self.log_pos}")
+                self.catchup_started = time.monotonic()
+                self.catchup_events = 0
+        self.replaying = False
+        return BinLogStreamReader(
+            connection_settings=self.binlog_config,
+            server_id=BINLOG_SERVER_ID,
+            only_events=[WriteRowsEvent, UpdateRowsEvent, DeleteRowsEvent, XidEvent, HeartbeatLogEvent],
+            only_tables=['heartbeat'],
+            blocking=True,
+            slave_heartbeat=BINLOG_HEARTBEAT_INTERVAL,
+            **resume
+        )
+
+    def load_checkpoint(self):
+        """Pick up the position checkpointed by a previous run."""
+        try:
+            position = self.cache.get_binlog_position()
+        except Exception as e:
+            logging.warning(f"Failed to read the binlog checkpoint, starting from the current position: {e}")
+            return
+        if position is not None:
+            self.log_file, self.log_pos = position
+            self.checkpointed = position
+
+    def checkpoint(self, force: bool = False):
+        """Write the processed position to Redis, at most every BINLOG_CHECKPOINT_INTERVAL seconds unless forced."""
+        if self.log_file is None or (self.log_file, self.log_pos) == self.checkpointed:
+            return
+        now = time.monotonic()
+        if not force and now - self.checkpointed_at < BINLOG_CHECKPOINT_INTERVAL:
+            return
+        self.checkpointed_at = now
+        try:
+            self.cache.set_binlog_position(self.log_file, self.log_pos)
+            self.checkpointed = (self.log_file, self.log_pos)
+        except Exception as e:
+            logging.warning(f"Failed to checkpoint the binlog position: {e}")
+
+    def reset_checkpoint(self):
+        """Start over from the current position once the checkpointed log file has been purged."""
+        logging.warning(f"Binlog {self.log_file} is gone, resuming from the current position")
+        self.log_file = self.log_pos = self.checkpointed = None
+        self.batch_position = None
+        self.catchup_started = None
+        self.cache.clear_binlog_position()
+        # Changes in between were missed, so have CacheSync rebuild the cache
+        self.cache.invalidate()
+
+    def track_catchup(self, binlogevent):
+        """Count events replayed since resuming, until they are within BINLOG_CATCHUP_LAG of now."""
+        if self.catchup_started is None:
+            return
+        self.catchup_events += 1
+        timestamp = getattr(binlogevent, 'timestamp', None)
+        if isinstance(timestamp, (int, float)) and time.time() - timestamp <= BINLOG_CATCHUP_LAG:
+            self.finish_catchup()
+
+    def finish_catchup(self):
+        """Report the throughput of the catch-up that just ended."""
+        if self.catchup_started is None:
+            return
+        elapsed = time.monotonic() - self.catchup_started
+        rate = self.catchup_events / elapsed if elapsed > 0 else 0.0
+        self.catchup_started = None
+        REGISTRY.gauge('binlog_catchup_seconds').set(elapsed)
+        REGISTRY.gauge('binlog_catchup_events_per_second').set(rate)
+        logging.info(f"Caught up with the binlog: {self.catchup_events} events in {elapsed:.1f}s ({rate:.0f} events/s)")
+
+    def publish_metrics(self, force: bool = False):
+        """Publish this process's metrics for the API, at most every metrics_interval seconds."""
+        now = time.monotonic()
+        if not force and now - self.metrics_published_at < self.metrics_interval:
+            return
+        if self.metrics_published_at and now > self.metrics_published_at:
+            REGISTRY.gauge('binlog_events_per_second').set(
+                (self.events_seen - self.events_published) / (now - self.metrics_published_at))
+        self.events_published = self.events_seen
+        self.metrics_published_at = now
+        try:
+            self.cache.publish_metrics('binlog_sync')
+        except Exception as e:
+            logging.warning(f"Failed to publish binlog sync metrics: {e}")
+
+    def handle_event(self, binlogevent):
+        """Add a row event to the batch, which is applied at a transaction boundary once its window is over."""
+        started = time.perf_counter()
+        self.events_seen += 1
+        REGISTRY.counter('binlog_events_total', {'event': binlogevent.__class__.__name__}).inc()
+        REGISTRY.counter('binlog_rows_total').inc(len(binlogevent.rows))
+        timestamp = getattr(binlogevent, 'timestamp', None)
+        if isinstance(timestamp, (int, float)):
+            REGISTRY.gauge('binlog_lag_seconds').set(time.time() - timestamp)
+        try:
+            if self.batch is None:
+                self.batch = RowBatch()
+            self.batch.add(binlogevent)
+        finally:
+            REGISTRY.histogram('binlog_event_handle_seconds').observe(time.perf_counter() - started)
+
+    def commit(self, log_file: str, log_pos: int):
+        """Record the position after a committed transaction, once its rows have been applied."""
+        if self.batch is None:
+            self.log_file, self.log_pos = log_file, log_pos
+        else:
+            self.batch.open = False
+            self.batch_position = (log_file, log_pos)
+
+    def flush(self, due_only: bool = False):
+        """Apply the pending batch, or with due_only only if its window is over."""
+        batch = self.batch
+        if batch is None or (due_only and time.monotonic() - batch.started < self.batch_window):
+            return
+        # A batch that fails to apply is replayed from the position before it
+        self.batch, position, self.batch_position = None, self.batch_position, None
+        if batch.open:
+            if due_only:
+                # Wait for the transaction to commit
+                self.batch, self.batch_position = batch, position
+                return
+            # The stream stopped inside a transaction, which is replayed whole with the rest of the batch
+            logging.info(f"Dropped {batch.events} binlog events of an unfinished transaction")
+            return
+        started = time.perf_counter()
+        try:
+            self._apply_batch(batch, position)
+        finally:
+            REGISTRY.histogram('binlog_batch_apply_seconds').observe(time.perf_counter() - started)
+        REGISTRY.histogram('binlog_batch_events', buckets=BATCH_SIZE_BUCKETS).observe(batch.events)
+        REGISTRY.histogram('binlog_batch_rows', buckets=BATCH_SIZE_BUCKETS).observe(batch.rows)
+        if position is not None:
+            self.log_file, self.log_pos = position
+        logging.debug(f"Applied {batch.events} binlog events, {batch.rows} rows, "
+                      f"for monitors {sorted(batch.monitor_ids)}")
+
+    def _apply_batch(self, batch: RowBatch, position: Tuple[str, int]):
+        if batch.unplaceable:
+            # Without a monitor id we cannot tell which shard changed
+            REGISTRY.counter('binlog_row_changes_total', {'outcome': 'invalidated'}).inc(batch.rows)
+            self.cache.invalidate()
+            return
+        if not batch.monitor_ids:
+            return
+        frames = batch.frames()
+        # Rows from the binlog carry no monitor columns to join in
+        applied = not HEARTBEAT_MONITOR_COLUMNS and (not frames or self._apply_under_lease(frames, position))
+        REGISTRY.counter('binlog_row_changes_total', {'outcome': 'applied' if applied else 'invalidated'}) \
+            .inc(batch.rows)
+        if not applied:
+            self.cache.invalidate_monitors(batch.monitor_ids)
+
+    def _apply_under_lease(self, frames: Dict[str, pd.DataFrame], position: Optional[Tuple[str, int]] = None) -> bool:
+        """Apply changes while holding the refresh lease, so they never interleave with a CacheSync refresh."""
+        deadline = time.monotonic() + self.lease_wait
+        lease = self.cache.acquire_refresh_lease()
+        while not lease and time.monotonic() < deadline:
+            time.sleep(0.05)
+            lease = self.cache.acquire_refresh_lease()
+        if not lease:
+            logging.warning("Timed out waiting for the heartbeat cache refresh lease")
+            return False
+        try:
+            with self.cache.keep_refresh_lease(lease):
+                # With the position, the aggregates skip batches they were updated with before a crash
+                return self.cache.apply_changes(**frames, position=position)
+        finally:
+            self.cache.release_refresh_lease(lease)
 
     def stop(self):
         """Stop the binlog sync service gracefully."""
@@ -1,16 +1,30 @@
 import pytest
 from unittest.mock import Mock, patch, AsyncMock
-from datetime import datetime
+from datetime import datetime, timedelta
 import pandas as pd
 import pickle
-from cache_manager import HeartbeatCache, CacheSync
+from cache_manager import (
+    HeartbeatCache, AsyncHeartbeatCache, CacheSync, get_redis_pool, PUBLISH_INVALIDATION_SCRIPT, MaxIdProbe, AutoIncrementProbe, encode_records,
+    HEARTBEAT_GENERATION_GRACE, HeartbeatSnapshot,
+    open_segment_start, segment_datetime, segment_start, split_segments, SEGMENT_SECONDS, SEGMENT_SENTINEL,
+    aggregate_stats, latest_status, read_chunks, summarize_stats, heartbeat_query, compact_frame, HEARTBEAT_TYPES
+)
+import orjson
 import asyncio
+import time
+from metrics import REGISTRY
 
 @pytest.fixture
 def redis_mock():
     """Create a mock Redis client"""
     with patch('cache_manager.redis.Redis') as mock_redis:
         mock_client = Mock()
+        mock_client.zrange.return_value = []
+        mock_client.smembers.return_value = set()
+        # Readers are pointed at generation 1
+        mock_client.get.return_value = b'1'
+        # Next generation, then the current one's index and segment list, read before each full write
+        mock_client.pipeline.return_value.execute.return_value = [2, set(), []]
         mock_redis.return_value = mock_client
         yield mock_client
 
@@ -19,6 +33,13 @@ def heartbeat_cache(redis_mock):
     """Create a test heartbeat cache"""
     return HeartbeatCache()
 
+def stream_rows(cache_sync, *results):
+    """Serve each list of rows to one streamed heartbeat query and return the streaming cursor"""
+    cache_sync.conn = Mock()
+    stream = cache_sync.conn.cursor.return_value
+    stream.fetchmany.side_effect = [chunk for rows in results for chunk in (rows, [])]
+    return stream
+
 @pytest.fixture
 def cache_sync():
     """Create a test cache sync service"""
@@ -29,19 +50,27 @@ def cache_sync():
 def test_cache_set_get(heartbeat_cache, redis_mock):
     """Test setting and getting data from cache"""
     # Test data
-    test_df = pd.DataFrame({'test': [1, 2, 3]})
+    test_df = pd.DataFrame({'monitor_id': [1, 1, 2], 'status': [1, 0, 1], 'time': [datetime.utcnow()] * 3})
+    redis_mock.smembers.return_value = set()
     
     # Set data
     heartbeat_cache.set_data(test_df)
     
-    # Verify Redis was called correctly
-    redis_mock.setex.assert_called_once()
-    assert redis_mock.setex.call_args[0][0] == heartbeat_cache.CACHE_KEY
-    assert redis_mock.setex.call_args[0][1] == heartbeat_cache.CACHE_TTL
+    # Verify one shard and JSON fragment per monitor was written with the index
+    pipe = redis_mock.pipeline.return_value
+    setex_calls = pipe.setex.call_args_list[::2]
+    assert [c[0][0] for c in setex_calls] == [heartbeat_cache.shard_key(1, 2), heartbeat_cache.shard_key(2, 2)]
+    assert [c[0][0] for c in pipe.setex.call_args_list[1::2]] == [
+        heartbeat_cache.json_key(1, 2), heartbeat_cache.json_key(2, 2)
+    ]
+    assert all(c[0][1] == heartbeat_cache.CACHE_TTL for c in setex_calls)
+    pipe.sadd.assert_called_once_with(heartbeat_cache.index_key(2), 1, 2)
+    # One read of the current generation, then one write transaction
+    assert pipe.execute.call_count == 2
     
-    # Mock get response with pickled DataFrame
-    pickled_df = pickle.dumps(test_df)
-    redis_mock.get.return_value = pickled_df
+    # Mock get response with the payloads that were written
+    redis_mock.smembers.return_value = {b'1', b'2'}
+    redis_mock.mget.return_value = [c[0][2] for c in setex_calls]
     
     # Get data
     result = heartbeat_cache.get_data()
@@ -49,16 +78,286 @@ def test_cache_set_get(heartbeat_cache, redis_mock):
     assert isinstance(result, pd.DataFrame)
     assert len(result) == 3
 
+def test_cache_get_monitor_subset(heartbeat_cache, redis_mock):
+    """Test reading a subset of monitors only fetches their shards"""
+    redis_mock.smembers.return_value = {b'1', b'2', b'3'}
+    redis_mock.mget.return_value = [heartbeat_cache.serialize(pd.DataFrame({'monitor_id': [2], 'status': [1]}))]
+
+    result = heartbeat_cache.get_data(monitor_ids=[2, 9])
+
+    redis_mock.mget.assert_called_once_with([heartbeat_cache.shard_key(2, 1)])
+    assert result['monitor_id'].tolist() == [2]
+
+def test_cache_missing_shard_is_a_miss(heartbeat_cache, redis_mock):
+    """Test an invalidated shard makes full reads miss"""
+    redis_mock.smembers.return_value = {b'1', b'2'}
+    redis_mock.mget.return_value = [heartbeat_cache.serialize(pd.DataFrame({'monitor_id': [1]})), None]
+
+    assert heartbeat_cache.get_data() is None
+
+def test_cache_arrow_column_projection(heartbeat_cache, redis_mock):
+    """Test Arrow payloads can be read back with only some columns"""
+    test_df = pd.DataFrame({'monitor_id': [1, 2], 'status': [1, 0], 'msg': ['up', 'down']})
+    payload = heartbeat_cache.serialize(test_df)
+    assert payload.startswith(b'ARROW1')
+    redis_mock.smembers.return_value = {b'1'}
+    redis_mock.mget.return_value = [payload]
+
+    result = heartbeat_cache.get_data(columns=['monitor_id', 'status'])
+
+    assert list(result.columns) == ['monitor_id', 'status']
+    assert result['status'].tolist() == [1, 0]
+
+def test_cache_arrow_mode_refuses_pickle(heartbeat_cache, redis_mock):
+    """Test pickle payloads are never unpickled in arrow mode"""
+    redis_mock.smembers.return_value = {b'1'}
+    redis_mock.mget.return_value = [pickle.dumps(pd.DataFrame({'monitor_id': [1]}))]
+
+    assert heartbeat_cache.get_data() is None
+
+def test_cache_pickle_mode(redis_mock):
+    """Test pickle mode still writes pickles and reads both formats"""
+    cache = HeartbeatCache(serialization='pickle')
+    test_df = pd.DataFrame({'monitor_id': [1, 1, 1], 'time': [datetime.utcnow()] * 3})
+    redis_mock.smembers.return_value = set()
+
+    cache.set_data(test_df)
+    payload = redis_mock.pipeline.return_value.setex.call_args_list[0][0][2]
+    assert pickle.loads(payload)['monitor_id'].tolist() == [1, 1, 1]
+
+    redis_mock.smembers.return_value = {b'1'}
+    redis_mock.mget.return_value = [HeartbeatCache(serialization='arrow').serialize(test_df)]
+    assert cache.get_data()['monitor_id'].tolist() == [1, 1, 1]
+
 def test_cache_invalidate(heartbeat_cache, redis_mock):
-    """Test cache invalidation"""
+    """Test a full invalidation marks the cache stale but keeps serving it"""
     heartbeat_cache.invalidate()
-    
-    # Verify both keys were deleted
-    assert redis_mock.delete.call_count == 2
-    delete_calls = redis_mock.delete.call_args_list
-    delete_keys = [call[0][0] for call in delete_calls]
-    assert heartbeat_cache.CACHE_KEY in delete_keys
-    assert heartbeat_cache.LAST_UPDATE_KEY in delete_keys
+
+    # Only the last update goes, which makes CacheSync rebuild
+    redis_mock.delete.assert_called_once_with(heartbeat_cache.LAST_UPDATE_KEY)
+    redis_mock.pipeline.return_value.delete.assert_not_called()
+
+    redis_mock.smembers.return_value = {b'1'}
+    redis_mock.mget.return_value = [heartbeat_cache.serialize(pd.DataFrame({'monitor_id': [1]}))]
+    assert heartbeat_cache.get_data()['monitor_id'].tolist() == [1]
+
+def test_cache_invalidate_monitor(heartbeat_cache, redis_mock):
+    """Test invalidating one monitor only drops its shard and JSON fragment"""
+    heartbeat_cache.invalidate(monitor_id=3)
+
+    pipe = redis_mock.pipeline.return_value
+    pipe.delete.assert_called_once_with(heartbeat_cache.shard_key(3, 1), heartbeat_cache.json_key(3, 1))
+    pipe.execute.assert_called_once()
+
+def test_cache_invalidate_monitors(heartbeat_cache, redis_mock):
+    """Test several monitors are invalidated in one transaction with one message"""
+    heartbeat_cache.invalidate_monitors([5, 3, 5])
+
+    pipe = redis_mock.pipeline.return_value
+    pipe.delete.assert_called_once_with(heartbeat_cache.shard_key(3, 1), heartbeat_cache.json_key(3, 1),
+                                        heartbeat_cache.shard_key(5, 1), heartbeat_cache.json_key(5, 1))
+    pipe.eval.assert_called_once_with(PUBLISH_INVALIDATION_SCRIPT, 1, heartbeat_cache.VERSION_KEY,
+                                      heartbeat_cache.INVALIDATION_CHANNEL, '3,5')
+    pipe.execute.assert_called_once()
+
+def test_set_data_switches_generation(heartbeat_cache, redis_mock):
+    """Test a full write fills a new generation, switches to it and lets the old one expire"""
+    pipe = redis_mock.pipeline.return_value
+    pipe.execute.return_value = [2, {b'7'}, [b'3600']]
+
+    heartbeat_cache.set_data(pd.DataFrame({'monitor_id': [1], 'time': [datetime.utcnow()]}))
+
+    pipe.incr.assert_called_once_with(heartbeat_cache.GENERATION_KEY)
+    pipe.smembers.assert_called_once_with(heartbeat_cache.index_key(1))
+    pipe.set.assert_called_once_with(heartbeat_cache.CURRENT_KEY, 2)
+    assert all(c[0][0].startswith(heartbeat_cache.generation_key(2) + ':') for c in pipe.setex.call_args_list)
+    retired = {c[0][0] for c in pipe.expire.call_args_list if c[0][1] == HEARTBEAT_GENERATION_GRACE}
+    assert {heartbeat_cache.shard_key(7, 1), heartbeat_cache.json_key(7, 1), heartbeat_cache.segment_key(3600, 1),
+            heartbeat_cache.index_key(1), heartbeat_cache.open_segment_key(1)} <= retired
+    pipe.delete.assert_not_called()
+
+def test_first_set_data_retires_nothing(heartbeat_cache, redis_mock):
+    """Test the first full write only hands out a generation"""
+    redis_mock.get.return_value = None
+    pipe = redis_mock.pipeline.return_value
+    pipe.execute.return_value = [1]
+
+    heartbeat_cache.set_data(pd.DataFrame({'monitor_id': [1], 'time': [datetime.utcnow()]}))
+
+    pipe.smembers.assert_not_called()
+    pipe.set.assert_called_once_with(heartbeat_cache.CURRENT_KEY, 1)
+
+def test_reads_miss_without_generation(heartbeat_cache, redis_mock):
+    """Test nothing is read or written per monitor before the first full write"""
+    redis_mock.get.return_value = None
+
+    assert heartbeat_cache.get_data() is None
+    heartbeat_cache.set_monitor_data(3, pd.DataFrame({'monitor_id': [3]}))
+
+    redis_mock.smembers.assert_not_called()
+    redis_mock.pipeline.return_value.setex.assert_not_called()
+
+def test_cache_counts_hits_and_misses(heartbeat_cache, redis_mock):
+    """Test lookups are counted as hits or misses per payload kind"""
+    hits = REGISTRY.counter('heartbeat_cache_hits_total', {'kind': 'frame'})
+    misses = REGISTRY.counter('heartbeat_cache_misses_total', {'kind': 'frame'})
+    before = (hits.value, misses.value)
+    redis_mock.smembers.return_value = {b'1'}
+    redis_mock.mget.return_value = [heartbeat_cache.serialize(pd.DataFrame({'monitor_id': [1]}))]
+
+    heartbeat_cache.get_data()
+    redis_mock.mget.return_value = [None]
+    heartbeat_cache.get_data()
+
+    assert (hits.value - before[0], misses.value - before[1]) == (1, 1)
+
+def test_cache_observes_payload_sizes(heartbeat_cache, redis_mock):
+    """Test written payload sizes land in the payload histogram"""
+    histogram = REGISTRY.histogram('heartbeat_cache_payload_bytes', {'kind': 'frame', 'segment': 'open'})
+    before = histogram.count
+
+    heartbeat_cache.set_monitor_data(3, pd.DataFrame({'monitor_id': [3]}))
+
+    assert histogram.count == before + 1
+
+def test_split_segments_by_hour():
+    """Test heartbeats are grouped into hourly segments before the open one"""
+    test_df = pd.DataFrame({
+        'monitor_id': [1, 1, 2, 1],
+        'time': pd.to_datetime(['2024-01-01 10:05', '2024-01-01 10:55', '2024-01-01 11:30', '2024-01-01 12:01'])
+    })
+
+    segments, open_rows = split_segments(test_df, segment_start(datetime(2024, 1, 1, 12)))
+
+    assert sorted(segments) == [segment_start(datetime(2024, 1, 1, 10)), segment_start(datetime(2024, 1, 1, 11))]
+    assert len(segments[segment_start(datetime(2024, 1, 1, 10))]) == 2
+    assert open_rows['time'].tolist() == [pd.Timestamp('2024-01-01 12:01')]
+    assert segment_datetime(segment_start(datetime(2024, 1, 1, 10, 30))) == datetime(2024, 1, 1, 10)
+
+def test_set_data_seals_past_hours(heartbeat_cache, redis_mock):
+    """Test closed hours are written once to segment hashes and the open hour to shards"""
+    redis_mock.smembers.return_value = set()
+    open_time = segment_datetime(open_segment_start())
+    old_time = open_time - timedelta(hours=2)
+    heartbeat_cache.set_data(pd.DataFrame({
+        'monitor_id': [1, 2, 1],
+        'time': [old_time, old_time, open_time]
+    }))
+
+    pipe = redis_mock.pipeline.return_value
+    old_start = segment_start(old_time)
+    mapping = pipe.hset.call_args_list[0].kwargs['mapping']
+    assert pipe.hset.call_args_list[0][0][0] == heartbeat_cache.segment_key(old_start, 2)
+    assert sorted(key for key in mapping if key != SEGMENT_SENTINEL) == [1, 2]
+    assert 0 < pipe.expire.call_args_list[1][0][1] <= 24 * 3600 + 2 * SEGMENT_SECONDS
+    pipe.zadd.assert_called_once_with(heartbeat_cache.segments_key(2), {old_start: old_start})
+    assert pipe.mset.call_args[0][0][heartbeat_cache.open_segment_key(2)] == open_segment_start()
+    # Monitor 2 has no open rows but still gets an (empty) shard
+    shards = {c[0][0]: c[0][2] for c in pipe.setex.call_args_list}
+    assert len(heartbeat_cache.deserialize(shards[heartbeat_cache.shard_key(1, 2)])) == 1
+    assert heartbeat_cache.deserialize(shards[heartbeat_cache.shard_key(2, 2)]).empty
+
+def test_get_data_assembles_segments(heartbeat_cache, redis_mock):
+    """Test reads join sealed segments and the open segment per monitor in time order"""
+    hour = 3600 * 1000
+    redis_mock.smembers.return_value = {b'1', b'2'}
+    redis_mock.zrange.return_value = [str(hour).encode(), str(hour + 3600).encode()]
+    frame = lambda monitor_id, status: heartbeat_cache.serialize(pd.DataFrame({'monitor_id': [monitor_id], 'status': [status]}))
+    redis_mock.mget.return_value = [frame(1, 3), frame(2, 3)]
+    pipe = redis_mock.pipeline.return_value
+    pipe.execute.return_value = [[b'', frame(1, 1), None], [b'', frame(1, 2), frame(2, 2)]]
+
+    result = heartbeat_cache.get_data()
+
+    assert pipe.hmget.call_args_list[0][0] == (heartbeat_cache.segment_key(hour, 1), SEGMENT_SENTINEL, 1, 2)
+    assert result['monitor_id'].tolist() == [1, 1, 1, 2, 2]
+    assert result['status'].tolist() == [1, 2, 3, 2, 3]
+
+def test_get_data_since_skips_older_segments(heartbeat_cache, redis_mock):
+    """Test range reads only fetch the segments they need"""
+    hour = 3600 * 1000
+    redis_mock.smembers.return_value = {b'1'}
+    redis_mock.zrange.return_value = [str(hour).encode(), str(hour + 3600).encode()]
+    redis_mock.mget.return_value = [heartbeat_cache.encode_json_fragment(pd.DataFrame({'monitor_id': [1]}))]
+    pipe = redis_mock.pipeline.return_value
+    pipe.execute.return_value = [[b'', heartbeat_cache.encode_json_fragment(pd.DataFrame({'monitor_id': [1]}))]]
+
+    body = heartbeat_cache.get_json(since=segment_datetime(hour + 3600) + timedelta(minutes=30))
+
+    pipe.hmget.assert_called_once_with(heartbeat_cache.segment_json_key(hour + 3600, 1), SEGMENT_SENTINEL, 1)
+    assert orjson.loads(body) == [{'monitor_id': 1}, {'monitor_id': 1}]
+
+def test_missing_segment_is_a_miss(heartbeat_cache, redis_mock):
+    """Test a listed segment that has gone missing makes the read miss"""
+    redis_mock.smembers.return_value = {b'1'}
+    redis_mock.zrange.return_value = [b'3600000']
+    redis_mock.mget.return_value = [heartbeat_cache.serialize(pd.DataFrame({'monitor_id': [1]}))]
+    redis_mock.pipeline.return_value.execute.return_value = [[None, None]]
+
+    assert heartbeat_cache.get_data() is None
+
+def test_read_retries_when_sealed_meanwhile(heartbeat_cache, redis_mock):
+    """Test the open segment is read again if a seal happened during the read"""
+    redis_mock.smembers.return_value = {b'1'}
+    redis_mock.zrange.side_effect = [[], [b'3600000'], [b'3600000'], [b'3600000']]
+    redis_mock.mget.return_value = [heartbeat_cache.serialize(pd.DataFrame({'monitor_id': [1]}))]
+    redis_mock.pipeline.return_value.execute.return_value = [[b'', None]]
+
+    assert len(heartbeat_cache.get_data()) == 1
+    assert redis_mock.mget.call_count == 2
+
+def test_seal_segments(heartbeat_cache, redis_mock):
+    """Test sealing moves closed hours out of the open shards"""
+    open_start = open_segment_start()
+    open_time = segment_datetime(open_start)
+    redis_mock.smembers.return_value = {b'1'}
+    redis_mock.mget.return_value = [heartbeat_cache.serialize(pd.DataFrame({
+        'monitor_id': [1, 1], 'time': [open_time - timedelta(minutes=1), open_time]
+    }))]
+
+    assert heartbeat_cache.seal_segments(open_start) is True
+
+    pipe = redis_mock.pipeline.return_value
+    assert pipe.hset.call_args_list[0][0][0] == heartbeat_cache.segment_key(open_start - SEGMENT_SECONDS, 1)
+    shard = pipe.setex.call_args_list[0][0][2]
+    assert heartbeat_cache.deserialize(shard)['time'].tolist() == [pd.Timestamp(open_time)]
+    pipe.eval.assert_called_once_with(PUBLISH_INVALIDATION_SCRIPT, 1, heartbeat_cache.VERSION_KEY,
+                                      heartbeat_cache.INVALIDATION_CHANNEL, 'seal')
+
+def test_encode_records_handles_timestamps_and_missing_values():
+    """Test records encode like FastAPI's encoder would have produced them"""
+    test_df = pd.DataFrame({
+        'monitor_id': [1, 2],
+        'ping': [12.5, float('nan')],
+        'time': pd.to_datetime(['2024-01-01 10:00:00', None])
+    })
+
+    assert orjson.loads(encode_records(test_df)) == [
+        {'monitor_id': 1, 'ping': 12.5, 'time': '2024-01-01T10:00:00'},
+        {'monitor_id': 2, 'ping': None, 'time': None}
+    ]
+
+def test_cache_get_json_joins_fragments(heartbeat_cache, redis_mock):
+    """Test JSON fragments of several shards are served as one array"""
+    redis_mock.smembers.return_value = {b'1', b'2', b'3'}
+    redis_mock.mget.return_value = [
+        heartbeat_cache.encode_json_fragment(pd.DataFrame({'monitor_id': [1, 1]})),
+        heartbeat_cache.encode_json_fragment(pd.DataFrame({'monitor_id': []})),
+        heartbeat_cache.encode_json_fragment(pd.DataFrame({'monitor_id': [3]}))
+    ]
+
+    body = heartbeat_cache.get_json()
+
+    redis_mock.mget.assert_called_once_with([heartbeat_cache.json_key(m, 1) for m in (1, 2, 3)])
+    assert orjson.loads(body) == [{'monitor_id': 1}, {'monitor_id': 1}, {'monitor_id': 3}]
+
+def test_cache_get_json_miss(heartbeat_cache, redis_mock):
+    """Test a missing fragment is a miss and an empty selection is an empty array"""
+    redis_mock.smembers.return_value = {b'1'}
+    redis_mock.mget.return_value = [None]
+    assert heartbeat_cache.get_json() is None
+
+    assert heartbeat_cache.get_json(monitor_ids=[9]) == b'[]'
 
 def test_cache_last_update(heartbeat_cache, redis_mock):
     """Test last update timestamp handling"""
@@ -81,6 +380,7 @@ async def test_cache_sync_start_stop(cache_sync, monkeypatch):
     
     # Mock check_for_updates to avoid database calls
     cache_sync.check_for_updates = AsyncMock()
+    cache_sync.sync_snapshot = AsyncMock()
     
     # Start sync in background task
     task = asyncio.create_task(cache_sync.start_sync())
@@ -104,28 +404,897 @@ async def test_cache_sync_check_updates(cache_sync):
         # Setup mock connection and cursor
         mock_conn = Mock()
         mock_cursor = Mock()
+        mock_stream = Mock()
         mock_connect.return_value = mock_conn
-        mock_conn.cursor.return_value = mock_cursor
+        mock_conn.cursor.side_effect = lambda **kwargs: mock_stream if kwargs == {'buffered': False} else mock_cursor
         
         # Mock database responses
         current_time = datetime.now()
-        mock_cursor.fetchone.return_value = {'last_update': current_time}
-        mock_cursor.fetchall.return_value = [
-            {'monitor_id': 1, 'status': 'up', 'time': current_time},
-            {'monitor_id': 2, 'status': 'down', 'time': current_time}
-        ]
+        mock_cursor.fetchone.return_value = {'heartbeat': 42}
+        mock_stream.fetchmany.side_effect = [[
+            {'id': 1, 'monitor_id': 1, 'status': 1, 'time': current_time},
+            {'id': 2, 'monitor_id': 2, 'status': 0, 'time': current_time}
+        ], []]
         
         # Mock cache last update to be older
-        cache_sync.cache.get_last_update = Mock(return_value=current_time.timestamp() - 3600)
+        cache_sync.cache.get_last_update = AsyncMock(return_value=current_time.timestamp() - 3600)
+        cache_sync.cache.set_data = AsyncMock()
+        cache_sync.cache.get_stats_monitor_ids = AsyncMock(return_value={1})
+        cache_sync.cache.update_stats = AsyncMock()
+        cache_sync.cache.acquire_refresh_lease = AsyncMock(return_value='lease-token')
+        cache_sync.cache.release_refresh_lease = AsyncMock()
         
         await cache_sync.check_for_updates()
         
-        # Verify database queries
-        assert mock_cursor.execute.call_count == 2
-        queries = [call[0][0] for call in mock_cursor.execute.call_args_list]
-        assert any("SELECT MAX(updated_at)" in query for query in queries)
-        assert any("SELECT h.*" in query for query in queries)
+        # Verify the probe ran on the buffered cursor and the heartbeats were streamed
+        assert "SELECT MAX(id) FROM heartbeat" in mock_cursor.execute.call_args[0][0]
+        assert "FROM heartbeat h WHERE" in mock_stream.execute.call_args[0][0]
         
-        # Verify cursor and connection were closed
+        # Verify the cursors were closed and the connection kept for the next poll
         mock_cursor.close.assert_called_once()
-        mock_conn.close.assert_called_once() 
\ No newline at end of file
+        mock_stream.close.assert_called_once()
+        mock_conn.close.assert_not_called()
+        assert cache_sync.watermark == 2
+
+        await cache_sync.check_for_updates()
+        mock_connect.assert_called_once()
+
+@pytest.mark.asyncio
+async def test_cache_sync_reconnects_after_error(cache_sync):
+    """Test a failed poll drops the persistent connection so the next one reconnects"""
+    with patch('cache_manager.mariadb.connect') as mock_connect:
+        mock_connect.return_value.cursor.return_value.fetchone.side_effect = RuntimeError("gone away")
+
+        await cache_sync.check_for_updates()
+
+        mock_connect.return_value.close.assert_called_once()
+        assert cache_sync.conn is None
+
+@pytest.mark.asyncio
+async def test_refresh_keeps_event_loop_responsive(cache_sync, async_redis_mock):
+    """Test blocking database calls and shard decoding run off the event loop, in full and incremental refreshes"""
+    cache_sync.cache = AsyncMock()
+    cursor = Mock()
+    stream = stream_rows(cache_sync)
+    rows = iter([[{'id': 1, 'monitor_id': 1, 'status': 1, 'time': datetime.utcnow()}], []])
+    stream.fetchmany.side_effect = lambda size: time.sleep(0.1) or next(rows)
+    loop = asyncio.get_running_loop()
+    lags = []
+
+    async def ticker():
+        while True:
+            started = loop.time()
+            await asyncio.sleep(0.01)
+            lags.append(loop.time() - started - 0.01)
+
+    task = asyncio.create_task(ticker())
+    await cache_sync.refresh_full(cursor)
+
+    # An incremental refresh sealing the last hour reads and decodes the open shards twice
+    full_lags, lags[:] = len(lags), []
+    cache = AsyncHeartbeatCache()
+    open_time = segment_datetime(open_segment_start())
+    values = {cache.CURRENT_KEY: b'1', cache.open_segment_key(1): str(open_segment_start() - SEGMENT_SECONDS).encode()}
+    async_redis_mock.get.side_effect = values.get
+    async_redis_mock.smembers.return_value = {b'1'}
+    async_redis_mock.mget.return_value = [cache.serialize(pd.DataFrame(
+        {'id': [1, 2], 'monitor_id': [1, 1], 'status': [1, 1], 'time': [open_time - timedelta(minutes=1), open_time]}))]
+    async_redis_mock.exists = AsyncMock(return_value=0)
+    async_redis_mock.pipeline.return_value.execute.return_value = [1]
+    decode = cache.deserialize
+    cache.deserialize = lambda payload: time.sleep(0.1) or decode(payload)
+    cache_sync.cache, cache_sync.watermark = cache, 2
+    stream_rows(cache_sync, [{'id': 3, 'monitor_id': 1, 'status': 0, 'time': datetime.utcnow()}])
+
+    await cache_sync.refresh_incremental(cursor)
+    task.cancel()
+
+    assert cache_sync.watermark == 3
+    assert full_lags > 5 and len(lags) > 10
+    assert max(lags) < 0.1
+
+@pytest.mark.asyncio
+async def test_refresh_full_sets_watermark(cache_sync):
+    """Test a full refresh caches everything and records the highest id"""
+    cache_sync.cache = AsyncMock()
+    now = datetime.utcnow()
+    stream = stream_rows(cache_sync, [
+        {'id': 4, 'monitor_id': 1, 'status': 1, 'time': now},
+        {'id': 9, 'monitor_id': 2, 'status': 1, 'time': now}
+    ])
+
+    await cache_sync.refresh_full(Mock())
+
+    assert cache_sync.watermark == 9
+    cache_sync.cache.set_data.assert_called_once()
+    assert cache_sync.cache.update_stats.call_args[1]['backfill'] is None
+    assert "WHERE h.time >= %s" in stream.execute.call_args[0][0]
+    cache_sync.conn.cursor.assert_called_once_with(buffered=False)
+    stream.close.assert_called_once()
+
+@pytest.mark.asyncio
+async def test_refresh_full_of_empty_window_uses_probed_id(cache_sync):
+    """Test a full refresh finding no recent heartbeats starts the next incremental refresh from the probed id"""
+    cache_sync.cache = AsyncMock()
+    cache_sync.probed_id = 5000
+    stream_rows(cache_sync, [])
+
+    await cache_sync.refresh_full(Mock())
+
+    assert cache_sync.watermark == 5000
+
+def test_probes_bound_the_heartbeat_id():
+    """Test both probes turn their token into the highest existing heartbeat id"""
+    assert MaxIdProbe(tables=('monitor', 'heartbeat')).heartbeat_id((3, 41)) == 41
+    assert AutoIncrementProbe().heartbeat_id((42,)) == 41
+    assert MaxIdProbe().heartbeat_id((None,)) is None
+    assert MaxIdProbe(tables=('monitor',)).heartbeat_id((3,)) is None
+
+@pytest.mark.asyncio
+async def test_refresh_full_backfills_stats_on_first_use(cache_sync):
+    """Test the 7d/30d windows are backfilled from daily aggregates when no stats exist yet"""
+    cache_sync.cache = AsyncMock()
+    cache_sync.cache.get_stats_monitor_ids.return_value = set()
+    stream_rows(cache_sync, [{'id': 4, 'monitor_id': 1, 'status': 1, 'time': datetime.utcnow()}])
+    cursor = Mock()
+    cursor.fetchall.return_value = [{'monitor_id': 1, 'bucket': 86400, 'up': 3, 'down': 1, 'ping_count': 3,
+                                     'ping_sum': 30, 'ping_min': 5, 'ping_max': 15}]
+
+    await cache_sync.refresh_full(cursor)
+
+    kwargs = cache_sync.cache.update_stats.call_args[1]
+    assert kwargs['backfill'] == {1: {'day:86400': [3, 1, 3, 30.0, 5.0, 15.0]}}
+    assert isinstance(kwargs['replace_since'], int)
+    assert "GROUP BY h.monitor_id, bucket" in cursor.execute.call_args[0][0]
+
+@pytest.mark.asyncio
+async def test_refresh_incremental_applies_new_rows(cache_sync):
+    """Test only rows above the watermark are fetched and applied as inserts"""
+    cache_sync.cache = AsyncMock()
+    cache_sync.cache.get_open_segment.return_value = open_segment_start()
+    cache_sync.cache.apply_changes.return_value = True
+    cache_sync.watermark = 10
+    stream = stream_rows(cache_sync, [{'id': 11, 'monitor_id': 1, 'status': 0, 'time': datetime.utcnow()}])
+
+    await cache_sync.refresh_incremental(Mock())
+
+    query, params = stream.execute.call_args[0]
+    assert "WHERE h.id > %s AND h.time >= %s" in query
+    assert params[0] == 10
+    cache_sync.cache.seal_segments.assert_not_called()
+    assert cache_sync.cache.apply_changes.call_args[1]['inserted']['id'].tolist() == [11]
+    cache_sync.cache.set_data.assert_not_called()
+    assert cache_sync.watermark == 11
+
+@pytest.mark.asyncio
+async def test_refresh_incremental_falls_back_to_full(cache_sync):
+    """Test rows the cache cannot apply trigger a full refresh instead"""
+    cache_sync.cache = AsyncMock()
+    cache_sync.cache.get_open_segment.return_value = open_segment_start()
+    cache_sync.cache.apply_changes.return_value = False
+    cache_sync.watermark = 10
+    stream_rows(cache_sync,
+                [{'id': 11, 'monitor_id': 1, 'status': 0, 'time': datetime.utcnow()}],
+                [{'id': 11, 'monitor_id': 1, 'status': 0, 'time': datetime.utcnow()}])
+
+    await cache_sync.refresh_incremental(Mock())
+
+    cache_sync.cache.set_data.assert_called_once()
+    assert cache_sync.watermark == 11
+
+@pytest.mark.asyncio
+async def test_refresh_incremental_seals_closed_segment(cache_sync):
+    """Test the open segment is sealed once its hour is over, before appending"""
+    cache_sync.cache = AsyncMock()
+    cache_sync.cache.get_open_segment.return_value = open_segment_start() - SEGMENT_SECONDS
+    cache_sync.cache.apply_changes.return_value = True
+    cache_sync.watermark = 10
+    stream_rows(cache_sync, [{'id': 11, 'monitor_id': 1, 'status': 0, 'time': datetime.utcnow()}])
+
+    await cache_sync.refresh_incremental(Mock())
+
+    cache_sync.cache.seal_segments.assert_called_once_with(open_segment_start())
+    cache_sync.cache.apply_changes.assert_called_once()
+    cache_sync.cache.set_data.assert_not_called()
+
+def apply_changes_redis(heartbeat_cache, redis_mock, cached: pd.DataFrame, stats_built: bool = True):
+    """Point redis_mock at generation 1 with one cached open shard for monitor 1"""
+    values = {heartbeat_cache.CURRENT_KEY: b'1',
+              heartbeat_cache.open_segment_key(1): str(open_segment_start()).encode()}
+    redis_mock.get.side_effect = values.get
+    redis_mock.exists.return_value = int(stats_built)
+    redis_mock.smembers.return_value = {b'1'}
+    redis_mock.mget.return_value = [heartbeat_cache.serialize(cached)]
+    pipe = redis_mock.pipeline.return_value
+    pipe.execute.return_value = [{}]
+    return pipe
+
+def test_apply_changes_merges_rows_by_id(heartbeat_cache, redis_mock):
+    """Test inserts and deletes are merged into the open shard, counting only new rows in the aggregates"""
+    now = datetime.utcnow()
+    pipe = apply_changes_redis(heartbeat_cache, redis_mock, pd.DataFrame(
+        {'id': [10, 11], 'monitor_id': [1, 1], 'status': [1, 1], 'time': [now, now]}))
+
+    applied = heartbeat_cache.apply_changes(
+        inserted=pd.DataFrame({'id': [11, 12], 'monitor_id': [1, 1], 'status': [1, 0], 'time': [now, now]}),
+        deleted=pd.DataFrame({'id': [10], 'monitor_id': [1], 'status': [1], 'time': [now]}))
+
+    assert applied is True
+    shard = heartbeat_cache.deserialize(pipe.setex.call_args_list[0][0][2])
+    assert shard['id'].tolist() == [11, 12]
+    pipe.eval.assert_called_once_with(PUBLISH_INVALIDATION_SCRIPT, 1, heartbeat_cache.VERSION_KEY,
+                                      heartbeat_cache.INVALIDATION_CHANNEL, '1')
+    assert orjson.loads(pipe.hset.call_args[1]['mapping']['status'])['status'] == 0
+
+def test_apply_changes_counts_rows_committed_out_of_id_order(heartbeat_cache, redis_mock):
+    """Test an insert below ids already cached is still counted, and a cached one is not counted twice"""
+    now = datetime.utcnow()
+    cached = pd.DataFrame({'id': [10, 12], 'monitor_id': [1, 1], 'status': [1, 1], 'time': [now, now]})
+    pipe = apply_changes_redis(heartbeat_cache, redis_mock, cached)
+
+    heartbeat_cache.apply_changes(
+        inserted=pd.DataFrame({'id': [11], 'monitor_id': [1], 'status': [0], 'time': [now]}))
+
+    assert orjson.loads(pipe.hset.call_args[1]['mapping']['status'])['status'] == 0
+
+    pipe = apply_changes_redis(heartbeat_cache, redis_mock, cached)
+    pipe.hset.reset_mock()
+
+    heartbeat_cache.apply_changes(
+        inserted=pd.DataFrame({'id': [12], 'monitor_id': [1], 'status': [1], 'time': [now]}))
+
+    pipe.setex.assert_called()
+    pipe.hset.assert_not_called()
+
+def test_apply_changes_keeps_quiet_shards_alive(heartbeat_cache, redis_mock):
+    """Test an append refreshes the TTL of every indexed shard, not only the rewritten ones"""
+    now = datetime.utcnow()
+    pipe = apply_changes_redis(heartbeat_cache, redis_mock, pd.DataFrame(
+        {'id': [10], 'monitor_id': [1], 'status': [1], 'time': [now]}))
+    redis_mock.smembers.return_value = {b'1', b'2'}
+    redis_mock.mget.return_value = [heartbeat_cache.serialize(pd.DataFrame(
+        {'id': [10], 'monitor_id': [1], 'status': [1], 'time': [now]}))]
+
+    heartbeat_cache.apply_changes(
+        inserted=pd.DataFrame({'id': [11], 'monitor_id': [1], 'status': [1], 'time': [now]}))
+
+    expired = {c[0][0] for c in pipe.expire.call_args_list if c[0][1] == heartbeat_cache.CACHE_TTL}
+    assert {heartbeat_cache.shard_key(2, 1), heartbeat_cache.json_key(2, 1),
+            heartbeat_cache.index_key(1)} <= expired
+    assert [c[0][0] for c in pipe.setex.call_args_list] == [heartbeat_cache.shard_key(1, 1),
+                                                           heartbeat_cache.json_key(1, 1)]
+
+def test_apply_changes_rejects_sealed_rows(heartbeat_cache, redis_mock):
+    """Test changes to sealed segments are left to a rebuild"""
+    late = segment_datetime(open_segment_start()) - timedelta(minutes=5)
+    pipe = apply_changes_redis(heartbeat_cache, redis_mock, pd.DataFrame(
+        {'id': [10], 'monitor_id': [1], 'status': [1], 'time': [late]}))
+
+    applied = heartbeat_cache.apply_changes(
+        deleted=pd.DataFrame({'id': [10], 'monitor_id': [1], 'status': [1], 'time': [late]}))
+
+    assert applied is False
+    pipe.setex.assert_not_called()
+    pipe.eval.assert_not_called()
+
+def test_apply_changes_leaves_unbuilt_aggregates_alone(heartbeat_cache, redis_mock):
+    """Test no aggregates are written before a full refresh has built them"""
+    now = datetime.utcnow()
+    pipe = apply_changes_redis(heartbeat_cache, redis_mock, pd.DataFrame(
+        {'id': [10], 'monitor_id': [1], 'status': [1], 'time': [now]}), stats_built=False)
+
+    assert heartbeat_cache.apply_changes(
+        inserted=pd.DataFrame({'id': [11], 'monitor_id': [1], 'status': [1], 'time': [now]})) is True
+
+    pipe.setex.assert_called()
+    pipe.hset.assert_not_called()
+
+def test_apply_changes_skips_aggregates_of_a_replayed_batch(heartbeat_cache, redis_mock):
+    """Test a batch at or before the position stored with the aggregates is not counted again"""
+    now = datetime.utcnow()
+    cached = pd.DataFrame({'id': [10], 'monitor_id': [1], 'status': [1], 'time': [now]})
+    updated = pd.DataFrame({'id': [10], 'monitor_id': [1], 'status': [0], 'time': [now]})
+    pipe = apply_changes_redis(heartbeat_cache, redis_mock, cached)
+    redis_mock.hmget.return_value = [b'mysql-bin.000002', b'500']
+
+    assert heartbeat_cache.apply_changes(updated=updated, previous=cached,
+                                         position=('mysql-bin.000002', 500)) is True
+
+    pipe.setex.assert_called()
+    pipe.hset.assert_not_called()
+
+    heartbeat_cache.apply_changes(updated=updated, previous=cached, position=('mysql-bin.000003', 4))
+
+    pipe.hset.assert_any_call(heartbeat_cache.STATS_POSITION_KEY,
+                              mapping={'log_file': 'mysql-bin.000003', 'log_pos': 4})
+
+@pytest.mark.asyncio
+async def test_cache_sync_skips_refresh_when_probe_unchanged(cache_sync):
+    """Test no refresh query runs while the probe token stays the same"""
+    with patch('cache_manager.mariadb.connect') as mock_connect:
+        mock_cursor = Mock()
+        mock_connect.return_value.cursor.return_value = mock_cursor
+        mock_cursor.fetchone.return_value = {'heartbeat': 42}
+        cache_sync.cache.get_last_update = AsyncMock(return_value=1.0)
+        cache_sync.last_probe_token = (42,)
+        cache_sync.watermark = 42
+
+        await cache_sync.check_for_updates()
+
+        assert mock_cursor.execute.call_count == 1
+
+def test_max_id_probe():
+    """Test the max id probe reads every table's primary key maximum in one query"""
+    cursor = Mock()
+    cursor.fetchone.return_value = {'heartbeat': 7, 'monitor': 3}
+
+    token = MaxIdProbe(tables=('heartbeat', 'monitor')).read(cursor)
+
+    assert token == (7, 3)
+    query = cursor.execute.call_args[0][0]
+    assert "(SELECT MAX(id) FROM heartbeat) AS heartbeat" in query
+    assert "(SELECT MAX(id) FROM monitor) AS monitor" in query
+
+def test_auto_increment_probe():
+    """Test the auto increment probe reads information_schema only"""
+    cursor = Mock()
+    cursor.fetchall.return_value = [{'TABLE_NAME': 'heartbeat', 'AUTO_INCREMENT': 100}]
+
+    token = AutoIncrementProbe().read(cursor)
+
+    assert token == (100,)
+    query, params = cursor.execute.call_args[0]
+    assert "information_schema.TABLES" in query
+    assert params == ('heartbeat',)
+
+def test_get_or_refresh_hit(heartbeat_cache):
+    """Test a cache hit never calls the loader or takes the lease"""
+    heartbeat_cache.get_data = Mock(return_value=pd.DataFrame({'monitor_id': [1]}))
+    loader = Mock()
+
+    result = heartbeat_cache.get_or_refresh(loader)
+
+    assert len(result) == 1
+    loader.assert_not_called()
+
+def test_get_or_refresh_single_flight(heartbeat_cache, redis_mock):
+    """Test the lease holder loads and caches while releasing its lease"""
+    heartbeat_cache.get_data = Mock(return_value=None)
+    heartbeat_cache.set_data = Mock()
+    redis_mock.set.return_value = True
+    loader = Mock(return_value=pd.DataFrame({'monitor_id': [1, 2]}))
+
+    result = heartbeat_cache.get_or_refresh(loader, monitor_ids=[2])
+
+    loader.assert_called_once()
+    heartbeat_cache.set_data.assert_called_once()
+    assert result['monitor_id'].tolist() == [2]
+    assert redis_mock.set.call_args.kwargs['nx'] is True
+    lease_token = redis_mock.set.call_args[0][1]
+    heartbeat_cache._release_lease.assert_called_once_with(keys=[heartbeat_cache.LEASE_KEY], args=[lease_token])
+
+def test_get_or_refresh_as_json(heartbeat_cache, redis_mock):
+    """Test JSON reads are served from the fragments and encoded on a reload"""
+    heartbeat_cache.get_json = Mock(side_effect=[b'[{"monitor_id":1}]', None])
+    heartbeat_cache.set_data = Mock()
+    redis_mock.set.return_value = True
+    loader = Mock(return_value=pd.DataFrame({'monitor_id': [1, 2]}))
+
+    assert heartbeat_cache.get_or_refresh(loader, as_json=True) == b'[{"monitor_id":1}]'
+    loader.assert_not_called()
+
+    assert heartbeat_cache.get_or_refresh(loader, monitor_ids=[2], as_json=True) == b'[{"monitor_id":2}]'
+
+def test_get_or_refresh_waits_for_holder(heartbeat_cache, redis_mock):
+    """Test callers without the lease wait for the holder instead of loading"""
+    cached = pd.DataFrame({'monitor_id': [1]})
+    heartbeat_cache.get_data = Mock(side_effect=[None, None, cached])
+    redis_mock.set.return_value = None
+    loader = Mock()
+
+    result = heartbeat_cache.get_or_refresh(loader, poll_interval=0)
+
+    assert result is cached
+    loader.assert_not_called()
+
+def test_get_or_refresh_timeout(heartbeat_cache, redis_mock):
+    """Test waiting gives up after the timeout"""
+    heartbeat_cache.get_data = Mock(return_value=None)
+    redis_mock.set.return_value = None
+
+    with pytest.raises(TimeoutError):
+        heartbeat_cache.get_or_refresh(Mock(), wait_timeout=0, poll_interval=0)
+
+def test_refresh_lease_is_renewed_while_held(heartbeat_cache, redis_mock):
+    """Test the lease is extended, checking its token, for as long as the block runs and no longer"""
+    with patch('cache_manager.HEARTBEAT_REFRESH_LEASE_MS', 30):
+        with heartbeat_cache.keep_refresh_lease('lease-token'):
+            time.sleep(0.1)
+
+        heartbeat_cache._renew_lease.assert_called_with(keys=[heartbeat_cache.LEASE_KEY], args=['lease-token', 30])
+        renewals = heartbeat_cache._renew_lease.call_count
+        time.sleep(0.05)
+
+    assert renewals >= 2
+    assert heartbeat_cache._renew_lease.call_count == renewals
+
+@pytest.mark.asyncio
+async def test_cache_sync_skips_refresh_without_lease(cache_sync):
+    """Test CacheSync leaves the refresh to whoever holds the lease"""
+    with patch('cache_manager.mariadb.connect') as mock_connect:
+        mock_cursor = Mock()
+        mock_connect.return_value.cursor.return_value = mock_cursor
+        mock_cursor.fetchone.return_value = {'heartbeat': 42}
+        cache_sync.cache.get_last_update = AsyncMock(return_value=None)
+        cache_sync.cache.acquire_refresh_lease = AsyncMock(return_value=None)
+
+        await cache_sync.check_for_updates()
+
+        assert mock_cursor.execute.call_count == 1
+        assert cache_sync.last_probe_token is None
+
+@pytest.fixture
+def l1_cache(redis_mock):
+    """Create a heartbeat cache with the in-process L1 enabled"""
+    redis_mock.get.return_value = b'5'
+    cache = HeartbeatCache(l1=True)
+    redis_mock.reset_mock()
+    return cache
+
+def test_l1_serves_hot_reads_without_redis(l1_cache, redis_mock):
+    """Test a second read is answered from the in-process copy"""
+    redis_mock.smembers.return_value = {b'1', b'2'}
+    redis_mock.mget.return_value = [
+        l1_cache.serialize(pd.DataFrame({'monitor_id': [1], 'status': [1]})),
+        l1_cache.serialize(pd.DataFrame({'monitor_id': [2], 'status': [0]}))
+    ]
+    assert len(l1_cache.get_data()) == 2
+    redis_mock.reset_mock()
+
+    result = l1_cache.get_data(monitor_ids=[2], columns=['status'])
+
+    assert result['status'].tolist() == [0]
+    assert redis_mock.method_calls == []
+
+def test_l1_invalidation_message_drops_shard(l1_cache, redis_mock):
+    """Test a pub/sub invalidation for one monitor forces a Redis read for it"""
+    redis_mock.smembers.return_value = {b'1'}
+    redis_mock.mget.return_value = [l1_cache.serialize(pd.DataFrame({'monitor_id': [1]}))]
+    l1_cache.get_data()
+
+    l1_cache._handle_invalidation_message({'data': b'6:1'})
+    l1_cache.get_data()
+
+    assert redis_mock.mget.call_count == 2
+    assert l1_cache._l1_version == 6
+
+def test_l1_keeps_frames_and_json_apart(l1_cache, redis_mock):
+    """Test L1 caches JSON fragments separately from frames of the same monitor"""
+    redis_mock.smembers.return_value = {b'1'}
+    redis_mock.mget.return_value = [l1_cache.serialize(pd.DataFrame({'monitor_id': [1]}))]
+    l1_cache.get_data()
+    redis_mock.mget.return_value = [l1_cache.encode_json_fragment(pd.DataFrame({'monitor_id': [1]}))]
+    l1_cache.get_json()
+    redis_mock.reset_mock()
+
+    assert l1_cache.get_json() == b'[{"monitor_id":1}]'
+    assert l1_cache.get_data()['monitor_id'].tolist() == [1]
+    assert redis_mock.method_calls == []
+
+    l1_cache._handle_invalidation_message({'data': b'6:1'})
+    assert l1_cache._l1 == {}
+
+def test_l1_keeps_sealed_segments_across_seals(l1_cache, redis_mock):
+    """Test sealing only drops the open segment from L1"""
+    redis_mock.smembers.return_value = {b'1'}
+    redis_mock.zrange.return_value = [b'3600000']
+    redis_mock.mget.return_value = [l1_cache.serialize(pd.DataFrame({'monitor_id': [1], 'status': [2]}))]
+    redis_mock.pipeline.return_value.execute.return_value = [
+        {SEGMENT_SENTINEL: b'', b'1': l1_cache.serialize(pd.DataFrame({'monitor_id': [1], 'status': [1]}))}
+    ]
+    assert l1_cache.get_data()['status'].tolist() == [1, 2]
+    redis_mock.pipeline.return_value.hgetall.assert_called_once_with(l1_cache.segment_key(3600000, 5))
+
+    l1_cache._handle_invalidation_message({'data': b'6:seal'})
+    l1_cache.get_data()
+
+    assert redis_mock.mget.call_count == 2
+    redis_mock.pipeline.return_value.hgetall.assert_called_once()
+
+def test_l1_skips_store_after_concurrent_invalidation(l1_cache, redis_mock):
+    """Test data read before an invalidation is not kept in L1"""
+    redis_mock.smembers.return_value = {b'1'}
+
+    def mget(keys):
+        l1_cache._apply_invalidation(6, None)
+        return [l1_cache.serialize(pd.DataFrame({'monitor_id': [1]}))]
+    redis_mock.mget.side_effect = mget
+
+    l1_cache.get_data()
+
+    assert l1_cache._l1 == {}
+
+def test_writes_publish_invalidations(heartbeat_cache, redis_mock):
+    """Test writes bump the version and publish within their own pipeline"""
+    heartbeat_cache.set_monitor_data(3, pd.DataFrame({'monitor_id': [3]}))
+    heartbeat_cache.set_data(pd.DataFrame({'monitor_id': [4], 'time': [datetime.utcnow()]}))
+
+    pipe = redis_mock.pipeline.return_value
+    assert [c[0][4] for c in pipe.eval.call_args_list] == ['3', '*']
+    assert all(c[0][:4] == (PUBLISH_INVALIDATION_SCRIPT, 1, heartbeat_cache.VERSION_KEY,
+                            heartbeat_cache.INVALIDATION_CHANNEL) for c in pipe.eval.call_args_list)
+    redis_mock.incr.assert_not_called()
+    redis_mock.publish.assert_not_called()
+
+def test_write_applies_published_version_to_l1(l1_cache, redis_mock):
+    """Test the local L1 picks up the version returned by the write pipeline"""
+    redis_mock.pipeline.return_value.execute.return_value = [True, True, 1, True, True, 9]
+
+    l1_cache.set_monitor_data(3, pd.DataFrame({'monitor_id': [3]}))
+
+    assert l1_cache._l1_version == 9
+
+def test_snapshot_round_trip(tmp_path):
+    """Test a published snapshot is mapped once and its payloads read in place"""
+    snapshot = HeartbeatSnapshot(str(tmp_path / 'segments.arrow'))
+    assert snapshot.load() is None
+
+    snapshot.publish(3, [0, 3600], [(3600, 2, b'frame-2', b'{"a":2}'), (0, 1, b'frame-1', b'{"a":1}')])
+    state = snapshot.load()
+
+    assert (state.generation, state.starts) == (3, [0, 3600])
+    assert isinstance(state.segments['frame'][0][1], memoryview)
+    assert bytes(state.segments['json'][3600][2]) == b'{"a":2}'
+    assert snapshot.load() is state
+    assert snapshot.get_segments('frame', 4, [0]) == {}
+    assert list(snapshot.get_segments('json', 3, [3600, 7200])) == [3600]
+
+def test_sealed_segments_read_from_snapshot(redis_mock, tmp_path):
+    """Test sealed segments covered by the snapshot are not read from Redis"""
+    writer = HeartbeatCache()
+    snapshot = HeartbeatSnapshot(str(tmp_path / 'segments.arrow'))
+    frame = lambda status: writer.serialize(pd.DataFrame({'monitor_id': [1], 'status': [status]}))
+    fragment = writer.encode_json_fragment(pd.DataFrame({'monitor_id': [1], 'status': [1]}))
+    snapshot.publish(1, [3600000], [(3600000, 1, frame(1), fragment)])
+    cache = HeartbeatCache(snapshot=snapshot)
+    redis_mock.smembers.return_value = {b'1'}
+    redis_mock.zrange.return_value = [b'3600000']
+    redis_mock.mget.return_value = [frame(2)]
+
+    assert cache.get_data()['status'].tolist() == [1, 2]
+    redis_mock.pipeline.return_value.hmget.assert_not_called()
+
+    redis_mock.mget.return_value = [writer.encode_json_fragment(pd.DataFrame({'monitor_id': [1], 'status': [2]}))]
+    assert orjson.loads(cache.get_json()) == [{'monitor_id': 1, 'status': 1}, {'monitor_id': 1, 'status': 2}]
+
+def test_snapshot_reads_decode_only_requested_monitors(redis_mock, tmp_path):
+    """Test a sealed segment read from the snapshot decodes only the requested monitors, with L1 on too"""
+    snapshot = HeartbeatSnapshot(str(tmp_path / 'segments.arrow'))
+    snapshot.publish(1, [3600000], [(3600000, 1, b'frame-1', b'{}'), (3600000, 2, b'frame-2', b'{}')])
+    cache = HeartbeatCache(snapshot=snapshot)
+    cache.l1_enabled = True
+    decode = Mock(side_effect=bytes)
+
+    segments = cache._run(cache._plan_read_sealed('frame', [2], [3600000], decode, 0, 1))
+
+    assert segments == [{2: b'frame-2'}]
+    decode.assert_called_once()
+    redis_mock.pipeline.return_value.hgetall.assert_not_called()
+
+@pytest.mark.asyncio
+async def test_sync_snapshot_fetches_only_new_segments(cache_sync, tmp_path):
+    """Test CacheSync keeps the segments it already has and reads newly sealed ones"""
+    cache_sync.snapshot = HeartbeatSnapshot(str(tmp_path / 'segments.arrow'))
+    cache_sync.snapshot.publish(2, [0], [(0, 1, b'old-frame', b'old-json')])
+    cache_sync.cache = AsyncMock()
+    cache_sync.cache.get_generation.return_value = 2
+    cache_sync.cache.get_sealed_segments.return_value = [0, 3600]
+    cache_sync.cache.get_segment_payloads.return_value = [(3600, 1, b'new-frame', b'new-json')]
+
+    await cache_sync.sync_snapshot()
+
+    cache_sync.cache.get_segment_payloads.assert_awaited_once_with(2, [3600])
+    state = cache_sync.snapshot.load()
+    assert state.starts == [0, 3600]
+    assert bytes(state.segments['frame'][0][1]) == b'old-frame'
+    assert bytes(state.segments['json'][3600][1]) == b'new-json'
+
+    await cache_sync.sync_snapshot()
+    cache_sync.cache.get_segment_payloads.assert_awaited_once()
+
+def test_redis_pools_are_shared(redis_mock):
+    """Test every cache instance of a process shares one pool per client kind"""
+    assert get_redis_pool() is get_redis_pool()
+    assert get_redis_pool(use_asyncio=True) is not get_redis_pool()
+
+@pytest.fixture
+def async_redis_mock():
+    """Create a mock asyncio Redis client"""
+    with patch('cache_manager.redis.asyncio.Redis') as mock_redis, patch('cache_manager.redis.Redis'):
+        mock_client = Mock()
+        for command in ('get', 'set', 'smembers', 'zrange', 'mget'):
+            setattr(mock_client, command, AsyncMock())
+        # Readers are pointed at generation 1, and nothing else is set
+        mock_client.get.side_effect = lambda key: b'1' if key == 'heartbeat_data:current' else None
+        mock_client.zrange.return_value = []
+        mock_client.register_script.return_value = AsyncMock()
+        mock_client.pipeline.return_value.execute = AsyncMock(return_value=[2, set(), []])
+        mock_redis.return_value = mock_client
+        yield mock_client
+
+@pytest.mark.asyncio
+async def test_async_cache_get_data(async_redis_mock):
+    """Test the asyncio variant runs the same reads on redis.asyncio"""
+    cache = AsyncHeartbeatCache()
+    async_redis_mock.smembers.return_value = {b'1'}
+    async_redis_mock.mget.return_value = [cache.serialize(pd.DataFrame({'monitor_id': [1], 'status': [1]}))]
+
+    result = await cache.get_data(columns=['status'])
+
+    assert result['status'].tolist() == [1]
+    assert await cache.get_last_update() is None
+
+@pytest.mark.asyncio
+async def test_async_cache_get_or_refresh(async_redis_mock):
+    """Test the lease holder loads off the event loop and writes with one transaction"""
+    cache = AsyncHeartbeatCache()
+    async_redis_mock.smembers.return_value = set()
+    async_redis_mock.set.return_value = True
+    loader = Mock(return_value=pd.DataFrame({'monitor_id': [1, 2], 'time': [datetime.utcnow()] * 2}))
+
+    body = await cache.get_or_refresh(loader, monitor_ids=[2], as_json=True)
+
+    assert [row['monitor_id'] for row in orjson.loads(body)] == [2]
+    loader.assert_called_once()
+    # The full write is sent by the synchronous client off the event loop
+    async_redis_mock.pipeline.return_value.execute.assert_awaited_once()
+    cache._sync_client.pipeline.return_value.execute.assert_called_once()
+    async_redis_mock.register_script.return_value.assert_awaited_once()
+
+@pytest.mark.asyncio
+async def test_async_cache_releases_lease_when_loader_fails(async_redis_mock):
+    """Test errors inside a plan step still run the plan's cleanup"""
+    cache = AsyncHeartbeatCache()
+    async_redis_mock.smembers.return_value = set()
+    async_redis_mock.set.return_value = True
+
+    with pytest.raises(RuntimeError):
+        await cache.get_or_refresh(Mock(side_effect=RuntimeError("db down")))
+
+    async_redis_mock.register_script.return_value.assert_awaited_once()
+
+@pytest.mark.parametrize('codec, header', [('zstd', b'\x01'), ('lz4', b'\x02')])
+def test_compressed_payload_round_trip(redis_mock, codec, header):
+    """Test large payloads are compressed behind a codec header byte"""
+    cache = HeartbeatCache(compression=codec)
+    cache.compression_min_bytes = 0
+    test_df = pd.DataFrame({'monitor_id': [1] * 1000, 'msg': ['OK'] * 1000})
+
+    payload = cache.serialize(test_df)
+
+    assert payload[:1] == header
+    assert len(payload) < len(HeartbeatCache().serialize(test_df))
+    assert cache.deserialize(payload)['msg'].tolist() == ['OK'] * 1000
+
+def test_small_payloads_stay_uncompressed(redis_mock):
+    """Test payloads under the threshold are stored as-is for older readers"""
+    cache = HeartbeatCache(compression='zstd')
+    payload = cache.serialize(pd.DataFrame({'monitor_id': [1]}))
+
+    assert payload.startswith(b'ARROW1')
+
+def test_uncompressed_reader_reads_compressed(redis_mock):
+    """Test any reader decodes compressed payloads whatever its own codec setting"""
+    writer = HeartbeatCache(compression='lz4')
+    writer.compression_min_bytes = 0
+    payload = writer.serialize(pd.DataFrame({'monitor_id': [1, 2]}))
+
+    assert HeartbeatCache().deserialize(payload, columns=['monitor_id'])['monitor_id'].tolist() == [1, 2]
+
+def test_debug_info(heartbeat_cache, redis_mock):
+    """Test the debug summary decodes versions, segments and freshness"""
+    redis_mock.pipeline.return_value.execute.return_value = [[b'5', b'7200', b'100.0'], 2, -2, [b'3600', b'0']]
+
+    info = heartbeat_cache.get_debug_info()
+
+    redis_mock.pipeline.return_value.scard.assert_called_once_with(heartbeat_cache.index_key(1))
+    assert info['version'] == 5
+    assert (info['generation'], info['stale']) == (1, False)
+    assert info['open_segment'] == segment_datetime(7200).isoformat()
+    assert info['sealed_segments'] == [segment_datetime(0).isoformat(), segment_datetime(3600).isoformat()]
+    assert info['cached_monitors'] == 2
+    assert info['last_update'] == 100.0
+    assert info['refresh_lease_ms'] is None
+    assert info['l1']['enabled'] is False
+
+def test_published_metrics_round_trip(heartbeat_cache, redis_mock):
+    """Test published snapshots are read back by source and stale ones dropped"""
+    REGISTRY.counter('heartbeat_cache_hits_total', {'kind': 'json'}).inc()
+    heartbeat_cache.publish_metrics('cache_sync')
+
+    key, source, payload = redis_mock.hset.call_args[0]
+    assert (key, source) == (heartbeat_cache.METRICS_KEY, 'cache_sync')
+    stale = orjson.dumps({'published_at': time.time() - 3600, 'metrics': {}})
+    redis_mock.hgetall.return_value = {b'cache_sync': payload, b'binlog_sync': stale}
+
+    published = heartbeat_cache.get_published_metrics()
+
+    assert list(published) == ['cache_sync']
+    assert 'heartbeat_cache_hits_total' in published['cache_sync']['metrics']
+
+def test_read_chunks_builds_columns_from_tuples():
+    """Test streamed tuple rows become one frame, whatever types each chunk infers"""
+    cursor = Mock()
+    cursor.description = [('id',), ('ping',), ('time',)]
+    now = datetime(2025, 1, 1)
+    cursor.fetchmany.side_effect = [[(1, None, now), (2, None, now)], [(3, 25, now)], []]
+
+    df = read_chunks(cursor, chunk_size=2)
+
+    cursor.fetchmany.assert_called_with(2)
+    assert df['id'].tolist() == [1, 2, 3]
+    assert df['ping'].isna().tolist() == [True, True, False]
+    assert df['time'].tolist() == [now] * 3
+
+def test_read_chunks_narrows_heartbeat_types():
+    """Test heartbeat columns are loaded with compact dtypes"""
+    cursor = Mock()
+    cursor.description = [('id',), ('important',), ('status',), ('msg',), ('time',)]
+    now = datetime(2025, 1, 1)
+    cursor.fetchmany.side_effect = [[(1, 0, 1, 'OK', now), (2, 1, 0, 'timeout', now), (3, 0, 1, 'OK', now)], []]
+
+    df = read_chunks(cursor, types=HEARTBEAT_TYPES)
+
+    assert str(df['status'].dtype) == 'int8'
+    assert df['important'].dtype == bool
+    assert isinstance(df['msg'].dtype, pd.CategoricalDtype)
+    assert sorted(df['msg'].cat.categories) == ['OK', 'timeout']
+    assert pd.api.types.is_datetime64_dtype(df['time'])
+    assert orjson.loads(encode_records(df))[1] == {
+        'id': 2, 'important': True, 'status': 0, 'msg': 'timeout', 'time': '2025-01-01T00:00:00'
+    }
+
+def test_compact_frame_after_concat():
+    """Test concatenated frames get their categoricals back and keep NaN columns as floats"""
+    first = compact_frame(pd.DataFrame({'msg': ['OK'], 'status': [1], 'retries': [0]}))
+    second = compact_frame(pd.DataFrame({'msg': ['down'], 'status': [0]}))
+
+    df = compact_frame(pd.concat([first, second], ignore_index=True))
+
+    assert isinstance(df['msg'].dtype, pd.CategoricalDtype)
+    assert str(df['status'].dtype) == 'int8'
+    assert df['retries'].isna().tolist() == [False, True]
+
+def test_serialize_drops_unused_categories(heartbeat_cache):
+    """Test a shard's payload only carries the categories it uses"""
+    df = compact_frame(pd.DataFrame({'monitor_id': [1, 2], 'msg': ['OK', 'x' * 10000]}))
+
+    payload = heartbeat_cache.serialize(df[df['monitor_id'] == 1])
+
+    assert len(payload) < 10000
+    assert heartbeat_cache.deserialize(payload)['msg'].tolist() == ['OK']
+
+def test_heartbeat_query_projects_columns():
+    """Test the cache query names its columns and only joins monitor when asked to"""
+    assert 'h.*' not in heartbeat_query(())
+    assert 'JOIN' not in heartbeat_query(())
+    query = heartbeat_query(('name',))
+    assert 'm.name AS monitor_name' in query and 'JOIN monitor m ON h.monitor_id = m.id' in query
+    with pytest.raises(ValueError):
+        heartbeat_query(('name; DROP TABLE heartbeat',))
+
+def test_read_chunks_empty_result():
+    """Test an empty result is an empty frame"""
+    cursor = Mock()
+    cursor.fetchmany.return_value = []
+
+    assert read_chunks(cursor).empty
+
+def test_aggregate_stats_buckets():
+    """Test heartbeats are counted into minute, hour and day buckets per monitor"""
+    df = pd.DataFrame({
+        'monitor_id': [1, 1, 1],
+        'status': [1, 0, 1],
+        'ping': [10, None, 30],
+        'time': [segment_datetime(3600), segment_datetime(3630), segment_datetime(3700)]
+    })
+
+    stats = aggregate_stats(df)[1]
+
+    assert stats['minute:3600'] == [1, 1, 1, 10.0, 10.0, 10.0]
+    assert stats['minute:3660'] == [1, 0, 1, 30.0, 30.0, 30.0]
+    assert stats['hour:3600'] == [2, 1, 2, 40.0, 10.0, 30.0]
+    assert stats['day:0'] == [2, 1, 2, 40.0, 10.0, 30.0]
+
+def test_latest_status_tracks_changes():
+    """Test the last status change survives batches without a change"""
+    rows = pd.DataFrame({'status': [1, 1, 0], 'time': [segment_datetime(60 * i) for i in (1, 2, 3)]})
+    status = latest_status(rows, {'status': 1, 'time': segment_datetime(0).isoformat(), 'changed_at': None})
+
+    assert status == {'status': 0, 'time': segment_datetime(180).isoformat(),
+                      'changed_at': segment_datetime(180).isoformat()}
+    more = pd.DataFrame({'status': [0], 'time': [segment_datetime(240)]})
+    assert latest_status(more, status)['changed_at'] == segment_datetime(180).isoformat()
+    assert latest_status(rows, status) is None
+
+def test_summarize_stats_windows():
+    """Test windows sum the buckets they overlap"""
+    now = 30 * 86400
+    fields = {
+        f'minute:{now - 60}': orjson.dumps([1, 0, 1, 10.0, 10.0, 10.0]),
+        f'hour:{now - 7200}': orjson.dumps([50, 10, 60, 1200.0, 5.0, 90.0]),
+        f'day:{now - 86400 * 3}': orjson.dumps([900, 100, 1000, 20000.0, 2.0, 400.0]),
+        'status': orjson.dumps({'status': 1, 'time': 'now', 'changed_at': 'before'})
+    }
+
+    stats = summarize_stats(fields, now)
+
+    assert stats['windows']['1h'] == {'up': 1, 'down': 0, 'uptime': 1.0, 'ping_min': 10.0,
+                                      'ping_avg': 10.0, 'ping_max': 10.0}
+    assert stats['windows']['24h']['uptime'] == 50 / 60
+    assert stats['windows']['7d']['ping_avg'] == 20.0
+    assert stats['windows']['30d']['ping_max'] == 400.0
+    assert stats['last_status_change'] == 'before'
+
+def test_update_stats_adds_to_stored_buckets(heartbeat_cache, redis_mock):
+    """Test new heartbeats are added to stored buckets and expired buckets are dropped"""
+    now = time.time()
+    start = int(now) - int(now) % 60
+    pipe = redis_mock.pipeline.return_value
+    pipe.execute.return_value = [{
+        f'minute:{start}'.encode(): orjson.dumps([2, 0, 2, 20.0, 5.0, 15.0]),
+        b'minute:0': orjson.dumps([1, 0, 0, 0.0, None, None])
+    }]
+
+    heartbeat_cache.update_stats(pd.DataFrame({'monitor_id': [4], 'status': [0], 'ping': [None],
+                                               'time': [segment_datetime(start)]}))
+
+    mapping = pipe.hset.call_args[1]['mapping']
+    assert orjson.loads(mapping[f'minute:{start}']) == [2, 1, 2, 20.0, 5.0, 15.0]
+    assert orjson.loads(mapping['status'])['status'] == 0
+    pipe.hdel.assert_called_once_with(heartbeat_cache.stats_key(4), 'minute:0')
+    pipe.sadd.assert_called_once_with(heartbeat_cache.STATS_INDEX_KEY, 4)
+
+def test_update_stats_replaces_covered_buckets(heartbeat_cache, redis_mock):
+    """Test a full load overwrites the buckets it covers and leaves older ones alone"""
+    start = open_segment_start()
+    pipe = redis_mock.pipeline.return_value
+    pipe.execute.return_value = [{
+        f'hour:{start}'.encode(): orjson.dumps([99, 0, 0, 0.0, None, None]),
+        f'hour:{start - 3600}'.encode(): orjson.dumps([5, 0, 0, 0.0, None, None])
+    }]
+
+    heartbeat_cache.update_stats(pd.DataFrame({'monitor_id': [4], 'status': [1],
+                                               'time': [segment_datetime(start)]}), replace_since=start)
+
+    mapping = pipe.hset.call_args[1]['mapping']
+    assert orjson.loads(mapping[f'hour:{start}'])[0] == 1
+    assert f'hour:{start - 3600}' not in mapping
+    pipe.hdel.assert_not_called()
+
+def test_update_stats_retracts_heartbeats(heartbeat_cache, redis_mock):
+    """Test retracted heartbeats are subtracted from stored buckets"""
+    now = time.time()
+    start = int(now) - int(now) % 60
+    pipe = redis_mock.pipeline.return_value
+    pipe.execute.return_value = [{f'minute:{start}'.encode(): orjson.dumps([2, 0, 2, 20.0, 5.0, 15.0])}]
+
+    heartbeat_cache.update_stats(pd.DataFrame(), retract=pd.DataFrame({
+        'monitor_id': [4], 'status': [1], 'ping': [5.0], 'time': [segment_datetime(start)]}))
+
+    mapping = pipe.hset.call_args[1]['mapping']
+    assert orjson.loads(mapping[f'minute:{start}']) == [1, 0, 1, 15.0, 5.0, 15.0]
+    assert f'hour:{start - start % 3600}' not in mapping
+
+def test_get_stats(heartbeat_cache, redis_mock):
+    """Test stats are read for the indexed monitors and skip expired ones"""
+    redis_mock.smembers.return_value = {b'1', b'2'}
+    redis_mock.pipeline.return_value.execute.return_value = [
+        {b'status': orjson.dumps({'status': 1, 'time': 't', 'changed_at': None})}, {}
+    ]
+
+    stats = heartbeat_cache.get_stats()
+
+    assert list(stats) == [1]
+    assert stats[1]['status'] == 1
+    assert stats[1]['windows']['24h']['uptime'] is None
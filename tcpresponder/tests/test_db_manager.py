@@ -1,13 +1,20 @@
 import pytest
-from db_manager import IPConfig, DatabaseManager
-from unittest.mock import Mock, patch
+import mariadb
+import msgpack
+from db_manager import (
+    IPConfig, DatabaseManager, LRUTTLCache, aggregate_device_ips,
+    IP_INVALIDATION_CHANNEL, SLOW_QUERIES_KEY, ip_cache_stats_from_metrics
+)
+from unittest.mock import Mock, MagicMock, patch
 
 @pytest.fixture
 def db_manager():
     """Create a test database manager with mocked connections"""
-    manager = DatabaseManager()
+    with patch('db_manager.redis.Redis'):
+        manager = DatabaseManager()
     # Mock the database connection and cursor
-    mock_cursor = Mock()
+    mock_cursor = MagicMock()
+    mock_cursor.__enter__.return_value = mock_cursor
     mock_conn = Mock()
     mock_conn.cursor.return_value = mock_cursor
     manager.get_connection = Mock(return_value=mock_conn)
@@ -100,4 +107,298 @@ def test_get_webhook_url_not_found(db_manager):
     
     result = db_manager.get_webhook_url(ip_address)
     
-    assert result == "" 
\ No newline at end of file
+    assert result == "" 
+
+def test_get_webhook_url_cached(db_manager):
+    """Test repeated webhook URL lookups are served from the cache"""
+    ip_address = "192.168.1.1"
+    cursor = db_manager.get_connection().cursor()
+    cursor.fetchone.return_value = {'push_url': 'http://test.com'}
+
+    assert db_manager.get_webhook_url(ip_address) == 'http://test.com'
+    assert db_manager.get_webhook_url(ip_address) == 'http://test.com'
+
+    assert cursor.fetchone.call_count == 1
+    stats = db_manager.get_cache_stats()
+    assert stats['hits'] == 1
+    assert stats['misses'] == 1
+
+def test_add_ip_invalidates_cache(db_manager):
+    """Test writing an IP drops its cached lookups"""
+    ip_address = "192.168.1.1"
+    cursor = db_manager.get_connection().cursor()
+    cursor.fetchone.return_value = {'push_url': 'http://old.com'}
+    assert db_manager.get_webhook_url(ip_address) == 'http://old.com'
+
+    db_manager.add_ip(IPConfig(ip_address=ip_address, is_static_ip=True, push_url='http://new.com'))
+    cursor.fetchone.return_value = {'push_url': 'http://new.com'}
+
+    assert db_manager.get_webhook_url(ip_address) == 'http://new.com'
+    assert db_manager.get_cache_stats()['misses'] == 2
+
+def test_writes_announce_invalidation(db_manager):
+    """Test writing an IP tells the other processes to drop its cached lookups"""
+    db_manager.remove_ip("192.168.1.1")
+
+    db_manager.redis_client.publish.assert_called_once_with(IP_INVALIDATION_CHANNEL, "192.168.1.1")
+
+def test_invalidation_message_drops_cached_lookup(db_manager):
+    """Test an invalidation published by another process forces a reload"""
+    ip_address = "192.168.1.1"
+    cursor = db_manager.get_connection().cursor()
+    cursor.fetchone.return_value = None
+    assert db_manager.get_webhook_url(ip_address) == ""
+
+    db_manager._handle_invalidation_message({'data': ip_address.encode()})
+    cursor.fetchone.return_value = {'push_url': 'http://new.com'}
+
+    assert db_manager.get_webhook_url(ip_address) == 'http://new.com'
+
+def test_ip_cache_stats_from_published_metrics():
+    """Test the stats of another process are rebuilt from its published metrics"""
+    metrics = {
+        'ip_cache_lookups_total': [
+            {'labels': {'result': 'hit'}, 'value': 3},
+            {'labels': {'result': 'miss'}, 'value': 1}
+        ],
+        'ip_cache_entries': [{'labels': {}, 'value': 2}]
+    }
+
+    stats = ip_cache_stats_from_metrics(metrics)
+
+    assert stats == {'hits': 3, 'misses': 1, 'evictions': 0, 'hit_ratio': 0.75, 'size': 2}
+    assert ip_cache_stats_from_metrics({}) is None
+
+def test_remove_ip_invalidates_cache(db_manager):
+    """Test removing an IP drops its cached details"""
+    ip_address = "192.168.1.1"
+    cursor = db_manager.get_connection().cursor()
+    cursor.fetchone.return_value = {
+        'ip_address': ip_address,
+        'device_name': '',
+        'client_name': 'test_client',
+        'location_name': 'test_location',
+        'is_static_ip': True,
+        'push_url': 'http://test.com'
+    }
+    assert db_manager.get_ip_details(ip_address).client_name == 'test_client'
+
+    db_manager.remove_ip(ip_address)
+    cursor.fetchone.return_value = None
+
+    assert db_manager.get_ip_details(ip_address) is None
+
+def test_lru_ttl_cache_eviction_and_expiry():
+    """Test the LRU cache evicts the oldest entry and expires by TTL"""
+    cache = LRUTTLCache(max_entries=2, ttl=60)
+    cache.put('a', 1)
+    cache.put('b', 2)
+    cache.get_or_load('a', Mock())
+    cache.put('c', 3)
+
+    loader = Mock(return_value=20)
+    assert cache.get_or_load('b', loader) == 20
+    loader.assert_called_once()
+    assert cache.stats()['evictions'] == 2
+
+    expired = LRUTTLCache(max_entries=2, ttl=0)
+    expired.put('a', 1)
+    assert expired.get_or_load('a', lambda: 2) == 2
+
+def test_get_ips_page(db_manager):
+    """Test keyset pagination returns the next cursor on full pages"""
+    cursor = db_manager.get_connection().cursor()
+    cursor.fetchall.return_value = [
+        {'id': 7, 'ip_address': '10.0.0.1', 'device_name': '', 'client_name': 'a',
+         'location_name': 'x', 'is_static_ip': True, 'push_url': ''},
+        {'id': 9, 'ip_address': '10.0.0.2', 'device_name': '', 'client_name': 'b',
+         'location_name': 'y', 'is_static_ip': True, 'push_url': ''}
+    ]
+
+    page, next_cursor = db_manager.get_ips_page(cursor=3, limit=2)
+
+    assert [ip.ip_address for ip in page] == ['10.0.0.1', '10.0.0.2']
+    assert next_cursor == 9
+    last_call = cursor.execute.call_args_list[-1]
+    assert "WHERE id > %s" in last_call[0][0]
+    assert last_call[0][1] == (3, 2)
+
+def test_iter_ips_streams_pages(db_manager):
+    """Test iter_ips keeps fetching until a short page is returned"""
+    def row(row_id):
+        return {'id': row_id, 'ip_address': f'10.0.0.{row_id}', 'device_name': '',
+                'client_name': '', 'location_name': '', 'is_static_ip': True, 'push_url': ''}
+    cursor = db_manager.get_connection().cursor()
+    cursor.fetchall.side_effect = [[row(1), row(2)], [row(3)]]
+
+    result = list(db_manager.iter_ips(chunk_size=2))
+
+    assert [ip.ip_address for ip in result] == ['10.0.0.1', '10.0.0.2', '10.0.0.3']
+    cursors = [c[0][1][0] for c in cursor.execute.call_args_list if "WHERE id > %s" in c[0][0]]
+    assert cursors == [0, 2]
+
+def test_snapshot_round_trip(db_manager, tmp_path):
+    """Test lookups of a fresh load are served from the snapshot without querying the database"""
+    path = str(tmp_path / "allowed_ips.snapshot")
+    db_manager.write_snapshot([
+        IPConfig(ip_address="10.0.0.1", is_static_ip=True, client_name="a", push_url="http://a.com"),
+        IPConfig(ip_address="10.0.0.2", is_static_ip=False, client_name="b")
+    ], path)
+    db_manager.ip_cache.invalidate()
+
+    assert db_manager.load_snapshot(path) is True
+
+    cursor = db_manager.get_connection().cursor()
+    cursor.execute.reset_mock()
+    assert db_manager.get_webhook_url("10.0.0.1") == "http://a.com"
+    assert db_manager.get_ip_details("10.0.0.2").client_name == "b"
+    cursor.execute.assert_not_called()
+    assert db_manager.get_cache_stats()['size'] == 2
+
+def test_snapshot_version_mismatch(db_manager, tmp_path):
+    """Test snapshots of another format version are ignored"""
+    path = tmp_path / "allowed_ips.snapshot"
+    path.write_bytes(msgpack.packb({'version': 999, 'columns': [], 'rows': []}))
+
+    assert db_manager.load_snapshot(str(path)) is False
+    assert db_manager.load_snapshot(str(tmp_path / "missing")) is False
+
+def test_snapshot_fallback_when_db_unreachable(db_manager, tmp_path):
+    """Test lookups fall back to the snapshot when MariaDB is down"""
+    path = str(tmp_path / "allowed_ips.snapshot")
+    db_manager.write_snapshot([IPConfig(ip_address="10.0.0.1", is_static_ip=True, push_url="http://a.com")], path)
+    db_manager.load_snapshot(path)
+    db_manager.ip_cache.invalidate()
+    db_manager.get_connection.side_effect = mariadb.Error("unreachable")
+
+    assert db_manager.get_webhook_url("10.0.0.1") == "http://a.com"
+    assert db_manager.get_webhook_url("10.0.0.9") == ""
+
+def test_reconcile_snapshot(db_manager, tmp_path):
+    """Test reconciling rewrites the snapshot from the database"""
+    path = str(tmp_path / "allowed_ips.snapshot")
+    db_manager.get_connection().cursor().fetchall.return_value = [
+        {'id': 1, 'ip_address': '10.0.0.1', 'device_name': '', 'client_name': 'a',
+         'location_name': '', 'is_static_ip': True, 'push_url': 'http://a.com'}
+    ]
+
+    db_manager.reconcile_snapshot(path)
+
+    assert set(db_manager.snapshot_index) == {'10.0.0.1'}
+    with open(path, 'rb') as f:
+        snapshot = msgpack.unpackb(f.read())
+    assert snapshot['rows'][0][0] == '10.0.0.1'
+
+def test_reconcile_keeps_the_lookup_cache(db_manager, tmp_path):
+    """Test reconciling neither evicts nor clears cached lookups, however many IPs there are"""
+    db_manager.ip_cache = LRUTTLCache(max_entries=4, ttl=300)
+    cursor = db_manager.get_connection().cursor()
+    cursor.fetchone.return_value = {'push_url': 'http://hot.com'}
+    db_manager.get_webhook_url("10.1.0.1")
+    cursor.fetchall.return_value = [
+        {'id': i, 'ip_address': f'10.0.0.{i}', 'device_name': '', 'client_name': '',
+         'location_name': '', 'is_static_ip': True, 'push_url': ''} for i in range(1, 21)
+    ]
+
+    assert db_manager.reconcile_snapshot(str(tmp_path / "allowed_ips.snapshot")) is True
+
+    stats = db_manager.get_cache_stats()
+    assert (stats['size'], stats['evictions']) == (1, 0)
+    assert len(db_manager.snapshot_index) == 20
+
+def test_reconcile_discards_listing_raced_by_a_write(db_manager, tmp_path):
+    """Test a write landing while allowed_ips is listed keeps the stale listing out of the index"""
+    path = str(tmp_path / "allowed_ips.snapshot")
+
+    def listing(*args, **kwargs):
+        db_manager.remove_ip('10.0.0.1')
+        return iter([IPConfig(ip_address='10.0.0.1', is_static_ip=True, push_url='http://old.com')])
+
+    with patch.object(db_manager, 'iter_ips', side_effect=listing):
+        assert db_manager.reconcile_snapshot(path) is False
+
+    assert '10.0.0.1' not in db_manager.snapshot_index
+
+def test_aggregate_device_ips():
+    """Test devices are counted per org, location and public IP"""
+    def device(org, location, public_ip):
+        return {
+            'publicIP': public_ip,
+            'references': {'organization': {'name': org}, 'location': {'name': location}}
+        }
+    devices = [
+        device('b_org', 'hq', '1.1.1.1'),
+        device('a_org', 'hq', '2.2.2.2'),
+        device('a_org', 'branch', '3.3.3.3'),
+        device('a_org', 'branch', '3.3.3.3'),
+        device('a_org', 'hq', None),
+        {'publicIP': '4.4.4.4'}
+    ]
+
+    result = aggregate_device_ips(devices)
+
+    assert [(r['references.organization.name'], r['publicIP'], r['count']) for r in result] == [
+        ('a_org', '3.3.3.3', 2),
+        ('a_org', '2.2.2.2', 1),
+        ('b_org', '1.1.1.1', 1)
+    ]
+
+def test_sync_from_ninja_pages_devices(db_manager):
+    """Test sync walks devices-detailed pages and stores each IP"""
+    def device(device_id):
+        return {
+            'id': device_id,
+            'publicIP': f'1.1.1.{device_id}',
+            'references': {'organization': {'name': 'org'}, 'location': {'name': 'hq'}}
+        }
+    db_manager.ninja = Mock()
+    db_manager.ninja.get_devices_detailed.side_effect = [[device(1), device(2)], [device(3)]]
+    db_manager.add_ip = Mock()
+
+    result = db_manager._iter_ninja_devices(page_size=2)
+    assert [d['id'] for d in result] == [1, 2, 3]
+
+    afters = [c.kwargs['after'] for c in db_manager.ninja.get_devices_detailed.call_args_list]
+    assert afters == [None, 2]
+
+    db_manager.ninja.get_devices_detailed.side_effect = [[device(1), device(2)]]
+    assert len(db_manager.sync_from_ninja()) == 2
+    assert db_manager.add_ip.call_count == 2
+
+def test_queries_are_timed_per_method(db_manager):
+    """Test every query feeds the latency histogram of its method"""
+    db_manager.get_connection().cursor().fetchone.return_value = None
+
+    db_manager.is_ip_allowed("192.168.1.1")
+
+    histograms = db_manager.get_query_stats()['histograms']
+    methods = {h['labels']['method']: h['count'] for h in histograms}
+    assert methods['is_ip_allowed'] >= 1
+
+def test_slow_query_log_redacts_params(db_manager):
+    """Test queries over the threshold are logged without parameter values"""
+    with patch('db_manager.SLOW_QUERY_THRESHOLD_MS', 0):
+        db_manager.remove_ip("10.1.2.3")
+
+    entry = db_manager.get_query_stats()['slow_queries'][-1]
+    assert entry['method'] == 'remove_ip'
+    assert entry['params'] == ['<str>']
+    assert "10.1.2.3" not in str(entry)
+
+def test_slow_query_log_is_published(db_manager):
+    """Test the slow-query log is published off the query path, once per change, and read back by source"""
+    with patch('db_manager.SLOW_QUERY_THRESHOLD_MS', 0):
+        db_manager.remove_ip("10.1.2.3")
+    db_manager.redis_client.hset.assert_not_called()
+
+    db_manager.publish_slow_queries()
+    db_manager.publish_slow_queries()
+
+    db_manager.redis_client.hset.assert_called_once()
+    key, source, payload = db_manager.redis_client.hset.call_args[0]
+    assert (key, source) == (SLOW_QUERIES_KEY, 'main')
+    assert msgpack.unpackb(payload)['slow_queries'][-1]['method'] == 'remove_ip'
+
+    db_manager.redis_client.hgetall.return_value = {b'main': payload, b'api': msgpack.packb({'slow_queries': []})}
+    published = db_manager.get_published_slow_queries()
+    assert list(published) == ['api']
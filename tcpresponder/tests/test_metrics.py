@@ -0,0 +1,45 @@
+import asyncio
+import time
+import pytest
+from metrics import Histogram, MetricsRegistry, monitor_loop_lag
+
+def test_histogram_buckets():
+    """Test observations land in cumulative buckets"""
+    histogram = Histogram(buckets=(0.1, 1.0))
+    for value in (0.05, 0.5, 0.5, 5.0):
+        histogram.observe(value)
+
+    snapshot = histogram.snapshot()
+
+    assert snapshot['count'] == 4
+    assert snapshot['sum'] == pytest.approx(6.05)
+    assert snapshot['min'] == 0.05
+    assert snapshot['max'] == 5.0
+    assert snapshot['buckets'] == {'0.1': 1, '1.0': 3, '+Inf': 4}
+
+def test_registry_reuses_labelled_metrics():
+    """Test the same name and labels always return the same metric"""
+    registry = MetricsRegistry()
+    registry.counter('hits', {'cache': 'a'}).inc()
+    registry.counter('hits', {'cache': 'a'}).inc(2)
+    registry.counter('hits', {'cache': 'b'}).inc()
+    registry.gauge('age').set(3)
+
+    snapshot = registry.snapshot()
+
+    assert {m['labels']['cache']: m['value'] for m in snapshot['hits']} == {'a': 3, 'b': 1}
+    assert snapshot['age'][0]['value'] == 3
+    assert set(registry.snapshot('hi')) == {'hits'}
+
+@pytest.mark.asyncio
+async def test_monitor_loop_lag_records_stalls():
+    """Test a blocking call on the loop shows up as lag"""
+    registry = MetricsRegistry()
+    task = asyncio.create_task(monitor_loop_lag(interval=0.01, registry=registry))
+    await asyncio.sleep(0.02)
+    time.sleep(0.05)
+    await asyncio.sleep(0.02)
+    task.cancel()
+
+    assert registry.gauge('event_loop_lag_max_seconds').value >= 0.03
+    assert registry.histogram('event_loop_lag_seconds').count >= 2
@@ -1,16 +1,32 @@
 import pytest
-from unittest.mock import Mock, patch, AsyncMock
-from sync_service import BinlogSyncService
+from datetime import datetime
+from unittest.mock import Mock, MagicMock, patch, AsyncMock
+from sync_service import BinlogSyncService, BATCH_SIZE_BUCKETS
 from pymysqlreplication.row_event import WriteRowsEvent, UpdateRowsEvent, DeleteRowsEvent
+from pymysqlreplication.event import HeartbeatLogEvent, XidEvent
 import logging
+import threading
+import time
+from metrics import REGISTRY
 
 @pytest.fixture
 def binlog_sync():
     """Create a test binlog sync service"""
     with patch('sync_service.HeartbeatCache') as mock_cache:
         mock_cache_instance = Mock()
+        mock_cache_instance.get_binlog_position.return_value = None
+        mock_cache_instance.keep_refresh_lease.return_value = MagicMock()
         mock_cache.return_value = mock_cache_instance
-        return BinlogSyncService(mock_cache_instance)
+        service = BinlogSyncService(mock_cache_instance)
+        # Apply every event right away unless a test batches them
+        service.batch_window = 0
+        return service
+
+def apply_event(binlog_sync, event, position=('mysql-bin.000001', 100)):
+    """Handle event as a transaction of its own"""
+    binlog_sync.handle_event(event)
+    binlog_sync.commit(*position)
+    binlog_sync.flush(due_only=True)
 
 def test_init(binlog_sync):
     """Test initialization of binlog sync service"""
@@ -34,82 +50,348 @@ def test_stop(binlog_sync):
     assert binlog_sync.stream is None
     mock_stream.close.assert_called_once()
 
-@pytest.mark.asyncio
-async def test_start_stop(binlog_sync):
+def test_start_stop(binlog_sync):
     """Test starting and stopping the binlog sync service"""
+    started = threading.Event()
+    released = threading.Event()
+
+    def events():
+        started.set()
+        released.wait(5)
+        yield from ()
+
     with patch('sync_service.BinLogStreamReader') as mock_reader:
-        mock_stream = Mock()
+        mock_stream = MagicMock()
         mock_reader.return_value = mock_stream
-        mock_stream.__iter__.return_value = []  # Empty stream
-        
-        # Start service in background
-        import asyncio
-        task = asyncio.create_task(binlog_sync.start())
-        
-        # Let it run for a moment
-        await asyncio.sleep(0)
+        mock_stream.__iter__.return_value = events()
+
+        # start() blocks on the stream, so run it the way main() does: on its own thread
+        thread = threading.Thread(target=binlog_sync.start)
+        thread.start()
+        assert started.wait(5)
         assert binlog_sync.running is True
-        
-        # Stop service
+
         binlog_sync.stop()
-        await task
-        
+        released.set()
+        thread.join(5)
+
+        assert not thread.is_alive()
+        mock_stream.close.assert_called_once()
         # Verify stream was created with correct parameters
         mock_reader.assert_called_once()
         call_args = mock_reader.call_args[1]
         assert call_args['connection_settings'] == binlog_sync.binlog_config
         assert call_args['server_id'] == 100
-        assert call_args['only_events'] == [WriteRowsEvent, UpdateRowsEvent, DeleteRowsEvent]
+        assert call_args['only_events'] == [WriteRowsEvent, UpdateRowsEvent, DeleteRowsEvent, XidEvent, HeartbeatLogEvent]
         assert call_args['only_tables'] == ['heartbeat']
+        assert call_args['blocking'] is True
+        assert 'resume_stream' not in call_args
 
-@pytest.mark.asyncio
-async def test_handle_events(binlog_sync):
+def test_handle_events(binlog_sync):
     """Test handling of binlog events"""
     with patch('sync_service.BinLogStreamReader') as mock_reader:
         # Create mock events
         mock_write_event = Mock(spec=WriteRowsEvent)
+        mock_write_event.rows = [{'values': {'id': 1, 'monitor_id': 1, 'time': datetime.utcnow()}}]
         mock_update_event = Mock(spec=UpdateRowsEvent)
+        mock_update_event.rows = [{'before_values': {'id': 1, 'monitor_id': 1, 'time': datetime.utcnow()},
+                                   'after_values': {'id': 1, 'monitor_id': 1, 'time': datetime.utcnow()}}]
         mock_delete_event = Mock(spec=DeleteRowsEvent)
-        
-        mock_stream = Mock()
+        mock_delete_event.rows = [{'values': {'id': 1, 'monitor_id': 1, 'time': datetime.utcnow()}}]
+
+        def events():
+            for event in (mock_write_event, mock_update_event, mock_delete_event):
+                yield event
+                yield Mock(spec=XidEvent, timestamp=0)
+            binlog_sync.stop()
+
+        mock_stream = MagicMock()
+        mock_stream.log_file, mock_stream.log_pos = 'mysql-bin.000001', 100
         mock_reader.return_value = mock_stream
-        mock_stream.__iter__.return_value = [
-            mock_write_event,
-            mock_update_event,
-            mock_delete_event
-        ]
-        
-        # Start service in background
-        import asyncio
-        task = asyncio.create_task(binlog_sync.start())
-        
-        # Let it run for a moment
-        await asyncio.sleep(0)
-        
-        # Stop service
-        binlog_sync.stop()
-        await task
-        
-        # Verify cache was invalidated for each event
-        assert binlog_sync.cache.invalidate.call_count == 3
+        mock_stream.__iter__.return_value = events()
+
+        binlog_sync.start()
 
-@pytest.mark.asyncio
-async def test_error_handling(binlog_sync, caplog):
+        # Verify each event was applied to the cache
+        assert binlog_sync.cache.apply_changes.call_count == 3
+        binlog_sync.cache.invalidate.assert_not_called()
+
+def test_error_handling(binlog_sync, caplog):
     """Test error handling in binlog sync service"""
+    def fail(**kwargs):
+        # Stop as well, so start() does not wait to reconnect
+        binlog_sync.stop()
+        raise Exception("Test error")
+
     with patch('sync_service.BinLogStreamReader') as mock_reader:
         # Make reader raise an exception
-        mock_reader.side_effect = Exception("Test error")
-        
-        # Start service in background
-        import asyncio
-        task = asyncio.create_task(binlog_sync.start())
-        
-        # Let it run for a moment
-        await asyncio.sleep(0)
-        
-        # Stop service
-        binlog_sync.stop()
-        await task
-        
+        mock_reader.side_effect = fail
+
+        binlog_sync.start()
+
         # Verify error was logged
-        assert "Error in binlog sync service: Test error" in caplog.text 
\ No newline at end of file
+        assert "Error in binlog sync service: Test error" in caplog.text
+
+def test_handle_event_applies_rows_under_lease(binlog_sync):
+    """Test update events are applied as before and after images while holding the refresh lease"""
+    now = datetime.utcnow()
+    event = Mock(spec=UpdateRowsEvent)
+    event.rows = [
+        {'before_values': {'id': 7, 'monitor_id': 1, 'status': 0, 'time': now},
+         'after_values': {'id': 7, 'monitor_id': 2, 'status': 1, 'time': now}}
+    ]
+    binlog_sync.cache.acquire_refresh_lease.return_value = 'lease-token'
+
+    apply_event(binlog_sync, event)
+
+    kwargs = binlog_sync.cache.apply_changes.call_args[1]
+    assert kwargs['updated']['monitor_id'].tolist() == [2]
+    assert kwargs['previous']['monitor_id'].tolist() == [1]
+    assert kwargs['position'] == ('mysql-bin.000001', 100)
+    binlog_sync.cache.release_refresh_lease.assert_called_once_with('lease-token')
+    binlog_sync.cache.keep_refresh_lease.assert_called_once_with('lease-token')
+    binlog_sync.cache.invalidate.assert_not_called()
+
+def test_handle_event_invalidates_unapplied_rows(binlog_sync):
+    """Test rows the cache cannot apply invalidate the shards of the touched monitors"""
+    now = datetime.utcnow()
+    event = Mock(spec=DeleteRowsEvent)
+    event.rows = [{'values': {'id': 7, 'monitor_id': 1, 'time': now}},
+                  {'values': {'id': 8, 'monitor_id': 2, 'time': now}}]
+    binlog_sync.cache.apply_changes.return_value = False
+
+    apply_event(binlog_sync, event)
+
+    binlog_sync.cache.invalidate_monitors.assert_called_once_with({1, 2})
+    binlog_sync.cache.invalidate.assert_not_called()
+
+def test_handle_event_invalidates_when_lease_is_held(binlog_sync):
+    """Test changes are not applied while a refresh keeps the lease past the wait"""
+    event = Mock(spec=WriteRowsEvent)
+    event.rows = [{'values': {'id': 7, 'monitor_id': 1, 'time': datetime.utcnow()}}]
+    binlog_sync.cache.acquire_refresh_lease.return_value = None
+    binlog_sync.lease_wait = 0
+
+    apply_event(binlog_sync, event)
+
+    binlog_sync.cache.apply_changes.assert_not_called()
+    binlog_sync.cache.invalidate_monitors.assert_called_once_with({1})
+
+def test_handle_event_without_monitor_id(binlog_sync):
+    """Test events without a monitor id invalidate the whole cache"""
+    event = Mock(spec=DeleteRowsEvent)
+    event.rows = [{'values': {'id': 5}}]
+
+    apply_event(binlog_sync, event)
+
+    binlog_sync.cache.invalidate.assert_called_once_with()
+
+def test_handle_event_records_metrics(binlog_sync):
+    """Test handled events are counted by type and row count"""
+    events = REGISTRY.counter('binlog_events_total', {'event': 'WriteRowsEvent'})
+    rows = REGISTRY.counter('binlog_rows_total')
+    before = (events.value, rows.value)
+    event = Mock(spec=WriteRowsEvent)
+    event.rows = [{'values': {'monitor_id': 1}}, {'values': {'monitor_id': 2}}]
+
+    binlog_sync.handle_event(event)
+
+    assert (events.value - before[0], rows.value - before[1]) == (1, 2)
+
+def test_publish_metrics_is_rate_limited(binlog_sync):
+    """Test metrics are published at most once per interval unless forced"""
+    binlog_sync.publish_metrics()
+    binlog_sync.publish_metrics()
+    binlog_sync.publish_metrics(force=True)
+
+    assert binlog_sync.cache.publish_metrics.call_count == 2
+    binlog_sync.cache.publish_metrics.assert_called_with('binlog_sync')
+
+def test_resumes_from_checkpoint(binlog_sync):
+    """Test the stream resumes at the checkpointed position and commits move the checkpoint"""
+    binlog_sync.cache.get_binlog_position.return_value = ('mysql-bin.000007', 1200)
+
+    def events():
+        yield Mock(spec=XidEvent, timestamp=0)
+        binlog_sync.running = False
+
+    with patch('sync_service.BinLogStreamReader') as mock_reader:
+        mock_stream = MagicMock()
+        mock_stream.log_file, mock_stream.log_pos = 'mysql-bin.000007', 1500
+        mock_stream.__iter__.return_value = events()
+        mock_reader.return_value = mock_stream
+
+        binlog_sync.start()
+
+        call_args = mock_reader.call_args[1]
+        assert (call_args['resume_stream'], call_args['log_file'], call_args['log_pos']) == (True, 'mysql-bin.000007', 1200)
+        binlog_sync.cache.set_binlog_position.assert_called_once_with('mysql-bin.000007', 1500)
+
+def test_catchup_is_only_tracked_after_start_or_error(binlog_sync):
+    """Test reopening the stream after a clean end resumes without starting another catch-up"""
+    binlog_sync.log_file, binlog_sync.log_pos = 'mysql-bin.000007', 1200
+
+    with patch('sync_service.BinLogStreamReader') as mock_reader:
+        binlog_sync.open_stream()
+        assert binlog_sync.catchup_started is not None
+        binlog_sync.finish_catchup()
+
+        binlog_sync.open_stream()
+        assert binlog_sync.catchup_started is None
+
+        binlog_sync.replaying = True
+        binlog_sync.open_stream()
+        assert binlog_sync.catchup_started is not None
+        assert all(c[1]['blocking'] is True and c[1]['resume_stream'] is True for c in mock_reader.call_args_list)
+
+def test_heartbeat_applies_pending_batch(binlog_sync):
+    """Test an idle heartbeat applies a batch whose window is over and ends the catch-up"""
+    now = datetime.utcnow()
+    binlog_sync.batch_window = 0.01
+    binlog_sync.cache.acquire_refresh_lease.return_value = 'lease-token'
+    binlog_sync.catchup_started = time.monotonic()
+    event = Mock(spec=WriteRowsEvent)
+    event.rows = [{'values': {'id': 7, 'monitor_id': 1, 'status': 0, 'time': now}}]
+    applied = []
+
+    def events():
+        yield event
+        yield Mock(spec=XidEvent, timestamp=0)
+        applied.append(binlog_sync.cache.apply_changes.called)
+        time.sleep(0.02)
+        yield Mock(spec=HeartbeatLogEvent)
+        applied.append(binlog_sync.cache.apply_changes.called)
+        binlog_sync.running = False
+
+    with patch('sync_service.BinLogStreamReader') as mock_reader:
+        mock_stream = MagicMock()
+        mock_stream.log_file, mock_stream.log_pos = 'mysql-bin.000001', 100
+        mock_stream.__iter__.return_value = events()
+        mock_reader.return_value = mock_stream
+
+        binlog_sync.start()
+
+    assert applied == [False, True]
+    assert binlog_sync.catchup_started is None
+
+def test_checkpoint_is_rate_limited(binlog_sync):
+    """Test positions are written at most once per interval unless forced, and never twice"""
+    binlog_sync.log_file, binlog_sync.log_pos = 'mysql-bin.000001', 10
+    binlog_sync.checkpoint()
+    binlog_sync.log_pos = 20
+    binlog_sync.checkpoint()
+    binlog_sync.checkpoint(force=True)
+    binlog_sync.checkpoint(force=True)
+
+    assert [c[0] for c in binlog_sync.cache.set_binlog_position.call_args_list] == [
+        ('mysql-bin.000001', 10), ('mysql-bin.000001', 20)
+    ]
+
+def test_purged_checkpoint_is_reset(binlog_sync):
+    """Test a purged log file drops the checkpoint and has the cache rebuilt"""
+    binlog_sync.log_file, binlog_sync.log_pos = 'mysql-bin.000001', 10
+
+    binlog_sync.reset_checkpoint()
+
+    assert binlog_sync.log_file is None
+    binlog_sync.cache.clear_binlog_position.assert_called_once()
+    binlog_sync.cache.invalidate.assert_called_once_with()
+
+def test_catchup_throughput_is_reported(binlog_sync):
+    """Test catch-up ends at the first recent event and reports its event rate"""
+    binlog_sync.catchup_started = time.monotonic() - 2
+    binlog_sync.track_catchup(Mock(spec=XidEvent, timestamp=time.time() - 600))
+    assert binlog_sync.catchup_started is not None
+
+    binlog_sync.track_catchup(Mock(spec=XidEvent, timestamp=time.time()))
+
+    assert binlog_sync.catchup_started is None
+    assert 0 < REGISTRY.gauge('binlog_catchup_events_per_second').value <= 1.5
+
+def test_events_are_coalesced_into_one_batch(binlog_sync):
+    """Test events within the window are applied together, with only each row's net change"""
+    now = datetime.utcnow()
+    binlog_sync.batch_window = 60
+    binlog_sync.cache.acquire_refresh_lease.return_value = 'lease-token'
+    events = [
+        (WriteRowsEvent, [{'values': {'id': 7, 'monitor_id': 1, 'status': 0, 'time': now}},
+                          {'values': {'id': 8, 'monitor_id': 2, 'status': 1, 'time': now}}]),
+        (UpdateRowsEvent, [{'before_values': {'id': 7, 'monitor_id': 1, 'status': 0, 'time': now},
+                            'after_values': {'id': 7, 'monitor_id': 1, 'status': 1, 'time': now}},
+                           {'before_values': {'id': 3, 'monitor_id': 1, 'status': 0, 'time': now},
+                            'after_values': {'id': 3, 'monitor_id': 1, 'status': 1, 'time': now}}]),
+        (DeleteRowsEvent, [{'values': {'id': 8, 'monitor_id': 2, 'status': 1, 'time': now}}])
+    ]
+    for event_type, rows in events:
+        event = Mock(spec=event_type)
+        event.rows = rows
+        binlog_sync.handle_event(event)
+    binlog_sync.commit('mysql-bin.000001', 300)
+    binlog_sync.cache.apply_changes.assert_not_called()
+
+    binlog_sync.flush()
+
+    kwargs = binlog_sync.cache.apply_changes.call_args[1]
+    assert set(kwargs) == {'inserted', 'updated', 'previous', 'position'}
+    assert kwargs['inserted'][['id', 'status']].values.tolist() == [[7, 1]]
+    assert kwargs['updated']['status'].tolist() == [1]
+    assert kwargs['previous']['status'].tolist() == [0]
+    binlog_sync.cache.acquire_refresh_lease.assert_called_once()
+
+def test_position_moves_once_batch_is_applied(binlog_sync):
+    """Test commits inside a pending batch only move the position when it is applied"""
+    binlog_sync.batch_window = 60
+    event = Mock(spec=WriteRowsEvent)
+    event.rows = [{'values': {'id': 7, 'monitor_id': 1, 'time': datetime.utcnow()}}]
+
+    binlog_sync.handle_event(event)
+    binlog_sync.commit('mysql-bin.000001', 300)
+    assert binlog_sync.log_pos is None
+
+    binlog_sync.flush()
+
+    assert (binlog_sync.log_file, binlog_sync.log_pos) == ('mysql-bin.000001', 300)
+
+def test_batch_sizes_and_event_rate_are_recorded(binlog_sync):
+    """Test applied batches record their size and publishing records the event rate"""
+    batches = REGISTRY.histogram('binlog_batch_events', buckets=BATCH_SIZE_BUCKETS)
+    before = batches.count
+    event = Mock(spec=WriteRowsEvent)
+    event.rows = [{'values': {'id': 7, 'monitor_id': 1, 'time': datetime.utcnow()}}]
+    binlog_sync.publish_metrics(force=True)
+
+    apply_event(binlog_sync, event)
+    binlog_sync.publish_metrics(force=True)
+
+    assert batches.count == before + 1
+    assert REGISTRY.gauge('binlog_events_per_second').value > 0
+
+def test_rows_wait_for_their_transaction_to_commit(binlog_sync):
+    """Test a batch whose window is over is still only applied once its transaction commits"""
+    event = Mock(spec=WriteRowsEvent)
+    event.rows = [{'values': {'id': 7, 'monitor_id': 1, 'time': datetime.utcnow()}}]
+
+    binlog_sync.handle_event(event)
+    binlog_sync.flush(due_only=True)
+    binlog_sync.cache.apply_changes.assert_not_called()
+
+    binlog_sync.commit('mysql-bin.000001', 300)
+    binlog_sync.flush(due_only=True)
+
+    binlog_sync.cache.apply_changes.assert_called_once()
+    assert binlog_sync.log_pos == 300
+
+def test_unfinished_transaction_is_replayed_not_applied(binlog_sync):
+    """Test a batch ending inside a transaction is dropped, leaving the position before it"""
+    binlog_sync.batch_window = 60
+    binlog_sync.log_file, binlog_sync.log_pos = 'mysql-bin.000001', 100
+    event = Mock(spec=WriteRowsEvent)
+    event.rows = [{'values': {'id': 7, 'monitor_id': 1, 'time': datetime.utcnow()}}]
+
+    binlog_sync.handle_event(event)
+    binlog_sync.commit('mysql-bin.000001', 300)
+    binlog_sync.handle_event(event)
+    binlog_sync.flush()
+
+    binlog_sync.cache.apply_changes.assert_not_called()
+    assert (binlog_sync.batch, binlog_sync.log_pos) == (None, 100)